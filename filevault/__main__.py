@@ -0,0 +1,5 @@
+import sys
+
+from filevault.cli import main
+
+sys.exit(main())
@@ -0,0 +1,275 @@
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+from pathlib import Path
+
+from filevault.compression import CodecPolicy, ParallelArchiver
+from filevault.engine import DEFAULT_SETTINGS, BackupEngine
+from filevault.scanner import TreeScanner
+from filevault.zipwriter import ZipStreamWriter
+
+BENCH_REPORT_VERSION = 1
+BENCH_PHASES = ("scan", "compress", "write", "rotate", "restore")
+ROTATE_INCREMENTALS = 2
+
+WORDS = ("backup archive version chunk delta manifest restore source destination file folder "
+         "schedule retention compress deflate stream index catalog journal scan write read "
+         "def class return import self None True False for in if else while try except with "
+         "the of and to a is that it on as be at by this from or an are not").split()
+
+
+# === Synthetic corpora ===
+def text_bytes(rng, size):
+    # Word salad with line structure: compresses roughly like source code/logs.
+    out = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 14))) + "\n"
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+
+def write_file(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_large(path, rng, size, compressible):
+    # Streams a big file in 1 MiB pieces; compressible data reuses a few
+    # generated text blocks so generation stays fast.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    blocks = [text_bytes(rng, 1024 * 1024) for _ in range(4)] if compressible else None
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 1024 * 1024)
+            f.write(rng.choice(blocks)[:n] if compressible else rng.randbytes(n))
+            remaining -= n
+
+
+def make_tiny(root, rng, scale):
+    for i in range(int(20000 * scale)):
+        write_file(root / f"d{i % 200:03}" / f"f{i:06}.txt", text_bytes(rng, rng.randint(0, 2048)))
+
+
+def make_huge(root, rng, scale):
+    size = int(96 * 1024 * 1024 * scale)
+    write_large(root / "logs" / "huge.log", rng, size, True)
+    write_large(root / "disk.img", rng, size, False)
+
+
+def make_deep(root, rng, scale):
+    for branch in range(max(1, int(32 * scale))):
+        path = root
+        for depth in range(64):
+            path = path / f"b{branch}_{depth}"
+            write_file(path / "note.txt", text_bytes(rng, rng.randint(100, 4000)))
+
+
+def make_media(root, rng, scale):
+    for i in range(max(1, int(40 * scale))):
+        ext = (".jpg", ".mp4", ".zip", ".png")[i % 4]
+        write_file(root / "media" / f"item{i:04}{ext}", rng.randbytes(4 * 1024 * 1024))
+
+
+def make_mixed(root, rng, scale):
+    for i in range(int(3000 * scale)):
+        path = root / "src" / f"pkg{i % 30}" / f"mod{i % 7}" / f"file{i}.py"
+        write_file(path, text_bytes(rng, rng.randint(1024, 40 * 1024)))
+    for i in range(max(1, int(200 * scale))):
+        write_file(root / "logs" / f"app{i}.log", text_bytes(rng, rng.randint(100 * 1024, 1024 * 1024)))
+    for i in range(max(1, int(50 * scale))):
+        write_file(root / "bin" / f"tool{i}.bin", rng.randbytes(rng.randint(200 * 1024, 2 * 1024 * 1024)))
+    for i in range(max(1, int(20 * scale))):
+        write_file(root / "photos" / f"img{i}.jpg", rng.randbytes(3 * 1024 * 1024))
+
+
+CORPORA = {
+    "tiny": make_tiny,
+    "huge": make_huge,
+    "deep": make_deep,
+    "media": make_media,
+    "mixed": make_mixed
+}
+
+
+def ensure_corpus(workdir, name, scale, seed):
+    # Generated once per (name, scale, seed) and reused by later runs.
+    root = Path(workdir) / "corpora" / f"{name}-{scale}-{seed}"
+    marker = root / ".complete"
+    if not marker.exists():
+        shutil.rmtree(root, ignore_errors=True)
+        data = root / "data"
+        data.mkdir(parents=True)
+        CORPORA[name](data, random.Random(f"{name}:{seed}"), scale)
+        marker.touch()
+    return root / "data"
+
+
+# === Measurements ===
+class DiscardSink:
+    # Write-only file object that drops the data: isolates compression cost.
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def time_scan(data):
+    started = time.perf_counter()
+    files = 0
+    size = 0
+    for _, entry in TreeScanner(data):
+        files += 1
+        size += entry.stat().st_size
+    return time.perf_counter() - started, files, size
+
+
+def time_compress(data, settings):
+    started = time.perf_counter()
+    writer = ZipStreamWriter(DiscardSink())
+    archiver = ParallelArchiver(writer, settings["workers"], CodecPolicy(settings["codec"], settings["codec_level"]))
+    try:
+        for arcname, entry in TreeScanner(data):
+            archiver.add_file(entry.path, arcname, entry.stat())
+        archiver.finish()
+    finally:
+        archiver.close()
+    writer.close()
+    return time.perf_counter() - started
+
+
+def run_backup(job):
+    # Returns the seconds the backup itself took. The background prune is
+    # waited for outside that, so it never overlaps a timed phase.
+    engine = BackupEngine(job)
+    started = time.perf_counter()
+    engine.run()
+    elapsed = time.perf_counter() - started
+    if engine.prune_thread:
+        engine.prune_thread.join()
+    return elapsed
+
+
+def measure_corpus(data, workdir, settings):
+    # One pass over every phase; the destination is rebuilt from scratch.
+    dest = Path(workdir) / "dest"
+    target = Path(workdir) / "restore"
+    shutil.rmtree(dest, ignore_errors=True)
+    shutil.rmtree(target, ignore_errors=True)
+    dest.mkdir(parents=True)
+    # No retention and no scrub: the only background work after a run.
+    job = dict(settings, source_dir=str(data), dest_dir=str(dest), incremental=True, full_every=0, max_backups=None,
+               retention=None, min_free_bytes=None, max_total_bytes=None, scrub_bytes=0)
+
+    timings = {}
+    timings["scan"], files, size = time_scan(data)
+    timings["compress"] = time_compress(data, job)
+
+    timings["write"] = run_backup(job)
+
+    # Rotation needs history: a few small incrementals and a second full
+    # backup, so keeping one version deletes the whole first chain.
+    marker = data / "bench-marker.txt"
+    try:
+        for i in range(ROTATE_INCREMENTALS):
+            write_file(marker, f"incremental {i}".encode())
+            run_backup(job)
+        run_backup(dict(job, incremental=False))
+    finally:
+        marker.unlink(missing_ok=True)
+    started = time.perf_counter()
+    BackupEngine(dict(job, max_backups=1)).enforce_rotation()
+    timings["rotate"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    BackupEngine(job).restore(None, target)
+    timings["restore"] = time.perf_counter() - started
+
+    shutil.rmtree(dest, ignore_errors=True)
+    shutil.rmtree(target, ignore_errors=True)
+    return timings, files, size
+
+
+def run_benchmarks(corpora=None, scale=1.0, seed=1, repeat=1, workdir=None, settings=None, progress=None):
+    # Returns a report dict: per corpus, the best (minimum) time of each phase
+    # over `repeat` passes, plus the corpus shape and scan/write throughput.
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    workdir = Path(workdir or Path.cwd() / "filevault-bench")
+    report = {
+        "version": BENCH_REPORT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "seed": seed,
+        "codec": settings["codec"],
+        "workers": settings["workers"],
+        "corpora": {}
+    }
+    for name in corpora or CORPORA:
+        if progress:
+            progress(f"{name}: generating corpus")
+        data = ensure_corpus(workdir, name, scale, seed)
+        best = {}
+        for i in range(repeat):
+            if progress:
+                progress(f"{name}: pass {i + 1}/{repeat}")
+            timings, files, size = measure_corpus(data, workdir / "run", settings)
+            for phase, seconds in timings.items():
+                best[phase] = min(seconds, best.get(phase, seconds))
+        report["corpora"][name] = {
+            "files": files,
+            "bytes": size,
+            "phases": {phase: round(best[phase], 4) for phase in BENCH_PHASES},
+            "write_mb_s": round(size / best["write"] / 1e6, 3) if best["write"] else None,
+            "restore_mb_s": round(size / best["restore"] / 1e6, 3) if best["restore"] else None
+        }
+    return report
+
+
+# === Baselines ===
+def compare_reports(report, baseline, tolerance=0.25, min_delta=0.05):
+    # Lists phases slower than baseline by more than `tolerance` (relative)
+    # and `min_delta` seconds (absolute, so tiny timings do not flap).
+    rows = []
+    for name, current in report["corpora"].items():
+        base = baseline.get("corpora", {}).get(name)
+        if not base:
+            continue
+        for phase in BENCH_PHASES:
+            before = base["phases"].get(phase)
+            after = current["phases"].get(phase)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0.0
+            regressed = change > tolerance and after - before > min_delta
+            rows.append({"corpus": name, "phase": phase, "baseline": before, "current": after,
+                         "change": round(change, 4), "regressed": regressed})
+    return rows
+
+
+def load_report(path):
+    with open(path, "r") as f:
+        report = json.load(f)
+    if report.get("version") != BENCH_REPORT_VERSION:
+        raise ValueError(f"{path} is not a version {BENCH_REPORT_VERSION} benchmark report")
+    return report
+
+
+def save_report(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
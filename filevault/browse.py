@@ -0,0 +1,594 @@
+import bisect
+import html
+import io
+import itertools
+import mimetypes
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+from filevault.catalog import Catalog, extract_zip_row, iter_member, open_member
+from filevault.chunkstore import CHUNK_STORE_DIR_NAME, ChunkStore
+from filevault.encryption import open_archive
+from filevault.manifest import MANIFEST_FILE_NAME
+from filevault.volumes import volume_name
+
+BLOCK_BYTES = 256 * 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+TREES_CACHED = 8
+CHUNK_SIZES_KEPT = 1 << 20
+SEND_BYTES = 64 * 1024
+
+
+# === Block cache ===
+class BlockCache:
+    # Decompressed blocks of archive members and chunk store chunks, least
+    # recently used dropped first once `max_bytes` is exceeded. Shared by
+    # every open file, so re-reading a region (or another client reading
+    # it) never decompresses it again.
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and self.blocks:
+                _, dropped = self.blocks.popitem(last=False)
+                self.bytes -= len(dropped)
+
+
+# === Sources ===
+class StoredSource:
+    # A member stored without compression: any range is one seek away (one
+    # segment to decrypt in an encrypted archive).
+
+    def __init__(self, archive_path, row):
+        self.fp = open_archive(archive_path)
+        self.size = row["size"]
+        open_member(self.fp, row)
+        self.data_offset = self.fp.tell()
+
+    def read_at(self, offset, size):
+        self.fp.seek(self.data_offset + offset)
+        return self.fp.read(max(0, min(size, self.size - offset)))
+
+    def close(self):
+        self.fp.close()
+
+
+class CompressedSource:
+    # A compressed member, read as blocks of BLOCK_BYTES decompressed bytes.
+    # A block not in the cache is reached by decompressing forward from the
+    # position the last read stopped at (or from the start for a block
+    # behind it), caching every block on the way; the member's CRC is
+    # checked whenever a pass reaches its end.
+
+    def __init__(self, archive_path, row, cache):
+        self.archive_path = archive_path
+        self.row = row
+        self.size = row["size"]
+        self.cache = cache
+        self.key = (row["archive"], row["volume"] or 1, row["header_offset"])
+        self.fp = None
+        self.stream = None
+        self.next_block = 0
+        self.pending = bytearray()
+
+    def _restart(self):
+        if self.fp is None:
+            self.fp = open_archive(self.archive_path)
+        self.stream = iter_member(self.fp, self.row)
+        self.next_block = 0
+        self.pending = bytearray()
+
+    def _block(self, index):
+        data = self.cache.get(self.key + (index,))
+        if data is not None:
+            return data
+        if self.stream is None or self.next_block > index:
+            self._restart()
+        while True:
+            for piece in self.stream:
+                self.pending += piece
+                if len(self.pending) >= BLOCK_BYTES:
+                    break
+            data = bytes(self.pending[:BLOCK_BYTES])
+            del self.pending[:BLOCK_BYTES]
+            self.cache.put(self.key + (self.next_block,), data)
+            self.next_block += 1
+            if self.next_block > index or not data:
+                return data
+
+    def read_at(self, offset, size):
+        out = bytearray()
+        while size > 0 and offset < self.size:
+            index, skip = divmod(offset, BLOCK_BYTES)
+            block = self._block(index)
+            piece = block[skip:skip + size]
+            if not piece:
+                break
+            out += piece
+            offset += len(piece)
+            size -= len(piece)
+        return bytes(out)
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+
+class ChunkSource:
+    # A chunk store file: its chunks are read (and cached) one at a time, so
+    # only the chunks a range touches are loaded, found by bisecting the
+    # chunk start offsets. The last one is also kept here, for sequential
+    # reads through a chunk larger than the cache. `lengths` are the chunk
+    # lengths from the version record; versions written before they were
+    # recorded learn them by loading each chunk once (kept in `known_lengths`,
+    # shared by every open file).
+
+    def __init__(self, store, digests, size, cache, lengths=None, known_lengths=None):
+        self.store = store
+        self.digests = digests
+        self.size = size
+        self.cache = cache
+        self.lengths = lengths
+        self.known_lengths = {} if known_lengths is None else known_lengths
+        self.starts = None
+        self.last = (None, None)
+
+    def _chunk(self, digest):
+        if self.last[0] == digest:
+            return self.last[1]
+        key = ("chunk", digest)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.store.get_chunk(digest)
+            self.cache.put(key, data)
+            if self.lengths is None:
+                if len(self.known_lengths) > CHUNK_SIZES_KEPT:
+                    self.known_lengths.clear()
+                self.known_lengths[digest] = len(data)
+        self.last = (digest, data)
+        return data
+
+    def _starts(self):
+        if self.starts is None:
+            lengths = self.lengths
+            if lengths is None:
+                lengths = [self.known_lengths.get(digest) or len(self._chunk(digest)) for digest in self.digests]
+            self.starts = [0, *itertools.accumulate(lengths)]
+        return self.starts
+
+    def read_at(self, offset, size):
+        starts = self._starts()
+        out = bytearray()
+        index = bisect.bisect_right(starts, offset) - 1
+        while size > 0 and index < len(self.digests):
+            piece = self._chunk(self.digests[index])[offset - starts[index]:offset - starts[index] + size]
+            if not piece:
+                break
+            out += piece
+            offset += len(piece)
+            size -= len(piece)
+            index += 1
+        return bytes(out)
+
+    def close(self):
+        pass
+
+
+class RebuiltSource:
+    # A file stored as a delta patch has no byte ranges of its own: every
+    # open rebuilds the whole file (its base, then each patch) into a temp
+    # file in the destination, which is dropped on close. Opening one costs
+    # a full restore of that file, however little of it is read.
+
+    def __init__(self, dest_base, row):
+        fd, name = tempfile.mkstemp(prefix="browse-rebuild-", dir=dest_base)
+        os.close(fd)
+        self.path = Path(name)
+        try:
+            extract_zip_row(dest_base, row, self.path)
+            self.fp = open(self.path, "rb")
+        except Exception:
+            self.path.unlink(missing_ok=True)
+            raise
+        self.size = row["size"]
+
+    def read_at(self, offset, size):
+        self.fp.seek(offset)
+        return self.fp.read(size)
+
+    def close(self):
+        self.fp.close()
+        self.path.unlink(missing_ok=True)
+
+
+class VirtualFile(io.RawIOBase):
+    # Read-only, seekable file over one of the sources above.
+
+    def __init__(self, source):
+        self.source = source
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.source.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        data = self.source.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+
+# === Version tree ===
+class VersionTree:
+    # Every version of a destination as one read-only tree, without
+    # extracting anything: "/<version>/<path>". Listings come from the
+    # catalog (each version's directory index is built once and the last few
+    # are kept); open() reads a file's bytes on demand, straight from the
+    # archive member or the chunks that hold them, through a shared block
+    # cache. Safe to use from several threads.
+
+    def __init__(self, dest_base, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.dest_base = Path(dest_base)
+        self.cache = BlockCache(cache_bytes)
+        self.store = ChunkStore(self.dest_base)
+        self.chunk_sizes = {}
+        self.trees = OrderedDict()
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.by_name = {}
+
+    def _stamp(self):
+        stamp = []
+        for path in (self.dest_base / MANIFEST_FILE_NAME, self.dest_base / CHUNK_STORE_DIR_NAME / "versions.json"):
+            try:
+                stamp.append(path.stat().st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def versions(self):
+        # Version rows, oldest first; re-read when a backup or prune changed
+        # the destination.
+        with self.lock:
+            stamp = self._stamp()
+            if stamp != self.stamp:
+                with Catalog(self.dest_base) as catalog:
+                    catalog.sync()
+                    rows = catalog.versions()
+                self.by_name = {row["name"]: row for row in rows}
+                for name in [name for name in self.trees if name not in self.by_name]:
+                    del self.trees[name]
+                self.stamp = stamp
+            return list(self.by_name.values())
+
+    def _index(self, name):
+        # {directory: {child name: row, or None for a directory}} of a version.
+        self.versions()
+        with self.lock:
+            if name in self.trees:
+                self.trees.move_to_end(name)
+                return self.trees[name]
+            version = self.by_name.get(name)
+        if version is None:
+            raise FileNotFoundError(name)
+        with Catalog(self.dest_base) as catalog:
+            rows = catalog.tree(version)
+        chunk_lists = {}
+        index = {"": {}}
+        for path, row in rows.items():
+            if row["kind"] == "chunk store":
+                if row["archive"] not in chunk_lists:
+                    chunk_lists[row["archive"]] = self.store.load_version(row["archive"])["files"]
+                record = chunk_lists[row["archive"]][path]
+                row["chunks"] = record["chunks"]
+                row["chunk_sizes"] = record.get("chunk_sizes")
+            parent = ""
+            for part in path.split("/")[:-1]:
+                child = f"{parent}/{part}" if parent else part
+                index[parent].setdefault(part, None)
+                index.setdefault(child, {})
+                parent = child
+            index[parent][path.rpartition("/")[2]] = row
+        with self.lock:
+            self.trees[name] = index
+            while len(self.trees) > TREES_CACHED:
+                self.trees.popitem(last=False)
+        return index
+
+    def stat(self, version, path=""):
+        # {"name", "dir", "size", "mtime_ns"} or None when it does not exist.
+        path = path.strip("/")
+        if not version:
+            return {"name": "", "dir": True, "size": 0, "mtime_ns": None}
+        self.versions()
+        if version not in self.by_name:
+            return None
+        index = self._index(version)
+        if path in index:
+            created = self.by_name[version]["created"]
+            return {"name": path.rpartition("/")[2] or version, "dir": True, "size": 0,
+                    "mtime_ns": int(created * 1e9) if created else None}
+        parent, _, child = path.rpartition("/")
+        row = index.get(parent, {}).get(child)
+        if row is None:
+            return None
+        return {"name": child, "dir": False, "size": row["size"] or 0, "mtime_ns": row["mtime_ns"]}
+
+    def listdir(self, version=None, path=""):
+        # The entries of a directory, directories first; the root lists the
+        # versions. Raises FileNotFoundError / NotADirectoryError.
+        if not version:
+            return [{"name": row["name"], "dir": True, "size": 0, "mtime_ns": int(row["created"] * 1e9)}
+                    for row in self.versions()]
+        info = self.stat(version, path)
+        if info is None:
+            raise FileNotFoundError(f"{version}/{path}")
+        if not info["dir"]:
+            raise NotADirectoryError(f"{version}/{path}")
+        path = path.strip("/")
+        entries = []
+        for name, row in self._index(version)[path].items():
+            if row is None:
+                entries.append(self.stat(version, f"{path}/{name}" if path else name))
+            else:
+                entries.append({"name": name, "dir": False, "size": row["size"] or 0, "mtime_ns": row["mtime_ns"]})
+        return sorted(entries, key=lambda entry: (not entry["dir"], entry["name"]))
+
+    def open(self, version, path):
+        # A seekable binary file object; bytes are only read as they are asked for.
+        path = path.strip("/")
+        info = self.stat(version, path)
+        if info is None:
+            raise FileNotFoundError(f"{version}/{path}")
+        if info["dir"]:
+            raise IsADirectoryError(f"{version}/{path}")
+        parent, _, child = path.rpartition("/")
+        row = self._index(version)[parent][child]
+        if row["kind"] == "chunk store":
+            source = ChunkSource(self.store, row["chunks"], row["size"], self.cache, row["chunk_sizes"],
+                                 self.chunk_sizes)
+        else:
+            archive_path = self.dest_base / volume_name(row["archive"], row["volume"] or 1)
+            if not archive_path.exists():
+                where = f" (streamed to {row['location']})" if row["location"] else ""
+                raise FileNotFoundError(f"Missing archive in backup chain: {archive_path.name}{where}")
+            if row["delta"]:
+                source = RebuiltSource(self.dest_base, row)
+            elif row["method"] == 0:
+                source = StoredSource(archive_path, row)
+            else:
+                source = CompressedSource(archive_path, row, self.cache)
+        return VirtualFile(source)
+
+
+# === HTTP / WebDAV ===
+class BrowseHandler(BaseHTTPRequestHandler):
+    # Serves a VersionTree read-only: HTML listings and files (with Range
+    # requests) over HTTP, plus the PROPFIND subset of WebDAV that file
+    # managers need to mount it (davfs2, Finder, Explorer).
+    server_version = "FileVault"
+    protocol_version = "HTTP/1.1"
+
+    def handle_one_request(self):
+        self.responded = False
+        super().handle_one_request()
+
+    def end_headers(self):
+        super().end_headers()
+        self.responded = True
+
+    def _fail(self, error):
+        # Reading the tree failed: a missing file is a 404, anything else (an
+        # encrypted archive without its key, a corrupt member) a 500 saying
+        # why. Once the headers are out, all that is left is to cut the
+        # response short by closing the connection.
+        self.log_error("%s: %s", self.path, error)
+        if self.responded:
+            self.close_connection = True
+        elif isinstance(error, FileNotFoundError):
+            self.send_error(404, None, str(error))
+        else:
+            self.send_error(500, None, str(error))
+
+    def _locate(self):
+        parts = [unquote(part) for part in urlsplit(self.path).path.split("/") if part]
+        return (parts[0] if parts else None), "/".join(parts[1:])
+
+    def _info(self):
+        version, path = self._locate()
+        info = self.server.tree.stat(version, path)
+        if info is None:
+            self.send_error(404)
+        return version, path, info
+
+    def _href(self, version, path, is_dir):
+        parts = [part for part in [version] + path.split("/") if part]
+        href = "/" + "/".join(quote(part) for part in parts)
+        return href + "/" if is_dir and parts else href
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header("Allow", "OPTIONS, GET, HEAD, PROPFIND")
+        self.send_header("DAV", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        try:
+            version, path, info = self._info()
+            if info is None:
+                return
+            if info["dir"]:
+                self._send_listing(version, path, body)
+            else:
+                self._send_file(version, path, info, body)
+        except Exception as e:
+            self._fail(e)
+
+    def _send_listing(self, version, path, body):
+        title = html.escape("/" + "/".join(part for part in (version, path) if part))
+        lines = [f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{title}</title></head><body>",
+                 f"<h1>{title}</h1><ul>"]
+        if version:
+            lines.append("<li><a href=\"../\">../</a></li>")
+        for entry in self.server.tree.listdir(version, path):
+            if version:
+                href = self._href(version, f"{path}/{entry['name']}" if path else entry["name"], entry["dir"])
+            else:
+                href = self._href(entry["name"], "", True)
+            label = html.escape(entry["name"] + ("/" if entry["dir"] else ""))
+            size = "" if entry["dir"] else f" ({entry['size']} bytes)"
+            lines.append(f"<li><a href=\"{href}\">{label}</a>{size}</li>")
+        lines.append("</ul></body></html>")
+        data = "\n".join(lines).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _send_file(self, version, path, info, body):
+        size = info["size"]
+        start, end = 0, size - 1
+        status = 200
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes=") and "," not in requested:
+            first, _, last = requested[6:].strip().partition("-")
+            try:
+                if first:
+                    start, end = int(first), min(int(last) if last else size - 1, size - 1)
+                else:
+                    start, end = max(size - int(last), 0), size - 1
+            except ValueError:
+                start, end = 0, size - 1
+            else:
+                if start > end or start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+        f = self.server.tree.open(version, path) if body and size else io.BytesIO()
+        with f:
+            self.send_response(status)
+            self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1 if size else 0))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            if info["mtime_ns"]:
+                self.send_header("Last-Modified", formatdate(info["mtime_ns"] / 1e9, usegmt=True))
+            self.end_headers()
+            if not body or not size:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(SEND_BYTES, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def do_PROPFIND(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        try:
+            self._propfind()
+        except Exception as e:
+            self._fail(e)
+
+    def _propfind(self):
+        version, path, info = self._info()
+        if info is None:
+            return
+        entries = [(version, path, info)]
+        if info["dir"] and self.headers.get("Depth", "1") != "0":
+            for entry in self.server.tree.listdir(version, path):
+                if version:
+                    entries.append((version, f"{path}/{entry['name']}" if path else entry["name"], entry))
+                else:
+                    entries.append((entry["name"], "", entry))
+        parts = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>", "<D:multistatus xmlns:D=\"DAV:\">"]
+        for entry_version, entry_path, entry in entries:
+            props = [f"<D:displayname>{escape(entry['name'] or '/')}</D:displayname>",
+                     "<D:resourcetype><D:collection/></D:resourcetype>" if entry["dir"] else "<D:resourcetype/>"]
+            if not entry["dir"]:
+                props.append(f"<D:getcontentlength>{entry['size']}</D:getcontentlength>")
+            if entry["mtime_ns"]:
+                props.append(f"<D:getlastmodified>{formatdate(entry['mtime_ns'] / 1e9, usegmt=True)}"
+                             f"</D:getlastmodified>")
+            parts.append(f"<D:response><D:href>{escape(self._href(entry_version, entry_path, entry['dir']))}"
+                         f"</D:href><D:propstat><D:prop>{''.join(props)}</D:prop>"
+                         f"<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>")
+        parts.append("</D:multistatus>")
+        data = "\n".join(parts).encode("utf-8")
+        self.send_response(207)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_tree(tree, host="127.0.0.1", port=8080):
+    # A server for `tree`; the caller runs serve_forever(). Loopback only
+    # unless told otherwise: nothing is authenticated.
+    server = ThreadingHTTPServer((host, port), BrowseHandler)
+    server.daemon_threads = True
+    server.tree = tree
+    return server
@@ -0,0 +1,484 @@
+import bz2
+import json
+import lzma
+import os
+import sqlite3
+import struct
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from filevault.chunkstore import ChunkStore
+from filevault.delta import apply_patch, entry_path, read_patch_header
+from filevault.encryption import open_archive
+from filevault.manifest import MANIFEST_FILE_NAME, READ_BLOCK_SIZE, BackupManifest
+from filevault.volumes import archive_name, volume_files, volume_name
+
+CATALOG_FILE_NAME = "backup_catalog.sqlite"
+CATALOG_VERSION = 6
+BACKUP_TIME_FORMAT = "%m-%d-%Y_%H-%M-%S"
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    base TEXT NOT NULL,
+    created REAL NOT NULL,
+    location TEXT,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    verified REAL,
+    verify_status TEXT,
+    volumes TEXT
+);
+CREATE INDEX IF NOT EXISTS versions_created ON versions (created);
+CREATE INDEX IF NOT EXISTS versions_base ON versions (base, created);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    version_id INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    method INTEGER,
+    crc INTEGER,
+    header_offset INTEGER,
+    compress_size INTEGER,
+    volume INTEGER,
+    delta INTEGER,
+    PRIMARY KEY (path, version_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_version ON entries (version_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+ENTRY_COLUMNS = ("path", "deleted", "size", "mtime_ns", "sha256", "method", "crc", "header_offset", "compress_size",
+                 "volume", "delta")
+
+
+def parse_backup_time(text):
+    # "backup_10-17-2026_14-05-00[.zip]" or a bare manifest timestamp.
+    stem = text.split(".")[0]
+    if stem.startswith("backup_"):
+        stem = stem[7:]
+    try:
+        return datetime.strptime(stem, BACKUP_TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+
+def file_stamp(path):
+    # Changes whenever the file is rewritten (write_json_atomic replaces it).
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def path_filter(paths):
+    # SQL matching each path exactly or anything below it as a directory.
+    clauses = []
+    params = []
+    for path in paths:
+        path = path.strip("/")
+        clauses.append("(e.path = ? OR (e.path >= ? AND e.path < ?))")
+        params.extend([path, path + "/", path + "0"])
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+class Catalog:
+    # SQLite index of every archived path in every version of one destination,
+    # so lookups ("all versions of X", "the tree as of T") never open an
+    # archive. Zip rows carry the volume, local header offset and sizes needed
+    # to extract a member directly. The catalog is derived data: sync()
+    # rebuilds whatever is missing from the manifest and the chunk store,
+    # reading each only when it changed since the last sync.
+
+    def __init__(self, dest_base):
+        self.dest_base = Path(dest_base)
+        self.path = self.dest_base / CATALOG_FILE_NAME
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            # Older layout: it only holds derived data, so rebuild from scratch.
+            self.db.executescript("DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS versions; "
+                                  "DROP TABLE IF EXISTS meta;")
+            self.db.executescript(CATALOG_SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add_version(self, name, kind, base, created, location=None, entries=(), size=0, sha256=None, volumes=None):
+        # `sha256` is the digest of the whole archive file, when recorded;
+        # `volumes` the manifest's volume list of a split archive.
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE version_id IN (SELECT id FROM versions WHERE name = ?)", (name,))
+            self.db.execute("DELETE FROM versions WHERE name = ?", (name,))
+            volumes = json.dumps(volumes) if volumes else None
+            version_id = self.db.execute(
+                "INSERT INTO versions (name, kind, base, created, location, bytes, sha256, volumes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, kind, base, created, location, size, sha256, volumes)).lastrowid
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO entries (version_id, {', '.join(ENTRY_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in ENTRY_COLUMNS)})",
+                ((version_id, *(entry.get(column) for column in ENTRY_COLUMNS)) for entry in entries))
+
+    def add_zip_archive(self, record, zip_entries, files, size=0):
+        # Indexes an archive just written by ZipStreamWriter: `record` is its
+        # manifest record, `files` the manifest file table after the run and
+        # `size` the bytes it occupies in the destination.
+        entries = []
+        for entry in zip_entries:
+            name = entry["name"].decode("utf-8" if entry["flags"] & 0x800 else "ascii")
+            path = entry_path(name)
+            info = files.get(path, {})
+            entries.append({"path": path, "size": info.get("size") if path != name else entry["file_size"],
+                            "mtime_ns": info.get("mtime_ns"), "sha256": info.get("sha256"), "method": entry["method"],
+                            "crc": entry["crc"], "header_offset": entry["offset"],
+                            "compress_size": entry["compress_size"], "volume": entry.get("volume", 1),
+                            "delta": 1 if path != name else None})
+        entries.extend({"path": path, "deleted": 1} for path in record.get("deleted", []))
+        self.add_version(record["name"], record["kind"], record["base"],
+                         parse_backup_time(record["timestamp"]), record.get("location"), entries, size,
+                         record.get("sha256"), record.get("volumes"))
+
+    def add_chunk_version(self, name, files, size=0):
+        # `size` is the chunk data this version added to the store.
+        entries = [{"path": path, "size": info["size"], "mtime_ns": info["mtime_ns"], "sha256": info["sha256"]}
+                   for path, info in files.items()]
+        self.add_version(name, "chunk store", name, parse_backup_time(name) or 0, None, entries, size)
+
+    def remove_version(self, name):
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE version_id IN (SELECT id FROM versions WHERE name = ?)", (name,))
+            self.db.execute("DELETE FROM versions WHERE name = ?", (name,))
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def has_version(self, *names):
+        return self.db.execute(f"SELECT 1 FROM versions WHERE name IN ({', '.join('?' for _ in names)}) LIMIT 1",
+                               names).fetchone() is not None
+
+    def sync(self, manifest=None):
+        # Adds versions the catalog has not seen (older backups, a deleted or
+        # stale catalog) and drops versions that no longer exist. The manifest
+        # and the chunk store's version list are only read when their file
+        # changed since the last sync; the archive names they held then are
+        # kept in the meta table. `manifest` is an already loaded, current
+        # BackupManifest to use instead of reading it again.
+        known = {row["name"] for row in self.db.execute("SELECT name FROM versions")}
+        live = set()
+        fresh = not known
+
+        manifest_path = self.dest_base / MANIFEST_FILE_NAME
+        stamp = file_stamp(manifest_path)
+        if stamp is not None and stamp == self.get_meta("manifest_stamp"):
+            live.update(self.get_meta("manifest_names"))
+        else:
+            manifest = manifest or BackupManifest(self.dest_base).load()
+            names = set()
+            for record in manifest.archives:
+                names.add(record["name"])
+                names.update(volume_files(record))
+                if record["name"] not in known:
+                    # The manifest's digests describe the newest archive only.
+                    newest = record is manifest.archives[-1]
+                    self._index_zip_file(record, manifest.files if newest else {})
+            live.update(names)
+            self.set_meta("manifest_names", sorted(names))
+            self.set_meta("manifest_stamp", stamp)
+
+        store = ChunkStore(self.dest_base)
+        stamp = file_stamp(store.versions_file)
+        if stamp is not None and stamp == self.get_meta("chunk_stamp"):
+            live.update(self.get_meta("chunk_names"))
+        else:
+            names = set()
+            for record in store.list_versions():
+                names.add(record["name"])
+                if record["name"] not in known:
+                    self.add_chunk_version(record["name"], store.load_version(record["name"])["files"],
+                                           record.get("new_bytes", 0))
+            live.update(names)
+            self.set_meta("chunk_names", sorted(names))
+            self.set_meta("chunk_stamp", stamp)
+
+        if fresh:
+            # Archives from before the manifest existed are plain full backups.
+            for archive_path in self.dest_base.glob("backup_*.zip"):
+                if archive_path.name not in live and archive_name(archive_path.name) == archive_path.name:
+                    live.add(archive_path.name)
+                    self._index_zip_file({"name": archive_path.name, "kind": "full", "base": archive_path.name,
+                                          "timestamp": archive_path.name, "deleted": []}, {})
+
+        for name in known - live:
+            # Archives outside the manifest stay as long as their file does.
+            if not (self.dest_base / name).exists():
+                self.remove_version(name)
+
+    def _index_zip_file(self, record, files):
+        archive_path = self.dest_base / record["name"]
+        created = parse_backup_time(record["timestamp"])
+        if not archive_path.exists():
+            # Streamed elsewhere: the version is known but not extractable here.
+            self.add_version(record["name"], record["kind"], record["base"], created or 0, record.get("location"),
+                             sha256=record.get("sha256"), volumes=record.get("volumes"))
+            return
+        if created is None:
+            created = archive_path.stat().st_mtime
+        entries = []
+        size = 0
+        for number, file_name in enumerate(volume_files(record), start=1):
+            volume_path = self.dest_base / file_name
+            if not volume_path.exists():
+                continue
+            size += volume_path.stat().st_size
+            with open_archive(volume_path) as fp, zipfile.ZipFile(fp, "r") as zipf:
+                for info in zipf.infolist():
+                    path = entry_path(info.filename)
+                    known = files.get(path, {})
+                    if path != info.filename:
+                        # A patch: the file's size and digest are in its header
+                        # (FVDELTA1 patches only have the size there).
+                        with zipf.open(info) as member:
+                            file_size, sha256 = read_patch_header(member.read)
+                        sha256 = sha256 or known.get("sha256")
+                    else:
+                        file_size = info.file_size
+                        sha256 = known.get("sha256") if known.get("size") == info.file_size else None
+                    entries.append({"path": path, "size": file_size, "mtime_ns": None, "sha256": sha256,
+                                    "method": info.compress_type, "crc": info.CRC,
+                                    "header_offset": info.header_offset, "compress_size": info.compress_size,
+                                    "volume": number, "delta": 1 if path != info.filename else None})
+        entries.extend({"path": path, "deleted": 1} for path in record.get("deleted", []))
+        self.add_version(record["name"], record["kind"], record["base"], created, record.get("location"), entries,
+                         size, record.get("sha256"), record.get("volumes"))
+
+    def versions(self):
+        return [dict(row) for row in self.db.execute("SELECT * FROM versions ORDER BY created, id")]
+
+    def find_version(self, name=None, as_of=None):
+        # A version by name, the newest one taken at or before `as_of` (epoch
+        # seconds), or the newest overall.
+        if name:
+            if name.endswith(".json"):
+                name = name[:-5]
+            row = self.db.execute("SELECT * FROM versions WHERE name = ?", (name,)).fetchone()
+        elif as_of is not None:
+            row = self.db.execute("SELECT * FROM versions WHERE created <= ? ORDER BY created DESC, id DESC LIMIT 1",
+                                  (as_of,)).fetchone()
+        else:
+            row = self.db.execute("SELECT * FROM versions ORDER BY created DESC, id DESC LIMIT 1").fetchone()
+        if row is None:
+            raise Exception(f"No backup found for {name or as_of or 'this destination'}.")
+        return dict(row)
+
+    def entries(self, version):
+        # The files written by one version itself (not its chain).
+        rows = self.db.execute("SELECT * FROM entries WHERE version_id = ? AND deleted = 0 "
+                               "ORDER BY volume, header_offset",
+                               (version["id"],))
+        return [dict(row) for row in rows]
+
+    def mark_verified(self, name, status, when):
+        with self.db:
+            self.db.execute("UPDATE versions SET verified = ?, verify_status = ? WHERE name = ?", (when, status, name))
+
+    def scrub_order(self):
+        # Never-verified versions first, then the longest unverified ones.
+        return [dict(row) for row in self.db.execute(
+            "SELECT * FROM versions ORDER BY verified IS NOT NULL, verified, created, id")]
+
+    def history(self, path):
+        # Every version that wrote or deleted `path`, oldest first.
+        rows = self.db.execute(
+            "SELECT v.name AS version, v.kind, v.created, e.deleted, e.size, e.mtime_ns, e.sha256 "
+            "FROM entries e JOIN versions v ON v.id = e.version_id WHERE e.path = ? ORDER BY v.created, v.id",
+            (path.strip("/"),))
+        return [dict(row) for row in rows]
+
+    def tree(self, version, paths=None):
+        # The files of `version` (a row from find_version), each mapped to the
+        # row of the archive that holds its data: replays the chain from its
+        # full backup, so an incremental resolves to the right older archive.
+        sql = ("SELECT e.*, v.name AS archive, v.kind, v.location FROM entries e "
+               "JOIN versions v ON v.id = e.version_id "
+               "WHERE v.base = ? AND (v.created < ? OR (v.created = ? AND v.id <= ?))")
+        params = [version["base"], version["created"], version["created"], version["id"]]
+        if paths:
+            clause, extra = path_filter(paths)
+            sql += " AND " + clause
+            params.extend(extra)
+        sql += " ORDER BY v.created, v.id"
+
+        # A patch row keeps the row it applies to as its "base".
+        latest = {}
+        for row in self.db.execute(sql, params):
+            if row["deleted"]:
+                latest.pop(row["path"], None)
+            else:
+                row = dict(row)
+                if row["delta"]:
+                    row["base"] = latest.get(row["path"])
+                latest[row["path"]] = row
+        return latest
+
+
+# === Extraction ===
+def open_member(fp, row):
+    # Seeks straight to a member's data using the catalogued header offset.
+    fp.seek(row["header_offset"])
+    header = fp.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise Exception(f"Bad local header for {row['path']} in {row['archive']}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    fp.seek(row["header_offset"] + 30 + name_length + extra_length)
+
+
+def member_decompressor(fp, method):
+    if method == zipfile.ZIP_STORED:
+        return None, 0
+    if method == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-15), 0
+    if method == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Decompressor(), 0
+    if method == zipfile.ZIP_LZMA:
+        # 2-byte version, 2-byte properties size, then the LZMA1 properties.
+        _, props_size = struct.unpack("<HH", fp.read(4))
+        props = fp.read(props_size)
+        if props_size != 5 or len(props) != 5:
+            raise Exception(f"Bad LZMA properties ({props_size} bytes)")
+        # One byte packing lc, lp and pb, then the dictionary size.
+        lc, lp, pb = props[0] % 9, props[0] // 9 % 5, props[0] // 45
+        filters = [{"id": lzma.FILTER_LZMA1, "dict_size": struct.unpack("<I", props[1:5])[0],
+                    "lc": lc, "lp": lp, "pb": pb}]
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters), 4 + props_size
+    raise Exception(f"Unsupported compression method {method}")
+
+
+def iter_member(fp, row):
+    # Yields the decompressed data of one member, then checks its CRC.
+    open_member(fp, row)
+    decompressor, header_size = member_decompressor(fp, row["method"])
+    remaining = row["compress_size"] - header_size
+    crc = 0
+    while remaining > 0:
+        data = fp.read(min(READ_BLOCK_SIZE, remaining))
+        if not data:
+            raise Exception(f"Truncated member {row['path']} in {row['archive']}")
+        remaining -= len(data)
+        if decompressor:
+            data = decompressor.decompress(data)
+        crc = zlib.crc32(data, crc)
+        yield data
+    if decompressor and hasattr(decompressor, "flush"):
+        data = decompressor.flush()
+        crc = zlib.crc32(data, crc)
+        yield data
+    if crc != row["crc"]:
+        raise Exception(f"CRC mismatch in {row['path']} from {row['archive']}")
+
+
+def extract_zip_member(archive_path, row, target):
+    with open_archive(archive_path) as fp, open(target, "wb") as out:
+        for data in iter_member(fp, row):
+            out.write(data)
+
+
+def extract_zip_row(dest_base, row, target):
+    # Writes the file a zip row stands for to `target`. A patch row first
+    # rebuilds its base (recursively, at most delta_rebase_after deep) in a
+    # temp file next to the target.
+    archive_path = dest_base / volume_name(row["archive"], row["volume"] or 1)
+    if not archive_path.exists():
+        where = f" (streamed to {row['location']})" if row["location"] else ""
+        raise Exception(f"Missing archive in backup chain: {archive_path.name}{where}")
+    if not row["delta"]:
+        extract_zip_member(archive_path, row, target)
+        return
+    if not row.get("base"):
+        raise Exception(f"Missing delta base for {row['path']} in {row['archive']}")
+    base_path = target.with_name(target.name + ".base")
+    try:
+        extract_zip_row(dest_base, row["base"], base_path)
+        with open_archive(archive_path) as fp:
+            apply_patch(base_path, iter_member(fp, row), target, row["sha256"])
+    finally:
+        base_path.unlink(missing_ok=True)
+
+
+def safe_target(target_dir, path):
+    # The catalog paths come from archive member names: refuse any that would
+    # land outside target_dir.
+    parts = path.split("/")
+    for part in parts:
+        if (part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part)
+                or os.path.splitdrive(part)[0]):
+            raise Exception(f"Refusing to restore unsafe path {path!r}")
+    return target_dir.joinpath(*parts)
+
+
+def extract_members(dest_base, rows, target_dir, workers=None, progress=None):
+    # Restores catalog rows (from Catalog.tree) into target_dir on a thread
+    # pool. Zip members are read with a direct seek; chunk store files are
+    # reassembled from their chunks. Returns the number of files restored.
+    dest_base = Path(dest_base)
+    target_dir = Path(target_dir)
+    store = ChunkStore(dest_base)
+    chunk_lists = {}
+
+    def chunks_for(row):
+        if row["archive"] not in chunk_lists:
+            chunk_lists[row["archive"]] = store.load_version(row["archive"])["files"]
+        return chunk_lists[row["archive"]][row["path"]]["chunks"]
+
+    def restore_one(row):
+        target = safe_target(target_dir, row["path"])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if row["kind"] == "chunk store":
+            with open(target, "wb") as f:
+                for digest in chunks_for(row):
+                    f.write(store.get_chunk(digest))
+        else:
+            extract_zip_row(dest_base, row, target)
+        if row["mtime_ns"]:
+            os.utime(target, ns=(row["mtime_ns"], row["mtime_ns"]))
+
+    # Chunk lists are loaded up front so worker threads only read them.
+    for row in rows:
+        if row["kind"] == "chunk store":
+            chunks_for(row)
+
+    # Sorted by archive, volume and offset so each file is read front to back.
+    rows = sorted(rows, key=lambda row: (row["archive"], row["volume"] or 1, row["header_offset"] or 0))
+    total_files = len(rows)
+    done = 0
+    bytes_done = 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for row, _ in zip(rows, pool.map(restore_one, rows)):
+            done += 1
+            bytes_done += row["size"] or 0
+            if progress and (done % 10 == 0 or done == total_files):
+                progress(done, total_files, row["path"], bytes_done)
+    return total_files
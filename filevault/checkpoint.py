@@ -0,0 +1,101 @@
+import json
+import os
+from pathlib import Path
+
+from filevault.delta import entry_path
+
+CHECKPOINT_FILE_NAME = "backup_checkpoint.jsonl"
+CHECKPOINT_VERSION = 2
+
+
+def entry_to_json(entry):
+    return dict(entry, name=entry["name"].decode("utf-8" if entry["flags"] & 0x800 else "ascii"))
+
+
+def entry_from_json(data):
+    return dict(data, name=data["name"].encode("utf-8" if data["flags"] & 0x800 else "ascii"))
+
+
+class ZipCheckpoint:
+    # Durable progress of the zip archive being written, kept in the
+    # destination next to its .partial file. The first line describes the
+    # run (archive name, kind, source, the newest archive it builds on); each
+    # later line is appended once the partial files have been fsynced up to
+    # "offset" (all volumes; "volume_offset" in the current one, see
+    # VolumeWriter) and lists the zip entries and manifest records written
+    # since the previous line. A run that dies leaves its files behind and
+    # the next run picks up at the last offset instead of starting over.
+
+    def __init__(self, dest_base, every_files=None, every_bytes=None):
+        self.path = Path(dest_base) / CHECKPOINT_FILE_NAME
+        self.every_files = every_files
+        self.every_bytes = every_bytes
+        self.fp = None
+        self.saved_entries = 0
+        self.saved_offset = 0
+
+    def load(self):
+        # Returns the header merged with every complete checkpoint line (a
+        # torn last line is ignored), or None without a usable checkpoint.
+        if not self.path.exists():
+            return None
+        state = None
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    break
+                if state is None:
+                    if data.get("version") != CHECKPOINT_VERSION:
+                        return None
+                    state = dict(data, offset=0, volume=1, volume_offset=0, volumes=[], entries=[], files={})
+                else:
+                    state.update(offset=data["offset"], volume=data["volume"], volume_offset=data["volume_offset"],
+                                 volumes=data["volumes"])
+                    state["entries"].extend(entry_from_json(entry) for entry in data["entries"])
+                    state["files"].update(data["files"])
+        return state
+
+    def start(self, header, state=None):
+        # Rewrites the checkpoint for a new run, or compacted to one line for
+        # a resumed run, so it never holds lines past a truncated offset.
+        lines = [dict(header, version=CHECKPOINT_VERSION)]
+        if state:
+            lines.append({"offset": state["offset"], "volume": state["volume"],
+                          "volume_offset": state["volume_offset"], "volumes": state["volumes"],
+                          "entries": [entry_to_json(entry) for entry in state["entries"]], "files": state["files"]})
+            self.saved_entries = len(state["entries"])
+            self.saved_offset = state["offset"]
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(line) + "\n" for line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.fp = open(self.path, "a")
+
+    def due(self, writer):
+        new_files = len(writer.entries) - self.saved_entries
+        new_bytes = writer.offset - self.saved_offset
+        return new_files > 0 and ((self.every_files and new_files >= self.every_files)
+                                  or (self.every_bytes and new_bytes >= self.every_bytes))
+
+    def save(self, writer, files):
+        # The archive data must be on disk before the line that points past it.
+        writer.sync()
+        entries = writer.entries[self.saved_entries:]
+        names = [entry_path(entry_to_json(entry)["name"]) for entry in entries]
+        self.fp.write(json.dumps(dict(writer.position(), offset=writer.offset,
+                                      entries=[entry_to_json(entry) for entry in entries],
+                                      files={name: files[name] for name in names})) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.saved_entries = len(writer.entries)
+        self.saved_offset = writer.offset
+
+    def discard(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        self.path.unlink(missing_ok=True)
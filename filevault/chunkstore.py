@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from filevault.manifest import stat_record, write_json_atomic
+from filevault.memory import drop_cache
+from filevault.scanner import TreeScanner, carry_forward
+from filevault.sinks import fsync_directory
+from filevault.throttle import Throttle
+
+CHUNK_STORE_DIR_NAME = "chunkstore"
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+try:
+    import numpy
+except ImportError:
+    # Optional: without it cut points are found byte by byte in Python.
+    numpy = None
+
+# Gear rolling hash: the hash at any position depends only on the previous 64
+# bytes, so cut points move with the content when bytes are inserted or removed.
+_gear_random = random.Random(0x46565354)
+GEAR_TABLE = [_gear_random.getrandbits(64) for _ in range(256)]
+GEAR_WINDOW = 64
+CHUNK_MASK = ((1 << 20) - 1) << 44
+# Bytes hashed per numpy pass: small enough for its temporaries to stay in
+# the CPU cache, large enough to amortize the per-pass overhead.
+GEAR_SCAN_STEP = 64 * 1024
+
+
+def gear_scan_python(buf, start, end):
+    # Position just past the first byte in [start, end) where the hash has
+    # the mask bits clear, or None.
+    gear = GEAR_TABLE
+    mask = CHUNK_MASK
+    h = 0
+    for b in buf[start - GEAR_WINDOW:start]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+    pos = start
+    for b in buf[start:end]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+        pos += 1
+        if not h & mask:
+            return pos
+    return None
+
+
+def gear_scan_numpy(buf, start, end):
+    # Same cut points as gear_scan_python. After 64 bytes the hash at i is
+    # the sum of GEAR[b[i - k]] << k for k < 64 (mod 2**64), so all of a
+    # step's hashes are built at once by doubling the window six times.
+    gear = numpy.array(GEAR_TABLE, dtype=numpy.uint64)
+    mask = numpy.uint64(CHUNK_MASK)
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    for lo in range(start, end, GEAR_SCAN_STEP):
+        hi = min(end, lo + GEAR_SCAN_STEP)
+        sums = gear[data[lo - GEAR_WINDOW + 1:hi]]
+        span = 1
+        while span < GEAR_WINDOW:
+            sums[span:] += sums[:-span] << numpy.uint64(span)
+            span *= 2
+        hits = numpy.flatnonzero((sums[GEAR_WINDOW - 1:] & mask) == 0)
+        if len(hits):
+            return lo + int(hits[0]) + 1
+    return None
+
+
+gear_scan = gear_scan_numpy if numpy else gear_scan_python
+
+
+def find_chunk_cut(buf, eof):
+    size = len(buf)
+    if size <= CHUNK_MIN_SIZE:
+        return size if eof else 0
+    end = min(size, CHUNK_MAX_SIZE)
+    if end < CHUNK_MAX_SIZE and not eof:
+        return 0
+    return gear_scan(buf, CHUNK_MIN_SIZE, end) or end
+
+
+def iter_file_chunks(f):
+    buf = b""
+    eof = False
+    while True:
+        cut = find_chunk_cut(buf, eof)
+        if cut:
+            yield buf[:cut]
+            buf = buf[cut:]
+            continue
+        if eof:
+            return
+        block = f.read(CHUNK_MAX_SIZE)
+        if block:
+            buf += block
+        else:
+            eof = True
+
+
+class ChunkStore:
+    # Content-addressed storage: every unique chunk is stored once under its
+    # SHA-256 and each version is a small JSON index of chunk references.
+
+    def __init__(self, dest_base, throttle=None, drop_cache=False, workers=None):
+        # With `drop_cache` the source files read leave the page cache;
+        # backup() chunks changed files on `workers` threads (hashing, zlib
+        # and the numpy scan release the GIL).
+        self.throttle = throttle or Throttle()
+        self.drop_cache = drop_cache
+        self.workers = workers or os.cpu_count() or 1
+        self.written_dirs = set()
+        self.root = Path(dest_base) / CHUNK_STORE_DIR_NAME
+        self.chunks_dir = self.root / "chunks"
+        self.versions_dir = self.root / "versions"
+        self.versions_file = self.root / "versions.json"
+
+    def list_versions(self):
+        if not self.versions_file.exists():
+            return []
+        with open(self.versions_file, "r") as f:
+            return json.load(f)
+
+    def save_versions(self, versions):
+        write_json_atomic(self.versions_file, versions)
+
+    def load_version(self, name):
+        with open(self.versions_dir / f"{name}.json", "r") as f:
+            return json.load(f)
+
+    def chunk_path(self, digest):
+        return self.chunks_dir / digest[:2] / digest
+
+    def put_chunk(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            return digest, 0
+        packed = zlib.compress(chunk, 6)
+        payload = b"z" + packed if len(packed) < len(chunk) else b"-" + chunk
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Two workers may store the same new chunk at once: one temp file each.
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        self.throttle.write(len(payload))
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.written_dirs.add(path.parent)
+        return digest, len(payload)
+
+    def sync_chunks(self):
+        # Makes the renames of the chunks written so far durable; called
+        # before a version that references them is saved.
+        if self.written_dirs:
+            for directory in self.written_dirs:
+                fsync_directory(directory)
+            fsync_directory(self.chunks_dir)
+            self.written_dirs = set()
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), "rb") as f:
+            payload = f.read()
+        chunk = zlib.decompress(payload[1:]) if payload[:1] == b"z" else payload[1:]
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise Exception(f"Corrupt chunk {digest}")
+        return chunk
+
+    def store_file(self, file):
+        # Returns (file SHA-256, chunk digests, chunk lengths, bytes written);
+        # the lengths let a reader find the chunk holding an offset.
+        digest = hashlib.sha256()
+        chunks = []
+        sizes = []
+        new_bytes = 0
+        with open(file, "rb") as f:
+            for chunk in iter_file_chunks(f):
+                self.throttle.read(len(chunk))
+                digest.update(chunk)
+                chunk_digest, written = self.put_chunk(chunk)
+                chunks.append(chunk_digest)
+                sizes.append(len(chunk))
+                new_bytes += written
+            if self.drop_cache and f.tell() > CHUNK_MAX_SIZE:
+                drop_cache(f.fileno())
+        return digest.hexdigest(), chunks, sizes, new_bytes
+
+    def backup(self, src, name, progress=None, rules=None, root=None, inodes=None, errors=None, unreadable=()):
+        # Returns None when the source is identical to the newest version.
+        # With a snapshot of src (see filevault.snapshot) the files are read
+        # from its `root`, and `inodes` gives their inode in the source.
+        # Paths that cannot be read are reported in `errors` and keep their
+        # records from the newest version.
+        errors = [] if errors is None else errors
+        unreadable = list(unreadable)
+        versions = self.list_versions()
+        previous = self.load_version(versions[-1]["name"])["files"] if versions else {}
+
+        files = {}
+        totals = {"changed": 0, "new_bytes": 0, "bytes_read": 0, "chunk_seconds": 0.0, "wait_seconds": 0.0}
+        pending = deque()
+
+        def settle(limit):
+            # Files the results of the oldest chunking jobs until at most
+            # `limit` are left running.
+            started = time.perf_counter()
+            while len(pending) > limit:
+                record, old, future = pending.popleft()
+                (record["sha256"], record["chunks"], record["chunk_sizes"], written), seconds = future.result()
+                totals["chunk_seconds"] += seconds
+                totals["new_bytes"] += written
+                totals["bytes_read"] += record["size"]
+                if not old or old["sha256"] != record["sha256"]:
+                    totals["changed"] += 1
+            totals["wait_seconds"] += time.perf_counter() - started
+
+        bytes_seen = 0
+        scanner = TreeScanner(root or src, rules)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for i, (arcname, entry) in enumerate(scanner, start=1):
+                self.throttle.file()
+                try:
+                    inode = inodes.get(arcname, entry.inode()) if inodes is not None else entry.inode()
+                    record = stat_record(entry.stat(), inode)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    errors.append(f"{entry.path}: {e}")
+                    unreadable.append(arcname)
+                    continue
+                old = previous.get(arcname)
+                if old and all(old.get(k) == record[k] for k in ("size", "mtime_ns", "inode")):
+                    record["sha256"] = old["sha256"]
+                    record["chunks"] = old["chunks"]
+                    if "chunk_sizes" in old:
+                        record["chunk_sizes"] = old["chunk_sizes"]
+                else:
+                    pending.append((record, old, pool.submit(self._timed_store, entry.path)))
+                    settle(self.workers * 2)
+                files[arcname] = record
+                bytes_seen += record["size"]
+                if progress and i % 10 == 0:
+                    progress(i, scanner.estimate_total(len(previous)), arcname, bytes_seen)
+            settle(0)
+        errors.extend(scanner.errors)
+        carry_forward(files, previous, unreadable + scanner.unreadable)
+
+        total_files = len(files)
+        if total_files == 0:
+            raise Exception("No files to back up.")
+        if progress:
+            progress(total_files, total_files, None, bytes_seen)
+
+        deleted = len(set(previous) - set(files))
+        if versions and not totals["changed"] and not deleted:
+            return None
+
+        self.sync_chunks()
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.versions_dir / f"{name}.json", {"source": str(src), "files": files})
+        stats = {"name": name, "files": total_files, "changed": totals["changed"], "deleted": deleted,
+                 "new_bytes": totals["new_bytes"]}
+        versions.append(stats)
+        self.save_versions(versions)
+        return dict(stats, bytes_read=totals["bytes_read"], chunk_seconds=totals["chunk_seconds"],
+                    wait_seconds=totals["wait_seconds"])
+
+    def _timed_store(self, path):
+        started = time.perf_counter()
+        return self.store_file(path), time.perf_counter() - started
+
+    def remove_versions(self, names):
+        # Drops the given version indexes, then garbage-collects chunks that no
+        # remaining version references. The caller must hold the destination
+        # lock so no backup is adding chunks meanwhile.
+        names = set(names)
+        versions = self.list_versions()
+        self.save_versions([record for record in versions if record["name"] not in names])
+        for name in names:
+            (self.versions_dir / f"{name}.json").unlink(missing_ok=True)
+
+        referenced = set()
+        for record in self.list_versions():
+            for entry in self.load_version(record["name"])["files"].values():
+                referenced.update(entry["chunks"])
+        freed = 0
+        for chunk_file in self.chunks_dir.glob("*/*"):
+            if chunk_file.name not in referenced:
+                freed += chunk_file.stat().st_size
+                chunk_file.unlink()
+        return freed
@@ -0,0 +1,391 @@
+import argparse
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+
+# Keep this module cheap to import: the engine (and everything it pulls in)
+# is only loaded inside the command that needs it.
+
+SETTINGS_FILE = "backup_settings.json"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="filevault", description="FileVault backup & versioning (headless)")
+    parser.add_argument("--settings", default=SETTINGS_FILE,
+                        help="settings file shared with the GUI (default: %(default)s)")
+    parser.add_argument("--source", help="override the source folder")
+    parser.add_argument("--dest", help="override the destination folder")
+    parser.add_argument("--job", help="operate on this job from the \"jobs\" list (default: the top-level job)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run one backup now")
+    run.add_argument("--incremental", action="store_true", default=None, help="only archive changed files")
+    run.add_argument("--full", dest="incremental", action="store_false", help="force a full backup")
+    run.add_argument("--workers", type=int, help="compression worker threads")
+    run.add_argument("--codec", choices=["store", "deflate", "bzip2", "lzma"])
+    run.add_argument("--stream", dest="stream_target", help='"-", "cmd:<command>" or "tcp:<host>:<port>"')
+    run.add_argument("--volume-size", dest="volume_bytes", type=parse_size,
+                     help='split the archive into volumes of at most this size, e.g. "4G" or "700M"')
+    run.add_argument("--snapshot", choices=["auto", "reflink", "hardlink", "hook"],
+                     help="read the source from a point-in-time snapshot taken at the start")
+    run.add_argument("--encrypt", dest="encryption", choices=["aes-256-gcm", "chacha20-poly1305"],
+                     help="encrypt the archive (passphrase from FILEVAULT_PASSPHRASE or the key_file setting)")
+    run.add_argument("--memory-limit", dest="memory_limit_bytes", type=parse_size,
+                     help='memory for file blocks being compressed, e.g. "256M" (default: 4 blocks per worker)')
+
+    commands.add_parser("list", help="list restorable backups")
+
+    restore = commands.add_parser("restore", help="restore a backup (or some paths of it) into a folder")
+    restore.add_argument("target", help="folder to restore into")
+    add_version_arguments(restore)
+    restore.add_argument("--path", dest="paths", action="append",
+                         help="only restore this file or directory (repeatable)")
+
+    ls = commands.add_parser("ls", help="list the files of a backup")
+    ls.add_argument("paths", nargs="*", help="only list these files or directories")
+    add_version_arguments(ls)
+
+    history = commands.add_parser("history", help="list every version of a file")
+    history.add_argument("path")
+
+    commands.add_parser("prune", help="apply the retention setting now")
+
+    verify = commands.add_parser("verify", help="check archives against the digests recorded at backup time")
+    verify.add_argument("--version", dest="names", action="append",
+                        help="only this backup (repeatable; default: every backup)")
+    verify.add_argument("--deep", action="store_true",
+                        help="decompress every file and check its CRC and SHA-256, not just the archive digest")
+    verify.add_argument("--scrub", action="store_true",
+                        help="only the next slice of scrub_bytes, least recently verified first")
+    verify.add_argument("--workers", type=int, help="archives checked in parallel")
+
+    runs = commands.add_parser("runs", help="show or export the run journal (metrics of every run)")
+    runs.add_argument("--type", default="run", choices=["run", "prune", "verify", "warning", "all"])
+    runs.add_argument("--since", type=parse_datetime, help='only records from "YYYY-MM-DD[ HH:MM]" on')
+    runs.add_argument("--format", default="table", choices=["table", "jsonl", "csv"])
+    runs.add_argument("--trend", metavar="FIELD",
+                      help="aggregate a numeric field per period, e.g. throughput_mb_s, bytes_written, phases.scan")
+    runs.add_argument("--by", default="month", choices=["day", "week", "month"])
+
+    serve = commands.add_parser("serve", help="browse every backup over HTTP/WebDAV without extracting it")
+    serve.add_argument("--bind", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=8080, help="(default: %(default)s)")
+    serve.add_argument("--cache-size", dest="cache_bytes", type=parse_size, default="64M",
+                       help="memory for decompressed blocks (default: %(default)s)")
+
+    commands.add_parser("jobs", help="list the configured backup jobs")
+
+    commands.add_parser("daemon", help="run scheduled / on-change backups of every job until interrupted")
+
+    bench = commands.add_parser("bench", help="time scan/compress/write/rotate/restore on synthetic corpora")
+    bench.add_argument("--corpus", dest="corpora", action="append",
+                       help="tiny, huge, deep, media or mixed (repeatable; default: all)")
+    bench.add_argument("--scale", type=float, default=1.0, help="corpus size factor (default: %(default)s)")
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--repeat", type=int, default=1, help="passes per corpus; the fastest counts")
+    bench.add_argument("--workdir", help="where corpora are cached and backups written (default: ./filevault-bench)")
+    bench.add_argument("--workers", type=int, help="compression worker threads")
+    bench.add_argument("--codec", choices=["store", "deflate", "bzip2", "lzma"])
+    bench.add_argument("--output", help="write the JSON report here")
+    bench.add_argument("--baseline", help="compare against this report; exit 1 on a regression")
+    bench.add_argument("--save-baseline", help="also write the report here as the new baseline")
+    bench.add_argument("--tolerance", type=float, default=0.25,
+                       help="allowed slowdown per phase, relative (default: %(default)s)")
+    return parser
+
+
+def add_version_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--version", dest="name", help="backup name as shown by 'list' (default: newest)")
+    group.add_argument("--as-of", type=parse_as_of, help='newest backup taken at or before "YYYY-MM-DD HH:MM[:SS]"')
+
+
+def parse_datetime(text):
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date/time: {text!r}")
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().removesuffix("B")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+
+
+def parse_as_of(text):
+    return parse_datetime(text).timestamp()
+
+
+def load_job_settings(args):
+    from filevault.engine import load_settings
+    from filevault.scheduler import find_job
+
+    settings = load_settings(args.settings)
+    if args.job:
+        settings = find_job(settings, args.job)
+    if args.source:
+        settings["source_dir"] = args.source
+    if args.dest:
+        settings["dest_dir"] = args.dest
+    for key in ("incremental", "workers", "codec", "stream_target", "volume_bytes", "snapshot", "encryption",
+                "memory_limit_bytes"):
+        value = getattr(args, key, None)
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def print_progress(done, total, path=None, bytes_done=0):
+    sys.stderr.write(f"\r{done}/{total} files, {bytes_done / 1e6:.1f} MB")
+    sys.stderr.flush()
+
+
+def describe_result(result):
+    if result["status"] == "no_changes":
+        return "No changes since last backup."
+    return (f"{result['name']} ({result['kind']}, {result['changed']} changed, "
+            f"{result['deleted']} deleted) -> {result['location']}")
+
+
+def cmd_run(args):
+    from filevault.engine import BackupEngine
+
+    settings = load_job_settings(args)
+    progress = print_progress if sys.stderr.isatty() and settings.get("stream_target") != "-" else None
+    engine = BackupEngine(settings, progress)
+    result = engine.run()
+    if progress:
+        sys.stderr.write("\n")
+    if engine.prune_thread:
+        # Pruning and scrubbing use thread pools, which refuse new work once
+        # the interpreter starts shutting down.
+        engine.prune_thread.join()
+    print(describe_result(result), file=sys.stderr if settings.get("stream_target") == "-" else sys.stdout)
+    return 0
+
+
+def cmd_list(args):
+    from filevault.engine import BackupEngine
+
+    for record in BackupEngine(load_job_settings(args)).list_backups():
+        print(f"{record['name']:<36} {record['kind']:<12} {record['location']}")
+    return 0
+
+
+def cmd_restore(args):
+    from filevault.engine import BackupEngine
+
+    settings = load_job_settings(args)
+    progress = print_progress if sys.stderr.isatty() else None
+    restored = BackupEngine(settings).restore(args.name, args.target, progress, args.paths, args.as_of)
+    if progress:
+        sys.stderr.write("\n")
+    print(f"Restored {restored} files to {args.target}.")
+    return 0
+
+
+def cmd_ls(args):
+    from filevault.engine import BackupEngine
+
+    tree = BackupEngine(load_job_settings(args)).tree(args.name, args.as_of, args.paths)
+    for path, row in sorted(tree.items()):
+        print(f"{row['size']:>14} {row['archive']:<32} {path}")
+    return 0
+
+
+def cmd_history(args):
+    from filevault.engine import BackupEngine
+
+    for row in BackupEngine(load_job_settings(args)).history(args.path):
+        created = datetime.fromtimestamp(row["created"]).strftime("%Y-%m-%d %H:%M:%S")
+        if row["deleted"]:
+            print(f"{created}  {row['version']:<32} deleted")
+        else:
+            print(f"{created}  {row['version']:<32} {row['size']:>14} {(row['sha256'] or '-')[:16]}")
+    return 0
+
+
+def cmd_prune(args):
+    from filevault.engine import BackupEngine
+
+    removed = BackupEngine(load_job_settings(args)).enforce_rotation()
+    for name in removed:
+        print(f"Deleted {name}")
+    return 0
+
+
+def cmd_verify(args):
+    from filevault.engine import BackupEngine
+
+    settings = load_job_settings(args)
+    budget = (settings["scrub_bytes"] or None) if args.scrub else None
+    results = BackupEngine(settings).verify(args.names, args.deep, budget)
+    for result in results:
+        print(f"{result['name']:<36} {result['kind']:<12} {result['status']}")
+        for error in result["errors"]:
+            print(f"    {error}")
+    return 1 if any(result["status"] in ("corrupt", "missing") for result in results) else 0
+
+
+def cmd_runs(args):
+    from filevault.runlog import RunLog, trend
+
+    run_log = RunLog(load_job_settings(args)["dest_dir"])
+    record_type = None if args.type == "all" else args.type
+    if args.trend:
+        print(f"{args.by:<10} {'runs':>6} {'mean':>14} {'min':>14} {'max':>14}")
+        for period, count, mean, low, high in trend(run_log.records(record_type, args.since), args.trend, args.by):
+            print(f"{period:<10} {count:>6} {mean:>14.3f} {low:>14.3f} {high:>14.3f}")
+        return 0
+    if args.format != "table":
+        run_log.export(sys.stdout, args.format, record_type, args.since)
+        return 0
+    for record in run_log.records(record_type, args.since):
+        if record["type"] == "run":
+            ratio = record.get("compression_ratio")
+            speed = record.get("throughput_mb_s")
+            rss = record.get("peak_rss_bytes")
+            print(f"{record['time']}  {record['status']:<10} {record.get('kind', '-'):<12} "
+                  f"{record.get('files_changed', 0):>7} changed {record.get('bytes_read', 0):>14} -> "
+                  f"{record.get('bytes_written', 0):>14} bytes  ratio {ratio if ratio is not None else '-':<7} "
+                  f"{speed if speed is not None else '-':>8} MB/s  {record['duration']:>8.2f}s"
+                  + (f"  peak RSS {rss / 1e6:.0f} MB" if rss else "")
+                  + (f"  {record['error']}" if record.get("error") else ""))
+        elif record["type"] == "verify":
+            print(f"{record['time']}  verify     {record['trigger']}, checked {record['checked']} "
+                  f"({record['bytes']} bytes), {len(record['corrupt'])} corrupt, {len(record['missing'])} missing")
+        elif record["type"] == "prune":
+            print(f"{record['time']}  prune      removed {len(record['removed'])}, freed {record['freed_bytes']} bytes, "
+                  f"{record['errors']} errors")
+        else:
+            print(f"{record['time']}  {record['type']:<10} {record.get('message', '')}")
+    return 0
+
+
+def cmd_serve(args):
+    from filevault.browse import VersionTree, serve_tree
+    from filevault.encryption import unlock_destination
+
+    settings = load_job_settings(args)
+    dest_dir = settings["dest_dir"]
+    if not dest_dir or not os.path.isdir(dest_dir):
+        raise Exception("Invalid folder paths.")
+    unlock_destination(dest_dir, settings)
+    tree = VersionTree(dest_dir, args.cache_bytes)
+    server = serve_tree(tree, args.bind, args.port)
+    print(f"Serving {len(tree.versions())} backups at http://{args.bind}:{server.server_port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.server_close()
+
+
+def cmd_jobs(args):
+    from filevault.scheduler import describe_schedule, load_jobs
+
+    for job in load_jobs(load_job_settings(args)):
+        print(f"{job['name']:<16} {describe_schedule(job):<20} {job['source_dir']} -> {job['dest_dir']}")
+    return 0
+
+
+def print_job_event(name, event, data):
+    stamp = time.strftime('%m-%d-%Y %H:%M:%S')
+    if event == "finished":
+        print(f"[{stamp}] {name}: {describe_result(data)}", flush=True)
+    elif event == "failed":
+        print(f"[{stamp}] {name}: Backup failed: {data}", file=sys.stderr, flush=True)
+
+
+def cmd_daemon(args):
+    from filevault.scheduler import JobScheduler, job_is_scheduled, load_jobs
+
+    settings = load_job_settings(args)
+    jobs = [settings] if args.job else load_jobs(settings)
+    if not any(job_is_scheduled(job) for job in jobs):
+        print("No schedule configured; set \"schedule\" or \"cron\" in the settings file.", file=sys.stderr)
+        return 2
+
+    scheduler = JobScheduler(print_job_event)
+    scheduler.set_limits(settings)
+    scheduler.set_jobs(jobs)
+    scheduler.start()
+
+    def stop_daemon(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop_daemon)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        scheduler.stop()
+
+
+def cmd_bench(args):
+    from filevault.bench import BENCH_PHASES, CORPORA, compare_reports, load_report, run_benchmarks, save_report
+
+    unknown = [name for name in args.corpora or [] if name not in CORPORA]
+    if unknown:
+        raise ValueError(f"Unknown corpus {unknown[0]!r}; use {', '.join(CORPORA)}.")
+    baseline = load_report(args.baseline) if args.baseline else None
+    overrides = {key: getattr(args, key) for key in ("workers", "codec") if getattr(args, key) is not None}
+    progress = lambda message: print(message, file=sys.stderr, flush=True)
+    report = run_benchmarks(args.corpora, args.scale, args.seed, args.repeat, args.workdir, overrides, progress)
+    for path in (args.output, args.save_baseline):
+        if path:
+            save_report(report, path)
+
+    print(f"{'corpus':<8} {'files':>8} {'bytes':>14} " + " ".join(f"{phase:>9}" for phase in BENCH_PHASES)
+          + f" {'write MB/s':>11}")
+    for name, result in report["corpora"].items():
+        print(f"{name:<8} {result['files']:>8} {result['bytes']:>14} "
+              + " ".join(f"{result['phases'][phase]:>9.3f}" for phase in BENCH_PHASES)
+              + f" {result['write_mb_s'] or 0:>11.1f}")
+    if baseline is None:
+        return 0
+
+    regressions = [row for row in compare_reports(report, baseline, args.tolerance) if row["regressed"]]
+    for row in regressions:
+        print(f"REGRESSION {row['corpus']}/{row['phase']}: {row['baseline']:.3f}s -> {row['current']:.3f}s "
+              f"({row['change']:+.0%})", file=sys.stderr)
+    if regressions:
+        return 1
+    print(f"No phase slower than the baseline by more than {args.tolerance:.0%}.")
+    return 0
+
+
+COMMANDS = {
+    "run": cmd_run,
+    "list": cmd_list,
+    "restore": cmd_restore,
+    "ls": cmd_ls,
+    "history": cmd_history,
+    "prune": cmd_prune,
+    "verify": cmd_verify,
+    "runs": cmd_runs,
+    "serve": cmd_serve,
+    "jobs": cmd_jobs,
+    "daemon": cmd_daemon,
+    "bench": cmd_bench
+}
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return COMMANDS[args.command](args)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
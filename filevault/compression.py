@@ -0,0 +1,330 @@
+import bz2
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from filevault.manifest import READ_BLOCK_SIZE
+from filevault.memory import BufferPool, drop_cache, read_blocks
+from filevault.throttle import Throttle
+
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+# What a spooled (bzip2/lzma) file holds while in flight: its read buffer
+# and the in-memory part of its spool.
+SPOOL_MEMORY = 5 * COMPRESS_BLOCK_SIZE
+CODEC_PROBE_SIZE = 64 * 1024
+
+CODEC_METHODS = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA
+}
+METHOD_NAMES = {method: name for name, method in CODEC_METHODS.items()}
+
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif", ".avif",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".wmv", ".flv",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".wma",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".7z", ".rar", ".zst", ".lz4", ".cab",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+    ".jar", ".apk", ".whl", ".msi", ".dmg", ".iso"
+}
+
+
+class CodecPolicy:
+    # Picks the zip method per file: known-compressed extensions are stored,
+    # other large files are stored when a quick deflate of their first block
+    # does not shrink it, everything else gets the configured codec and level.
+
+    def __init__(self, codec="deflate", level=6, min_ratio=0.95):
+        if codec not in CODEC_METHODS:
+            raise ValueError(f"Unknown codec: {codec}")
+        self.method = CODEC_METHODS[codec]
+        self.level = level
+        self.min_ratio = min_ratio
+
+    def choose(self, path, size):
+        # Returns (method, reason) where reason explains a ZIP_STORED choice.
+        if self.method == zipfile.ZIP_STORED:
+            return zipfile.ZIP_STORED, "policy"
+        if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return zipfile.ZIP_STORED, "extension"
+        if size > COMPRESS_BLOCK_SIZE:
+            with open(path, "rb") as f:
+                sample = f.read(CODEC_PROBE_SIZE)
+            if not self.worthwhile(len(sample), len(zlib.compress(sample, 1))):
+                return zipfile.ZIP_STORED, "probe"
+        return self.method, None
+
+    def worthwhile(self, raw_size, packed_size):
+        return packed_size < raw_size * self.min_ratio
+
+
+def compress_bytes(raw, method, level):
+    if method == zipfile.ZIP_BZIP2:
+        return bz2.compress(raw, max(1, min(level, 9)))
+    if method == zipfile.ZIP_LZMA:
+        # zip's LZMA framing (header + properties) comes from zipfile itself;
+        # it always uses the default preset, so `level` does not apply here.
+        compressor = zipfile.LZMACompressor()
+        return compressor.compress(raw) + compressor.flush()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def read_range(path, offset, length, buffer=None, drop=False, throttle=None):
+    # The `length` bytes at `offset` (fewer if the file shrank): a new bytes
+    # object, or a view of the reusable `buffer` read into directly. With
+    # `drop` the range leaves the page cache once read. The read is charged
+    # to the `throttle` as it happens, so the workers run at its read rate.
+    if buffer is None:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            raw = f.read(length)
+        if throttle:
+            throttle.read(len(raw))
+        return raw
+    view = memoryview(buffer)[:length]
+    done = 0
+    with open(path, "rb", buffering=0) as f:
+        f.seek(offset)
+        while done < length:
+            n = f.readinto(view[done:])
+            if not n:
+                break
+            if throttle:
+                throttle.read(n)
+            done += n
+        if drop:
+            drop_cache(f.fileno(), offset, done)
+    return view[:done]
+
+
+def compress_block(path, offset, length, last, method, level, buffer=None, drop=False, throttle=None):
+    # For deflate, each block is an independent raw stream ended with a sync
+    # flush, so the blocks of one file can be deflated on different cores and
+    # simply concatenated (only the final block sets the end-of-stream marker).
+    raw = read_range(path, offset, length, buffer, drop, throttle)
+    if method == zipfile.ZIP_STORED:
+        return raw, raw
+    if method != zipfile.ZIP_DEFLATED:
+        return raw, compress_bytes(raw, method, level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    packed = compressor.compress(raw) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return raw, packed
+
+
+def compress_spooled(path, method, level, buffer=None, drop=False, throttle=None):
+    # bzip2 and lzma streams cannot be split into blocks, so a large file is
+    # compressed by one worker into a temp spool that the writer copies out.
+    if method == zipfile.ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(max(1, min(level, 9)))
+    else:
+        compressor = zipfile.LZMACompressor()
+    spool = tempfile.SpooledTemporaryFile(max_size=COMPRESS_BLOCK_SIZE * 4)
+    digest = hashlib.sha256()
+    crc = 0
+    file_size = 0
+    for block in read_blocks(path, buffer or bytearray(COMPRESS_BLOCK_SIZE), drop, throttle):
+        crc = zlib.crc32(block, crc)
+        file_size += len(block)
+        digest.update(block)
+        spool.write(compressor.compress(block))
+    spool.write(compressor.flush())
+    spool.seek(0)
+    return spool, crc, file_size, digest.hexdigest()
+
+
+class ParallelArchiver:
+    # Compresses file blocks on a thread pool (zlib, bz2 and lzma release the
+    # GIL) while the calling thread appends finished entries to the archive in
+    # submission order. Workers charge each block they read to the throttle.
+    # Blocks are only started while their raw and compressed data fit in
+    # `memory_limit` (oldest file first), so a multi-GB file streams through
+    # instead of all its blocks piling up; the blocks of large files are read
+    # into pooled buffers, and with `drop_cache` leave the page cache behind.
+
+    def __init__(self, writer, workers=None, policy=None, throttle=None, delta=None, memory_limit=None,
+                 drop_cache=False):
+        # `delta` (a filevault.delta.DeltaEncoder) is consulted by
+        # archive_entry for large files of incremental runs.
+        self.writer = writer
+        self.workers = workers or os.cpu_count() or 1
+        self.policy = policy or CodecPolicy()
+        self.throttle = throttle or Throttle()
+        self.delta = delta
+        self.memory_limit = memory_limit or self.workers * 4 * COMPRESS_BLOCK_SIZE
+        self.drop_cache = drop_cache
+        self.buffers = BufferPool(COMPRESS_BLOCK_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.bytes_read = 0
+        self.on_written = None
+        self.stats = {}
+        # Seconds spent queueing files (add_file, including back-pressure),
+        # compressing (summed over workers), waiting for compressed blocks and
+        # hashing/writing them, and draining the queue in finish().
+        self.timings = {"queue": 0.0, "compress": 0.0, "wait": 0.0, "write": 0.0, "finish": 0.0}
+        self.timing_lock = threading.Lock()
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.timing_lock:
+                self.timings["compress"] += elapsed
+
+    def add_file(self, path, arcname, st, temporary=False, source_size=None):
+        # A `temporary` file (a delta patch) is deleted once written;
+        # `source_size` is the size of the file it stands for, which is what
+        # bytes_read counts.
+        started = time.perf_counter()
+        size = st.st_size
+        self.bytes_read += size if source_size is None else source_size
+        method, reason = self.policy.choose(path, size)
+        level = self.policy.level
+        blocks = max(1, -(-size // COMPRESS_BLOCK_SIZE))
+        # Tasks are (memory, pooled buffer?, function, arguments), started by _submit().
+        if blocks > 1 and method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            tasks = [(SPOOL_MEMORY, True, compress_spooled, (path, method, level))]
+            spooled = True
+        elif blocks == 1:
+            tasks = [(2 * size, False, compress_block, (path, 0, size, True, method, level))]
+            spooled = False
+        else:
+            tasks = [
+                (2 * COMPRESS_BLOCK_SIZE, True, compress_block,
+                 (path, i * COMPRESS_BLOCK_SIZE,
+                  COMPRESS_BLOCK_SIZE if i < blocks - 1 else size - i * COMPRESS_BLOCK_SIZE,
+                  i == blocks - 1, method, level))
+                for i in range(blocks)
+            ]
+            spooled = False
+        item = {"arcname": arcname, "st": st, "size": size, "method": method, "reason": reason,
+                "tasks": deque(tasks), "futures": deque(), "spooled": spooled,
+                "temporary": path if temporary else None}
+        self.pending.append(item)
+        self._submit()
+        while len(self.pending) > 1 and (item["tasks"] or len(self.pending) > self.workers * 64):
+            self._write_next()
+        self.timings["queue"] += time.perf_counter() - started
+
+    def _submit(self):
+        # Starts queued tasks in file order while they fit in memory_limit;
+        # one always starts when nothing is in flight, whatever its size.
+        for item in self.pending:
+            tasks = item["tasks"]
+            while tasks:
+                memory, pooled, fn, args = tasks[0]
+                if self.inflight_bytes and self.inflight_bytes + memory > self.memory_limit:
+                    return
+                tasks.popleft()
+                buffer = self.buffers.acquire() if pooled else None
+                future = self.executor.submit(self._timed, fn, *args, buffer, self.drop_cache, self.throttle)
+                item["futures"].append((future, memory, buffer))
+                self.inflight_bytes += memory
+                self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+
+    def _next_result(self, item):
+        # The next finished task of `item` (started here if memory kept it
+        # queued) and the (memory, buffer) to hand to _release() once used.
+        if not item["futures"]:
+            self._submit()
+        future, memory, buffer = item["futures"].popleft()
+        started = time.perf_counter()
+        result = future.result()
+        self.timings["wait"] += time.perf_counter() - started
+        return result, (memory, buffer)
+
+    def _release(self, held):
+        memory, buffer = held
+        if buffer is not None:
+            self.buffers.release(buffer)
+        self.inflight_bytes -= memory
+        self._submit()
+
+    def _write_next(self):
+        started = time.perf_counter()
+        wait_before = self.timings["wait"]
+        # The file stays at the head of the queue until written, so its
+        # remaining blocks are started before those of later files.
+        item = self.pending[0]
+        arcname, st, method, reason = item["arcname"], item["st"], item["method"], item["reason"]
+        if item["spooled"]:
+            (spool, crc, file_size, sha256), held = self._next_result(item)
+            with spool:
+                self.writer.reserve(spool.seek(0, os.SEEK_END))
+                spool.seek(0)
+                entry = self.writer.begin_entry(arcname, st.st_mtime, st.st_mode, method)
+                for block in iter(lambda: spool.read(READ_BLOCK_SIZE), b""):
+                    self.writer.write_data(entry, block)
+                self.writer.end_entry(entry, crc, file_size)
+            self._release(held)
+        elif len(item["futures"]) + len(item["tasks"]) == 1:
+            (raw, packed), held = self._next_result(item)
+            crc = zlib.crc32(raw)
+            sha256 = hashlib.sha256(raw).hexdigest()
+            if method != zipfile.ZIP_STORED and not self.policy.worthwhile(len(raw), len(packed)):
+                method, reason, packed = zipfile.ZIP_STORED, "probe", raw
+            self.writer.reserve(len(packed))
+            self.writer.write_entry(arcname, st.st_mtime, st.st_mode, method, crc, len(raw), packed)
+            self._release(held)
+        else:
+            digest = hashlib.sha256()
+            crc = 0
+            file_size = 0
+            # Deflated blocks are written as they arrive: the raw size is the
+            # only bound known up front.
+            self.writer.reserve(item["size"])
+            entry = self.writer.begin_entry(arcname, st.st_mtime, st.st_mode, method)
+            while item["futures"] or item["tasks"]:
+                (raw, packed), held = self._next_result(item)
+                crc = zlib.crc32(raw, crc)
+                file_size += len(raw)
+                digest.update(raw)
+                self.writer.write_data(entry, packed)
+                self._release(held)
+            self.writer.end_entry(entry, crc, file_size)
+            sha256 = digest.hexdigest()
+
+        self.pending.popleft()
+        if item["temporary"]:
+            os.unlink(item["temporary"])
+        written = self.writer.entries[-1]
+        self.record_stats(method, reason, written["file_size"], written["compress_size"])
+        if self.on_written:
+            self.on_written(arcname, sha256)
+        self.timings["write"] += time.perf_counter() - started - (self.timings["wait"] - wait_before)
+
+    def record_stats(self, method, reason, file_size, compress_size):
+        key = METHOD_NAMES[method] if reason is None or reason == "policy" else f"store ({reason})"
+        stats = self.stats.setdefault(key, {"files": 0, "bytes_in": 0, "bytes_out": 0})
+        stats["files"] += 1
+        stats["bytes_in"] += file_size
+        stats["bytes_out"] += compress_size
+
+    def finish(self):
+        started = time.perf_counter()
+        try:
+            while self.pending:
+                self._write_next()
+        finally:
+            self.close()
+            self.timings["finish"] += time.perf_counter() - started
+
+    def close(self):
+        for item in self.pending:
+            for future, memory, buffer in item["futures"]:
+                future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
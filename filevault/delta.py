@@ -0,0 +1,386 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+
+from filevault.manifest import READ_BLOCK_SIZE
+from filevault.memory import drop_cache, read_blocks
+
+SIGNATURES_DIR_NAME = "signatures"
+# Zip member names of patches: the patch for "a/b.vmdk" is stored as
+# ".fvdelta/a/b.vmdk", so a plain unzip never passes a patch off as the file.
+DELTA_PREFIX = ".fvdelta/"
+PATCH_MAGIC = b"FVDELTA2"
+# Patches from before the header carried the target's SHA-256.
+PATCH_MAGIC_V1 = b"FVDELTA1"
+SIGNATURE_MAGIC = b"FVSIG1"
+STRONG_SIZE = 16
+ADLER_MOD = 65521
+# Consecutive unmatched blocks searched byte by byte before falling back to
+# block-aligned matching; bounds the pure-Python rolling loop for a file
+# that was rewritten rather than edited.
+ROLL_BLOCKS = 16
+MAX_LITERAL_RUN = 4 * 1024 * 1024
+# A patch carrying more new data than this share of the file is not worth
+# a restore that needs the base as well.
+MAX_LITERAL_RATIO = 0.5
+
+
+def entry_path(name):
+    # The source path a zip entry stands for.
+    return name[len(DELTA_PREFIX):] if name.startswith(DELTA_PREFIX) else name
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+# === Signatures ===
+class Signature:
+    # rsync-style block signature of one file version: per fixed-size block
+    # the Adler-32 (weak, rolling) and a 128-bit BLAKE2b (strong) digest, plus
+    # the SHA-256 of the whole content it describes.
+
+    def __init__(self, block_size, size=0, sha256=None, blocks=None):
+        self.block_size = block_size
+        self.size = size
+        self.sha256 = sha256
+        self.blocks = blocks if blocks is not None else []
+
+    def add_block(self, block):
+        self.blocks.append((zlib.adler32(block), strong_hash(block)))
+
+    def to_bytes(self):
+        return (SIGNATURE_MAGIC + struct.pack("<QQ", self.block_size, self.size) + bytes.fromhex(self.sha256)
+                + b"".join(struct.pack("<I", weak) + strong for weak, strong in self.blocks))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data.startswith(SIGNATURE_MAGIC):
+            raise ValueError("not a signature file")
+        header = len(SIGNATURE_MAGIC)
+        block_size, size = struct.unpack_from("<QQ", data, header)
+        sha256 = data[header + 16:header + 48].hex()
+        record = 4 + STRONG_SIZE
+        blocks = [(struct.unpack_from("<I", data, i)[0], data[i + 4:i + record])
+                  for i in range(header + 48, len(data), record)]
+        return cls(block_size, size, sha256, blocks)
+
+
+class BlockSigner:
+    # Builds the signature of a file from the data as it is read, in any
+    # read sizes.
+
+    def __init__(self, block_size):
+        self.signature = Signature(block_size)
+        self.digest = hashlib.sha256()
+        self.pending = b""
+
+    def update(self, data):
+        self.digest.update(data)
+        self.signature.size += len(data)
+        data = self.pending + data
+        size = self.signature.block_size
+        full = len(data) - len(data) % size
+        for i in range(0, full, size):
+            self.signature.add_block(data[i:i + size])
+        self.pending = data[full:]
+
+    def finish(self):
+        if self.pending:
+            self.signature.add_block(self.pending)
+        self.signature.sha256 = self.digest.hexdigest()
+        return self.signature
+
+
+# === Patches ===
+class PatchWriter:
+    # Patch format: magic, target size and SHA-256, then "C" + (base offset,
+    # length) to copy from the base and "L" + length + data for new bytes.
+    # Adjacent copies are merged, so an untouched stretch of the base is one
+    # record. The header makes a patch self-describing: the catalog reads a
+    # patched file's size and digest from it when indexing an archive.
+
+    def __init__(self, fileobj):
+        self.fp = fileobj
+        self.fp.write(PATCH_MAGIC + struct.pack("<Q", 0) + bytes(32))
+        self.copy = None
+        self.literal = bytearray()
+        self.literal_bytes = 0
+
+    def add_copy(self, offset, length):
+        self._flush_literal()
+        if self.copy and self.copy[0] + self.copy[1] == offset:
+            self.copy[1] += length
+        else:
+            self._flush_copy()
+            self.copy = [offset, length]
+
+    def add_literal(self, data):
+        self._flush_copy()
+        self.literal += data
+        self.literal_bytes += len(data)
+        if len(self.literal) >= MAX_LITERAL_RUN:
+            self._flush_literal()
+
+    def _flush_copy(self):
+        if self.copy:
+            self.fp.write(b"C" + struct.pack("<QQ", *self.copy))
+            self.copy = None
+
+    def _flush_literal(self):
+        if self.literal:
+            self.fp.write(b"L" + struct.pack("<Q", len(self.literal)) + self.literal)
+            self.literal = bytearray()
+
+    def close(self, target_size, sha256):
+        # The size and digest are only known once the file has been read.
+        self._flush_copy()
+        self._flush_literal()
+        self.fp.seek(len(PATCH_MAGIC))
+        self.fp.write(struct.pack("<Q", target_size) + bytes.fromhex(sha256))
+        self.fp.seek(0, os.SEEK_END)
+
+
+class StreamReader:
+    # read(n) over an iterator of byte strings (a zip member being inflated).
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0
+
+    def read(self, n):
+        while len(self.buf) - self.pos < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def exact(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise Exception("Truncated delta patch")
+        return data
+
+
+def read_patch_header(read):
+    # (target size, target SHA-256) from the start of a patch, read with
+    # `read(n)`; the digest is None for a FVDELTA1 patch.
+    magic = read(len(PATCH_MAGIC))
+    if magic not in (PATCH_MAGIC, PATCH_MAGIC_V1):
+        raise Exception("Not a delta patch")
+    length = 8 if magic == PATCH_MAGIC_V1 else 40
+    header = read(length)
+    if len(header) != length:
+        raise Exception("Truncated delta patch")
+    target_size, = struct.unpack_from("<Q", header)
+    return target_size, header[8:].hex() or None
+
+
+def apply_patch(base_path, chunks, target, sha256=None):
+    # Rebuilds a file from its base version and the patch data in `chunks`,
+    # checking the result against `sha256` (by default the digest in the
+    # patch header).
+    reader = StreamReader(chunks)
+    target_size, recorded = read_patch_header(reader.read)
+    sha256 = sha256 or recorded
+    written = 0
+    digest = hashlib.sha256()
+    with open(base_path, "rb") as base, open(target, "wb") as out:
+        while True:
+            op = reader.read(1)
+            if not op:
+                break
+            if op == b"C":
+                offset, length = struct.unpack("<QQ", reader.exact(16))
+                base.seek(offset)
+                while length > 0:
+                    data = base.read(min(READ_BLOCK_SIZE, length))
+                    if not data:
+                        raise Exception("Delta base is shorter than the patch expects")
+                    digest.update(data)
+                    out.write(data)
+                    length -= len(data)
+                    written += len(data)
+            elif op == b"L":
+                length, = struct.unpack("<Q", reader.exact(8))
+                while length > 0:
+                    data = reader.exact(min(READ_BLOCK_SIZE, length))
+                    digest.update(data)
+                    out.write(data)
+                    length -= len(data)
+                    written += len(data)
+            else:
+                raise Exception("Corrupt delta patch")
+    if written != target_size:
+        raise Exception(f"Delta patch rebuilt {written} bytes instead of {target_size}")
+    if sha256 and digest.hexdigest() != sha256:
+        raise Exception("Delta patch rebuilt a file that does not match its recorded digest")
+
+
+# === Encoding ===
+class DeltaEncoder:
+    # Decides, per large file of an incremental run, between storing it
+    # whole and storing a patch against the version the previous run
+    # stored. Signatures of every large file stored are kept in
+    # <dest>/signatures (one per path, checked against the SHA-256 of the
+    # version they describe); a file whose version is already
+    # `rebase_after` patches away from a whole copy is stored whole again,
+    # so a restore never replays more than that many patches. With
+    # `drop_cache` the files read leave the page cache behind them.
+
+    def __init__(self, dest_base, min_bytes, block_size=64 * 1024, rebase_after=7, drop_cache=False):
+        self.dir = Path(dest_base) / SIGNATURES_DIR_NAME
+        self.min_bytes = min_bytes
+        self.block_size = block_size
+        self.rebase_after = rebase_after
+        self.drop_cache = drop_cache
+        self.workdir = None
+        self.encoded = 0
+        self.saved_bytes = 0
+
+    def wants(self, size):
+        return bool(self.min_bytes) and size >= self.min_bytes
+
+    def signature_path(self, arcname):
+        return self.dir / (hashlib.sha256(arcname.encode("utf-8")).hexdigest()[:32] + ".sig")
+
+    def load_signature(self, arcname):
+        try:
+            return Signature.from_bytes(self.signature_path(arcname).read_bytes())
+        except (OSError, ValueError):
+            return None
+
+    def save_signature(self, arcname, signature):
+        self.dir.mkdir(exist_ok=True)
+        path = self.signature_path(arcname)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(signature.to_bytes())
+        os.replace(tmp_path, path)
+
+    def forget(self, arcnames):
+        for arcname in arcnames:
+            self.signature_path(arcname).unlink(missing_ok=True)
+
+    def prepare(self, path, arcname, st, previous, record, throttle):
+        # Returns (source path, zip member name, stat, temporary) for the
+        # archiver: the file itself, or a patch file staged in the destination.
+        # Either way the file's signature is stored for the next run and
+        # record["sha256"] is set; a patch also sets record["delta_depth"].
+        base = None
+        if previous and previous.get("delta_depth", 0) < self.rebase_after:
+            base = self.load_signature(arcname)
+            if base and (base.sha256 != previous.get("sha256") or base.block_size != self.block_size):
+                base = None
+        if base is None:
+            signer = BlockSigner(self.block_size)
+            for data in read_blocks(path, bytearray(READ_BLOCK_SIZE), self.drop_cache, throttle):
+                signer.update(data)
+            signature = signer.finish()
+            self.save_signature(arcname, signature)
+            record["sha256"] = signature.sha256
+            return path, arcname, st, False
+
+        if self.workdir is None:
+            # Next to the archive rather than in /tmp: patches can be as large
+            # as the file, and the destination has room for the backup.
+            self.workdir = tempfile.mkdtemp(prefix="delta-staging-", dir=self.dir.parent)
+        patch_path = os.path.join(self.workdir, f"{self.encoded}.patch")
+        with open(patch_path, "wb") as out:
+            signature, literal_bytes = self._encode(path, base, out, throttle)
+        self.save_signature(arcname, signature)
+        record["sha256"] = signature.sha256
+        if literal_bytes > signature.size * MAX_LITERAL_RATIO:
+            os.unlink(patch_path)
+            return path, arcname, st, False
+        record["delta_depth"] = previous.get("delta_depth", 0) + 1
+        patch_size = os.path.getsize(patch_path)
+        self.encoded += 1
+        self.saved_bytes += max(0, signature.size - patch_size)
+        patch_st = SimpleNamespace(st_size=patch_size, st_mtime=st.st_mtime, st_mode=st.st_mode)
+        return patch_path, DELTA_PREFIX + arcname, patch_st, True
+
+    def _encode(self, path, base, out, throttle):
+        # rsync matching: at each position the Adler-32 of the next block is
+        # looked up among the base's blocks and confirmed with the strong
+        # hash. After a miss the window rolls byte by byte (Adler-32 rolls in
+        # O(1)) for up to one block, which finds data shifted by inserts or
+        # deletes; after ROLL_BLOCKS misses in a row only block-aligned
+        # positions are tried until something matches again.
+        bs = base.block_size
+        weak_index = {}
+        for i, (weak, strong) in enumerate(base.blocks):
+            if (i + 1) * bs <= base.size:
+                weak_index.setdefault(weak, {}).setdefault(strong, i)
+        patch = PatchWriter(out)
+        signer = BlockSigner(bs)
+        misses = 0
+        buf = b""
+        pos = 0
+        eof = False
+
+        def lookup(weak, start):
+            candidates = weak_index.get(weak)
+            if candidates:
+                return candidates.get(strong_hash(buf[start:start + bs]))
+            return None
+
+        with open(path, "rb") as f:
+            while True:
+                if not eof and len(buf) - pos < 2 * bs:
+                    data = f.read(max(READ_BLOCK_SIZE, 2 * bs))
+                    throttle.read(len(data))
+                    signer.update(data)
+                    buf = buf[pos:] + data
+                    pos = 0
+                    eof = not data
+                    continue
+                if len(buf) - pos < bs:
+                    break
+                weak = zlib.adler32(buf[pos:pos + bs])
+                index = lookup(weak, pos)
+                if index is not None:
+                    patch.add_copy(index * bs, bs)
+                    pos += bs
+                    misses = 0
+                    continue
+                if misses < ROLL_BLOCKS:
+                    a = weak & 0xFFFF
+                    b = weak >> 16
+                    limit = min(bs, len(buf) - pos - bs)
+                    for k in range(1, limit + 1):
+                        out_byte = buf[pos + k - 1]
+                        a = (a - out_byte + buf[pos + k - 1 + bs]) % ADLER_MOD
+                        b = (b - bs * out_byte + a - 1) % ADLER_MOD
+                        index = lookup((b << 16) | a, pos + k)
+                        if index is not None:
+                            patch.add_literal(buf[pos:pos + k])
+                            patch.add_copy(index * bs, bs)
+                            pos += k + bs
+                            misses = 0
+                            break
+                    if index is not None:
+                        continue
+                patch.add_literal(buf[pos:pos + bs])
+                pos += bs
+                misses += 1
+            if self.drop_cache:
+                drop_cache(f.fileno())
+        patch.add_literal(buf[pos:])
+        signature = signer.finish()
+        patch.close(signature.size, signature.sha256)
+        return signature, patch.literal_bytes
+
+    def close(self):
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
@@ -0,0 +1,288 @@
+import hashlib
+import hmac
+import io
+import json
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from filevault.manifest import write_json_atomic
+
+ENCRYPTION_FILE_NAME = "backup_encryption.json"
+PASSPHRASE_ENV = "FILEVAULT_PASSPHRASE"
+CIPHERS = {"aes-256-gcm": 1, "chacha20-poly1305": 2}
+CIPHER_NAMES = {number: name for name, number in CIPHERS.items()}
+
+# Every archive file starts with this header; its bytes are the associated
+# data of every segment, so no field of it can be altered unnoticed.
+MAGIC = b"FVAULTE1"
+HEADER = struct.Struct("<8sB3xI16s")
+SEGMENT_BYTES = 64 * 1024
+TAG_BYTES = 16
+# Segments sealed per task: enough work per worker to beat the pool overhead.
+SEGMENTS_PER_TASK = 16
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 15, 8, 1
+
+# Master keys of the destinations unlocked in this process, by resolved path.
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+# === Keys ===
+def hkdf(key, salt, info, length=32):
+    # HKDF-SHA256 (RFC 5869).
+    prk = hmac.new(salt, key, hashlib.sha256).digest()
+    out = b""
+    block = b""
+    counter = 1
+    while len(out) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        out += block
+        counter += 1
+    return out[:length]
+
+
+def _master_key(params, settings):
+    key_file = settings.get("key_file")
+    if key_file:
+        with open(key_file, "rb") as f:
+            secret = f.read()
+        if len(secret) < 32:
+            raise ValueError(f"Key file {key_file} is too short; use at least 32 random bytes.")
+        return "key file", hkdf(secret, bytes.fromhex(params["salt"]), b"filevault key file")
+    passphrase = os.environ.get(PASSPHRASE_ENV)
+    if passphrase:
+        return "scrypt", hashlib.scrypt(passphrase.encode("utf-8"), salt=bytes.fromhex(params["salt"]),
+                                        n=params.get("n", SCRYPT_N), r=params.get("r", SCRYPT_R),
+                                        p=params.get("p", SCRYPT_P), maxmem=256 * 1024 * 1024, dklen=32)
+    return None, None
+
+
+def _key_check(master):
+    return hmac.new(master, b"filevault key check", hashlib.sha256).hexdigest()[:32]
+
+
+def unlock_destination(dest_base, settings, create=False, require=False):
+    # The master key of a destination's encrypted archives, derived from the
+    # key_file setting or the FILEVAULT_PASSPHRASE environment variable with
+    # the salt kept in backup_encryption.json (created on the first
+    # encrypted backup when `create`). Registered for open_archive(); None
+    # when the destination has no encrypted archives, or no secret is given
+    # and not `require`d.
+    dest_base = Path(dest_base)
+    resolved = str(dest_base.resolve())
+    with _keys_lock:
+        if resolved in _keys:
+            return _keys[resolved]
+    path = dest_base / ENCRYPTION_FILE_NAME
+    if path.exists():
+        with open(path, "r") as f:
+            params = json.load(f)
+    elif create:
+        params = {"version": 1, "salt": os.urandom(16).hex(), "n": SCRYPT_N, "r": SCRYPT_R, "p": SCRYPT_P}
+    else:
+        return None
+
+    kdf, master = _master_key(params, settings)
+    if master is None:
+        if create or require:
+            raise Exception(f"Encryption needs a key_file setting or the {PASSPHRASE_ENV} environment variable.")
+        return None
+    if "check" in params:
+        if params["kdf"] != kdf or not hmac.compare_digest(params["check"], _key_check(master)):
+            raise Exception("Wrong passphrase or key file for the encrypted backups in this destination.")
+    else:
+        write_json_atomic(path, dict(params, kdf=kdf, check=_key_check(master)))
+    with _keys_lock:
+        _keys[resolved] = master
+    return master
+
+
+def make_aead(cipher, key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    except ImportError:
+        raise Exception("Encrypted archives need the optional \"cryptography\" package "
+                        "(pip install -r requirements-optional.txt).")
+    return AESGCM(key) if cipher == "aes-256-gcm" else ChaCha20Poly1305(key)
+
+
+def segment_nonce(index, last):
+    # STREAM construction: the counter stops segments being reordered, the
+    # last-segment flag stops the file being truncated at a segment boundary.
+    return struct.pack(">QI", index, 1 if last else 0)
+
+
+# === Writing ===
+class EncryptingWriter:
+    # Write-only file object that encrypts an archive stream in segments of
+    # SEGMENT_BYTES (each sealed with its own tag) under a key derived for
+    # this file alone from the master key and a random salt. Segments are
+    # sealed in batches on a thread pool while earlier batches are written
+    # out in order. The last segment is only sealed by close(), so the data
+    # written must end there.
+
+    def __init__(self, fileobj, master, cipher="aes-256-gcm", workers=None):
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unknown cipher {cipher!r}; use {', '.join(CIPHERS)}.")
+        salt = os.urandom(16)
+        self.header = HEADER.pack(MAGIC, CIPHERS[cipher], SEGMENT_BYTES, salt)
+        self.aead = make_aead(cipher, hkdf(master, salt, b"filevault archive"))
+        self.fp = fileobj
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.index = 0
+        self.fp.write(self.header)
+
+    def _seal(self, index, data, last=False):
+        out = []
+        for i in range(0, max(len(data), 1), SEGMENT_BYTES):
+            segment_last = last and i + SEGMENT_BYTES >= len(data)
+            out.append(self.aead.encrypt(segment_nonce(index, segment_last), data[i:i + SEGMENT_BYTES], self.header))
+            index += 1
+        return b"".join(out)
+
+    def _submit(self, count, last=False):
+        size = len(self.buffer) if last else count * SEGMENT_BYTES
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.pending.append(self.executor.submit(self._seal, self.index, data, last))
+        self.index += max(count, 1)
+        while len(self.pending) > self.workers * 2:
+            self.fp.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        # Full segments go out once more data follows them, so the final
+        # segment is never sealed as an inner one.
+        while len(self.buffer) > SEGMENTS_PER_TASK * SEGMENT_BYTES:
+            self._submit(SEGMENTS_PER_TASK)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        full = (len(self.buffer) - 1) // SEGMENT_BYTES if self.buffer else 0
+        if full:
+            self._submit(full)
+        self._submit(1, last=True)
+        try:
+            while self.pending:
+                self.fp.write(self.pending.popleft().result())
+            self.fp.flush()
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+# === Reading ===
+class DecryptingReader(io.RawIOBase):
+    # Seekable plaintext view of an encrypted archive file: a read only
+    # decrypts (and authenticates) the segments it touches, so a member is
+    # extracted without decrypting the rest of the archive.
+
+    def __init__(self, fp, master, name=""):
+        self.fp = fp
+        self.name = name
+        self.header = fp.read(HEADER.size)
+        magic, cipher, self.segment_bytes, salt = HEADER.unpack(self.header)
+        if cipher not in CIPHER_NAMES:
+            raise Exception(f"{name}: unknown cipher {cipher}")
+        self.aead = make_aead(CIPHER_NAMES[cipher], hkdf(master, salt, b"filevault archive"))
+        stored = fp.seek(0, io.SEEK_END) - HEADER.size
+        sealed = self.segment_bytes + TAG_BYTES
+        self.segments = max(1, -(-stored // sealed))
+        self.size = stored - self.segments * TAG_BYTES
+        if self.size < 0:
+            raise Exception(f"{name}: truncated encrypted archive")
+        self.position = 0
+        self.cached = (None, None)
+
+    def _segment(self, index):
+        if self.cached[0] == index:
+            return self.cached[1]
+        sealed = self.segment_bytes + TAG_BYTES
+        self.fp.seek(HEADER.size + index * sealed)
+        data = self.fp.read(sealed)
+        try:
+            plain = self.aead.decrypt(segment_nonce(index, index == self.segments - 1), data, self.header)
+        except Exception:
+            raise Exception(f"{self.name}: segment {index} failed authentication (corrupt, truncated or "
+                            f"encrypted with another key)")
+        self.cached = (index, plain)
+        return plain
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        done = 0
+        while done < len(buffer) and self.position < self.size:
+            index, skip = divmod(self.position, self.segment_bytes)
+            piece = self._segment(index)[skip:skip + len(buffer) - done]
+            if not piece:
+                break
+            buffer[done:done + len(piece)] = piece
+            done += len(piece)
+            self.position += len(piece)
+        return done
+
+    def close(self):
+        if not self.closed:
+            self.fp.close()
+        super().close()
+
+
+def open_archive(path):
+    # Opens an archive (volume) file for reading: the file itself, or its
+    # decrypted view when it is encrypted and its destination is unlocked.
+    path = Path(path)
+    fp = open(path, "rb")
+    if fp.read(len(MAGIC)) != MAGIC:
+        fp.seek(0)
+        return fp
+    fp.seek(0)
+    with _keys_lock:
+        master = _keys.get(str(path.parent.resolve()))
+    if master is None:
+        fp.close()
+        raise Exception(f"{path.name} is encrypted; set key_file or {PASSPHRASE_ENV} to read it.")
+    try:
+        return io.BufferedReader(DecryptingReader(fp, master, path.name), SEGMENT_BYTES)
+    except Exception:
+        fp.close()
+        raise
+
+
+def validate_encryption(settings):
+    cipher = settings.get("encryption")
+    if not cipher:
+        return
+    if cipher not in CIPHERS:
+        raise ValueError(f"Unknown encryption {cipher!r}; use {', '.join(CIPHERS)}.")
+    if settings.get("storage") == "Chunk Store":
+        raise ValueError("Encryption is only available for zip archives, not the chunk store.")
@@ -0,0 +1,773 @@
+import json
+import os
+import stat
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from filevault.catalog import Catalog, extract_members
+from filevault.checkpoint import ZipCheckpoint
+from filevault.chunkstore import ChunkStore
+from filevault.compression import CodecPolicy, ParallelArchiver
+from filevault.delta import DELTA_PREFIX, DeltaEncoder
+from filevault.encryption import EncryptingWriter, unlock_destination, validate_encryption
+from filevault.manifest import BackupManifest, file_sha256, stat_record
+from filevault.memory import peak_rss, reset_peak_rss, validate_memory
+from filevault.retention import destination_lock, free_space, plan_retention, prune_lock
+from filevault.rules import IGNORE_FILE_NAME, SourceRules, validate_rules
+from filevault.runlog import RunLog, now_iso
+from filevault.scanner import TreeScanner, carry_forward
+from filevault.sinks import open_archive_sink
+from filevault.snapshot import Snapshot, validate_snapshot
+from filevault.throttle import Throttle, validate_throttle
+from filevault.verify import verify_destination
+from filevault.volumes import VolumeWriter, archive_name, remove_partials, volume_files, volume_name
+
+# === Settings ===
+SETTINGS_FILE = Path("backup_settings.json")
+
+DEFAULT_SETTINGS = {
+    "source_dir": "",
+    "dest_dir": "",
+    "max_backups": 5,
+    "schedule": "None",
+    "incremental": False,
+    "full_every": 10,
+    "storage": "Zip Archives",
+    "codec": "deflate",
+    "codec_level": 6,
+    "workers": None,
+    "stream_target": None,
+    "watch": False,
+    "cron": None,
+    "jobs": [],
+    "max_parallel_jobs": 2,
+    "max_total_workers": None,
+    "max_jobs_per_device": 1,
+    "max_total_read_bytes_per_s": None,
+    "max_total_write_bytes_per_s": None,
+    "retention": None,
+    "min_free_bytes": None,
+    "max_total_bytes": None,
+    "throttle": None,
+    "checkpoint_files": 1000,
+    "checkpoint_bytes": 256 * 1024 * 1024,
+    "scrub_bytes": 256 * 1024 * 1024,
+    "exclude": [],
+    "include": [],
+    "min_file_size": None,
+    "max_file_size": None,
+    "max_age_days": None,
+    "volume_bytes": None,
+    "delta_min_bytes": None,
+    "delta_block_bytes": 64 * 1024,
+    "delta_rebase_after": 7,
+    "snapshot": None,
+    "snapshot_dir": None,
+    "snapshot_path": None,
+    "snapshot_freeze_command": None,
+    "snapshot_thaw_command": None,
+    "snapshot_release_command": None,
+    "encryption": None,
+    "key_file": None,
+    "memory_limit_bytes": None,
+    "drop_page_cache": True
+}
+
+SCHEDULE_INTERVALS = {
+    "1 minute": ("minutes", 1),
+    "5 minutes": ("minutes", 5),
+    "15 minutes": ("minutes", 15),
+    "30 minutes": ("minutes", 30),
+    "1 hour": ("hours", 1),
+    "3 hours": ("hours", 3),
+    "6 hours": ("hours", 6),
+    "12 hours": ("hours", 12),
+    "1 day": ("hours", 24)
+}
+
+
+def load_settings(path=SETTINGS_FILE):
+    settings = dict(DEFAULT_SETTINGS)
+    path = Path(path)
+    if path.exists():
+        with open(path, "r") as f:
+            settings.update(json.load(f))
+    return settings
+
+
+def save_settings(settings, path=SETTINGS_FILE):
+    with open(path, "w") as f:
+        json.dump(settings, f, indent=4)
+
+
+# === Archiving ===
+def archive_entry(archiver, arcname, path, st, inode, previous, files, changed):
+    archiver.throttle.file()
+    record = stat_record(st, inode)
+    files[arcname] = record
+    unchanged = previous and all(previous.get(k) == record[k] for k in ("size", "mtime_ns", "inode"))
+    if not unchanged and previous and previous["size"] == record["size"]:
+        # Same size, new mtime: hash it before deciding to archive it again.
+        unchanged = file_sha256(path, archiver.drop_cache, archiver.throttle) == previous["sha256"]
+    if unchanged:
+        record["sha256"] = previous["sha256"]
+        if "delta_depth" in previous:
+            record["delta_depth"] = previous["delta_depth"]
+        return
+    if archiver.delta and archiver.delta.wants(record["size"]):
+        # Large file: stored as a patch against its previous version when
+        # that pays off (see filevault.delta).
+        source, member, st, temporary = archiver.delta.prepare(path, arcname, st, previous, record, archiver.throttle)
+        archiver.add_file(source, member, st, temporary, record["size"])
+    else:
+        archiver.add_file(path, arcname, st)
+    changed.append(arcname)
+
+
+def archive_tree(archiver, src, manifest, full, progress=None, resumed=None, checkpoint=None, rules=None,
+                 inodes=None, errors=None, unreadable=()):
+    # Returns (files, changed, deleted): the new manifest file table, the paths
+    # written to this archive and the paths that disappeared since the last run.
+    # `resumed` holds the records of files already in a resumed archive; they
+    # are kept as checkpointed, so a later change is picked up by the next run.
+    # `checkpoint(files)` is called after every entry written. Files the
+    # `rules` exclude are left out, so a newly excluded file counts as deleted.
+    # `inodes` maps paths to their inode in the source when `src` is a
+    # snapshot of it (see filevault.snapshot). Files and directories that
+    # cannot be read are reported in `errors`; an incremental run keeps their
+    # previous records, as it does for the `unreadable` paths the snapshot
+    # could not read, while a full run leaves them out.
+    errors = [] if errors is None else errors
+    unreadable = list(unreadable)
+    files = dict(resumed or {})
+    changed = list(files)
+
+    def record_digest(arcname, sha256):
+        # A patch's digest is not the file's; delta.prepare() set that one.
+        if not arcname.startswith(DELTA_PREFIX):
+            files[arcname]["sha256"] = sha256
+        if checkpoint:
+            checkpoint(files)
+
+    archiver.on_written = record_digest
+    scanner = TreeScanner(src, rules)
+    previous_total = len(manifest.files)
+    bytes_seen = 0
+    for i, (arcname, entry) in enumerate(scanner, start=1):
+        if arcname in files:
+            continue
+        previous = None if full else manifest.files.get(arcname)
+        try:
+            st = entry.stat()
+            inode = inodes.get(arcname, entry.inode()) if inodes is not None else entry.inode()
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            errors.append(f"{entry.path}: {e}")
+            unreadable.append(arcname)
+            continue
+        archive_entry(archiver, arcname, entry.path, st, inode, previous, files, changed)
+        bytes_seen += st.st_size
+        if progress and i % 10 == 0:
+            progress(i, scanner.estimate_total(previous_total), arcname, bytes_seen)
+
+    if not files and (full or not manifest.files):
+        raise Exception("No files to back up.")
+    if progress:
+        progress(len(files), len(files) or 1, None, bytes_seen)
+
+    archiver.finish()
+    errors.extend(scanner.errors)
+    if not full:
+        carry_forward(files, manifest.files, unreadable + scanner.unreadable)
+    deleted = [] if full else sorted(set(manifest.files) - set(files))
+    return files, changed, deleted
+
+
+def collapse_dirty_paths(dirty):
+    # Drops paths already covered by a dirty ancestor directory.
+    dirty = set(dirty)
+    collapsed = []
+    for rel in sorted(dirty):
+        parts = rel.split("/")
+        if not any("/".join(parts[:i]) in dirty for i in range(1, len(parts))):
+            collapsed.append(rel)
+    return collapsed
+
+
+def dirty_roots(dirty):
+    # The journal's dirty paths as the files and subtrees to look at again:
+    # an edited .backupignore makes its whole directory dirty.
+    return collapse_dirty_paths(rel[:-len(IGNORE_FILE_NAME) - 1] if rel.endswith("/" + IGNORE_FILE_NAME) else rel
+                                for rel in dirty)
+
+
+def archive_paths(archiver, src, manifest, dirty, progress=None, checkpoint=None, rules=None, inodes=None,
+                  errors=None, unreadable=()):
+    # Journal-driven variant of archive_tree: only the dirty paths (a file, or
+    # a directory meaning "rescan this subtree") are looked at, never the tree.
+    # Paths that cannot be read keep their previous records.
+    errors = [] if errors is None else errors
+    unreadable = list(unreadable)
+    files = dict(manifest.files)
+    changed = []
+
+    def record_digest(arcname, sha256):
+        # A patch's digest is not the file's; delta.prepare() set that one.
+        if not arcname.startswith(DELTA_PREFIX):
+            files[arcname]["sha256"] = sha256
+        if checkpoint:
+            checkpoint(files)
+
+    def forget(prefix):
+        for arcname in [k for k in files if k.startswith(prefix)]:
+            del files[arcname]
+
+    archiver.on_written = record_digest
+    dirty = dirty_roots(dirty)
+    bytes_seen = 0
+    for i, rel in enumerate(dirty, start=1):
+        path = os.path.join(src, *rel.split("/"))
+        try:
+            st = os.stat(path)
+            is_link = os.path.islink(path)
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                errors.append(f"{path}: {e}")
+                unreadable.append(rel)
+            st = None
+            is_link = False
+
+        if st is not None and stat.S_ISDIR(st.st_mode) and not is_link:
+            seen = set()
+            scanner = TreeScanner(path, rules, rel)
+            for sub, entry in scanner:
+                arcname = f"{rel}/{sub}"
+                try:
+                    sub_st = entry.stat()
+                    inode = inodes.get(arcname, entry.inode()) if inodes is not None else entry.inode()
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    errors.append(f"{entry.path}: {e}")
+                    unreadable.append(arcname)
+                    continue
+                seen.add(arcname)
+                archive_entry(archiver, arcname, entry.path, sub_st, inode, manifest.files.get(arcname), files, changed)
+                bytes_seen += sub_st.st_size
+            errors.extend(scanner.errors)
+            unreadable.extend(scanner.unreadable)
+            for arcname in [k for k in files if k.startswith(rel + "/") and k not in seen]:
+                del files[arcname]
+            files.pop(rel, None)
+        elif st is not None and stat.S_ISREG(st.st_mode) and not (rules and rules.excludes_path(rel, False, st)):
+            forget(rel + "/")
+            inode = inodes.get(rel, st.st_ino) if inodes is not None else st.st_ino
+            archive_entry(archiver, rel, path, st, inode, manifest.files.get(rel), files, changed)
+            bytes_seen += st.st_size
+        else:
+            files.pop(rel, None)
+            forget(rel + "/")
+
+        if progress:
+            progress(i, len(dirty), rel, bytes_seen)
+
+    archiver.finish()
+    carry_forward(files, manifest.files, unreadable)
+    deleted = sorted(set(manifest.files) - set(files))
+    return files, changed, deleted
+
+
+# === Engine ===
+class BackupEngine:
+    # Runs, lists, restores and prunes backups for one settings dict. Has no
+    # UI dependencies: progress is reported through the optional callback,
+    # called as progress(done, total, path, bytes_done) from the backup
+    # thread (see filevault.progress.ProgressMeter), and results/errors are
+    # returned or raised to the caller. `bandwidth` is the SharedBandwidth of
+    # the scheduler running the job, if any.
+
+    def __init__(self, settings, progress=None, bandwidth=None):
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.src = Path(self.settings["source_dir"])
+        self.dest_base = Path(self.settings["dest_dir"])
+        self.progress = progress
+        self.bandwidth = bandwidth
+        self.prune_thread = None
+        self.run_log = RunLog(self.dest_base)
+        self.warnings = []
+        self.throttle = Throttle()
+
+    def run(self, journal=None):
+        # Returns a result dict; status is "success" or "no_changes".
+        # `journal` (a filevault.watch.ChangeJournal) is consumed by every
+        # run that does not fail, whatever its storage or kind, so it never
+        # grows between runs; only incremental zip runs read its dirty paths,
+        # the others walk the whole tree.
+        if not self.settings["source_dir"] or not self.settings["dest_dir"]:
+            raise Exception("Invalid folder paths.")
+        if not self.src.exists() or not self.dest_base.exists():
+            raise Exception("Invalid folder paths.")
+        validate_throttle(self.settings["throttle"])
+        validate_rules(self.settings)
+        validate_snapshot(self.settings)
+        validate_encryption(self.settings)
+        validate_memory(self.settings)
+        stream_target = self.settings["stream_target"]
+        if self.settings["volume_bytes"] and stream_target and not stream_target.startswith("cmd:"):
+            raise ValueError("Volumes need the destination folder or a cmd: stream target (one command per volume).")
+
+        if self.settings["encryption"]:
+            unlock_destination(self.dest_base, self.settings, create=True)
+        timestampfile = self._unique_timestamp()
+        # Priorities are lowered on the calling thread, so the scheduler's job
+        # threads (and the CLI process) slow down, not the GUI thread.
+        self.throttle = Throttle(self.settings["throttle"], self.bandwidth)
+        self.throttle.start_run()
+        record = {"type": "run", "time": now_iso(), "storage": self.settings["storage"], "source": str(self.src)}
+        self.warnings = []
+        self._add_warnings(self.throttle.warnings)
+        reset_peak_rss()
+        started = time.perf_counter()
+        dirty = None
+        if journal:
+            dirty, rescan = journal.begin()
+            if rescan or not self.settings["incremental"]:
+                dirty = None
+        try:
+            if self.settings["storage"] == "Chunk Store":
+                result = self._run_chunk_store(timestampfile)
+            else:
+                result = self._write_zip(timestampfile, dirty)
+        except Exception as e:
+            if journal:
+                journal.rollback()
+            self.run_log.append(dict(record, status="failed", error=str(e), errors=1 + len(self.warnings),
+                                     duration=round(time.perf_counter() - started, 3)))
+            raise
+        if journal:
+            journal.commit()
+
+        duration = time.perf_counter() - started
+        metrics = result["metrics"]
+        if self.throttle.enabled:
+            metrics["throttled_seconds"] = round(self.throttle.waited, 3)
+        rss = peak_rss()
+        if rss is not None:
+            metrics["peak_rss_bytes"] = rss
+        bytes_read = metrics.get("bytes_read", 0)
+        self.run_log.append(dict(
+            record, status=result["status"], name=result["name"], errors=len(self.warnings),
+            duration=round(duration, 3),
+            compression_ratio=round(metrics["bytes_written"] / bytes_read, 4) if bytes_read else None,
+            throughput_mb_s=round(bytes_read / duration / 1e6, 3) if duration > 0 else None,
+            **metrics))
+        if result["status"] == "success":
+            self.prune_in_background()
+        return result
+
+    def _unique_timestamp(self):
+        # Backup names have one-second resolution; a queued job can start in
+        # the same second its previous run finished, so wait for a free name.
+        # The catalog knows streamed archives without reading the manifest.
+        store = ChunkStore(self.dest_base)
+        with self.open_catalog() as catalog:
+            while True:
+                timestampfile = datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
+                name = f"backup_{timestampfile}"
+                if (not (self.dest_base / f"{name}.zip").exists() and not catalog.has_version(f"{name}.zip", name)
+                        and not (store.versions_dir / f"{name}.json").exists()):
+                    return timestampfile
+                time.sleep(1 - datetime.now().microsecond / 1e6)
+
+    def _resumable_checkpoint(self, checkpoint, manifest):
+        # The state of an interrupted run to continue, or None. A checkpoint
+        # only applies to the same source, on top of the same newest archive,
+        # with its partial files still holding everything it points to.
+        state = checkpoint.load()
+        if state is None:
+            checkpoint.discard()
+            return None
+
+        def holds(file_name, size):
+            partial = self.dest_base / f"{file_name}.partial"
+            return partial.exists() and partial.stat().st_size >= size
+
+        newest = manifest.archives[-1]["name"] if manifest.archives else None
+        usable = (not self.settings["stream_target"] and not self.settings["encryption"]
+                  and state["source"] == str(self.src)
+                  and state["after"] == newest and state["offset"] > 0
+                  and holds(volume_name(state["name"], state["volume"]), state["volume_offset"])
+                  and all(holds(volume["name"], volume["bytes"]) for volume in state["volumes"]))
+        if not usable:
+            remove_partials(self.dest_base, state["name"])
+            checkpoint.discard()
+            return None
+        return state
+
+    def _write_zip(self, timestampfile, dirty):
+        src = self.src
+        dest_base = self.dest_base
+        stream_target = self.settings["stream_target"]
+        scan_started = time.perf_counter()
+        manifest = BackupManifest(dest_base).load()
+        checkpoint = ZipCheckpoint(dest_base, self.settings["checkpoint_files"], self.settings["checkpoint_bytes"])
+        resume = self._resumable_checkpoint(checkpoint, manifest)
+        if resume:
+            timestampfile = resume["timestamp"]
+            full = resume["kind"] == "full"
+            dirty = None
+        else:
+            full = not self.settings["incremental"] or manifest.needs_full_backup(src, self.settings["full_every"])
+            if dirty is not None and IGNORE_FILE_NAME in dirty:
+                # The top-level .backupignore changed: every path may be affected.
+                dirty = None
+        zip_name = f"backup_{timestampfile}.zip"
+        kind = "full" if full else "incremental"
+
+        delta = DeltaEncoder(dest_base, self.settings["delta_min_bytes"], self.settings["delta_block_bytes"],
+                             self.settings["delta_rebase_after"], self.settings["drop_page_cache"])
+        snapshot = Snapshot(src, dest_base, self.settings) if self.settings["snapshot"] else None
+        cipher = self.settings["encryption"]
+        encrypt = None
+        if cipher:
+            master = unlock_destination(dest_base, self.settings)
+            encrypt = lambda fileobj: EncryptingWriter(fileobj, master, cipher, self.settings["workers"])
+        drop = self.settings["drop_page_cache"]
+        writer = VolumeWriter(lambda file_name, offset: open_archive_sink(dest_base, file_name, stream_target, offset,
+                                                                          drop),
+                              zip_name, self.settings["volume_bytes"], self.throttle, resume, encrypt)
+        try:
+            def save_checkpoint(files):
+                if checkpoint.due(writer):
+                    checkpoint.save(writer, files)
+
+            # An encrypted archive cannot be cut back to a checkpoint offset:
+            # its last segment is only sealed when the volume is closed.
+            checkpointing = not stream_target and not cipher and (self.settings["checkpoint_files"]
+                                                                  or self.settings["checkpoint_bytes"])
+            if checkpointing:
+                newest = manifest.archives[-1]["name"] if manifest.archives else None
+                checkpoint.start({"name": zip_name, "timestamp": timestampfile, "kind": kind, "source": str(src),
+                                  "after": newest}, resume)
+
+            policy = CodecPolicy(self.settings["codec"], self.settings["codec_level"])
+            archiver = ParallelArchiver(writer, self.settings["workers"], policy, self.throttle, delta,
+                                        self.settings["memory_limit_bytes"], drop)
+            rules = SourceRules(src, self.settings)
+            incremental_paths = dirty is not None and not full
+            scan_errors = []
+            try:
+                root, inodes, unreadable = src, None, ()
+                if snapshot:
+                    snapshot.freeze(rules, dirty_roots(dirty) if incremental_paths else None)
+                    root, rules, inodes = snapshot.root, snapshot.rules, snapshot.inodes
+                    unreadable = snapshot.unreadable
+                if incremental_paths:
+                    files, changed, deleted = archive_paths(archiver, root, manifest, dirty, self.progress,
+                                                            save_checkpoint if checkpointing else None, rules,
+                                                            inodes, scan_errors, unreadable)
+                else:
+                    files, changed, deleted = archive_tree(archiver, root, manifest, full, self.progress,
+                                                           resume["files"] if resume else None,
+                                                           save_checkpoint if checkpointing else None, rules,
+                                                           inodes, scan_errors, unreadable)
+            finally:
+                archiver.close()
+                delta.close()
+                self._release_snapshot(snapshot)
+                self._add_warnings(scan_errors)
+            writer.close()
+        except Exception:
+            writer.abort()
+            remove_partials(dest_base, zip_name)
+            checkpoint.discard()
+            raise
+
+        timings = archiver.timings
+        walked = time.perf_counter() - scan_started - (snapshot.seconds if snapshot else 0)
+        commit_started = time.perf_counter()
+        metrics = {
+            "kind": kind,
+            "files_scanned": len(files),
+            "files_changed": len(changed),
+            "files_deleted": len(deleted),
+            "bytes_read": archiver.bytes_read,
+            "bytes_written": writer.offset,
+            # scan is the walk itself; compress is summed over the workers and
+            # overlaps the walk, wait is the writer stalled on compression.
+            "phases": {
+                "scan": round(walked - timings["queue"] - timings["finish"], 3),
+                "compress": round(timings["compress"], 3),
+                "wait": round(timings["wait"], 3),
+                "write": round(timings["write"], 3),
+                "finish": round(timings["finish"], 3)
+            },
+            "codecs": archiver.stats,
+            "peak_buffered_bytes": archiver.peak_inflight_bytes
+        }
+        if resume:
+            metrics["resumed_files"] = len(resume["files"])
+        if len(writer.volumes) > 1:
+            metrics["volumes"] = len(writer.volumes)
+        if delta.encoded:
+            metrics["delta_files"] = delta.encoded
+            metrics["delta_saved_bytes"] = delta.saved_bytes
+        if snapshot:
+            self._snapshot_metrics(snapshot, metrics)
+
+        if not full and not changed and not deleted:
+            writer.abort()
+            remove_partials(dest_base, zip_name)
+            checkpoint.discard()
+            with destination_lock(dest_base):
+                # Re-read the archive list: a background prune may have run.
+                manifest.archives = BackupManifest(dest_base).load().archives
+                manifest.source = str(src)
+                manifest.files = files
+                manifest.save()
+            metrics["bytes_written"] = 0
+            metrics["phases"]["commit"] = round(time.perf_counter() - commit_started, 3)
+            return {"status": "no_changes", "name": None, "metrics": metrics}
+
+        writer.commit()
+        # Volumes a resumed run never got back to.
+        remove_partials(dest_base, zip_name)
+        location = writer.sinks[0].location
+        volumes = writer.volumes if len(writer.volumes) > 1 else None
+        with destination_lock(dest_base):
+            manifest.archives = BackupManifest(dest_base).load().archives
+            manifest.source = str(src)
+            manifest.files = files
+            manifest.add_archive(zip_name, kind, timestampfile, len(changed), deleted, archiver.stats,
+                                 location if stream_target else None, writer.volumes[0]["sha256"], volumes)
+            manifest.save()
+        checkpoint.discard()
+        delta.forget(deleted)
+        archive_bytes = 0 if stream_target else writer.offset
+        self._update_catalog(lambda catalog: catalog.add_zip_archive(manifest.archives[-1], writer.entries, files,
+                                                                     archive_bytes), manifest)
+
+        metrics["phases"]["commit"] = round(time.perf_counter() - commit_started, 3)
+        return {"status": "success", "name": zip_name, "kind": kind, "changed": len(changed),
+                "deleted": len(deleted), "location": location, "metrics": metrics}
+
+    def _run_chunk_store(self, timestampfile):
+        store = ChunkStore(self.dest_base, self.throttle, self.settings["drop_page_cache"], self.settings["workers"])
+        started = time.perf_counter()
+        rules = SourceRules(self.src, self.settings)
+        snapshot = Snapshot(self.src, self.dest_base, self.settings) if self.settings["snapshot"] else None
+        scan_errors = []
+        try:
+            root, inodes, unreadable = None, None, ()
+            if snapshot:
+                snapshot.freeze(rules)
+                root, rules, inodes = snapshot.root, snapshot.rules, snapshot.inodes
+                unreadable = snapshot.unreadable
+            # Held for the whole run: chunk garbage collection must not see chunks
+            # this backup has written but not yet referenced from a version.
+            with destination_lock(self.dest_base):
+                stats = store.backup(self.src, f"backup_{timestampfile}", self.progress, rules, root, inodes,
+                                     scan_errors, unreadable)
+        finally:
+            self._release_snapshot(snapshot)
+            self._add_warnings(scan_errors)
+
+        walked = time.perf_counter() - started - (snapshot.seconds if snapshot else 0)
+
+        if stats is None:
+            metrics = {"kind": "chunk store", "bytes_written": 0, "phases": {"scan": round(walked, 3)}}
+            if snapshot:
+                self._snapshot_metrics(snapshot, metrics)
+            return {"status": "no_changes", "name": None, "metrics": metrics}
+
+        commit_started = time.perf_counter()
+        self._update_catalog(lambda catalog: catalog.add_chunk_version(
+            stats["name"], store.load_version(stats["name"])["files"], stats["new_bytes"]))
+        metrics = {
+            "kind": "chunk store",
+            "files_scanned": stats["files"],
+            "files_changed": stats["changed"],
+            "files_deleted": stats["deleted"],
+            "bytes_read": stats["bytes_read"],
+            "bytes_written": stats["new_bytes"],
+            "phases": {
+                # chunk is summed over the workers and overlaps the walk; wait
+                # is the walk stalled on them.
+                "scan": round(walked - stats["wait_seconds"], 3),
+                "chunk": round(stats["chunk_seconds"], 3),
+                "wait": round(stats["wait_seconds"], 3),
+                "commit": round(time.perf_counter() - commit_started, 3)
+            }
+        }
+        if snapshot:
+            self._snapshot_metrics(snapshot, metrics)
+        return {"status": "success", "name": stats["name"], "kind": "chunk store", "changed": stats["changed"],
+                "deleted": stats["deleted"], "location": str(store.root), "metrics": metrics}
+
+    def _release_snapshot(self, snapshot):
+        # Drops the frozen view once every file is read; a failed release is
+        # only worth a warning, the backup itself is complete.
+        if not snapshot:
+            return
+        snapshot.release()
+        self._add_warnings(snapshot.warnings)
+        snapshot.warnings = []
+
+    def _add_warnings(self, messages):
+        for message in messages:
+            self.warnings.append(message)
+            self.run_log.warn(message)
+
+    def _snapshot_metrics(self, snapshot, metrics):
+        # The snapshot phase is how long the source had to hold still.
+        metrics["phases"]["snapshot"] = round(snapshot.seconds, 3)
+        metrics["snapshot"] = {"method": snapshot.method, "files": snapshot.files}
+        if snapshot.live:
+            metrics["snapshot"]["live_files"] = snapshot.live
+
+    def _update_catalog(self, update, manifest=None):
+        # The catalog is derived from the manifest and the chunk store, so a
+        # failure here never fails the backup; the next sync() catches up.
+        # Syncing right away records the files just rewritten as indexed, so
+        # the next open_catalog() need not read them (`manifest` is the one
+        # just saved, if at hand).
+        try:
+            with Catalog(self.dest_base) as catalog:
+                update(catalog)
+                catalog.sync(manifest)
+        except Exception as e:
+            self.warnings.append(f"Catalog update failed: {e}")
+            self.run_log.warn(f"Catalog update failed: {e}")
+
+    def prune_in_background(self):
+        # Retention, then a scrub slice, run after the backup has returned, so
+        # slow deletes and reads on a network destination never delay the
+        # next job. The thread is not a daemon: a CLI run still finishes its
+        # prune before the process exits.
+        self.prune_thread = threading.Thread(target=self._background_prune)
+        self.prune_thread.start()
+
+    def _background_prune(self):
+        try:
+            self.enforce_rotation()
+        except Exception as e:
+            self.run_log.warn(f"Prune failed: {e}")
+        if self.settings["scrub_bytes"]:
+            try:
+                self.verify(budget_bytes=self.settings["scrub_bytes"], trigger="scrub")
+            except Exception as e:
+                self.run_log.warn(f"Scrub failed: {e}")
+
+    def verify(self, names=None, deep=False, budget_bytes=None, trigger="manual"):
+        # Checks the named versions, the next scrub slice of `budget_bytes`
+        # (least recently verified first) or everything against the digests
+        # recorded at backup time; see filevault.verify. Holds the prune lock
+        # so nothing is deleted mid-check.
+        # Without the key every encrypted archive would count as corrupt.
+        unlock_destination(self.dest_base, self.settings, require=True)
+        throttle = Throttle(self.settings["throttle"], self.bandwidth)
+        with prune_lock(self.dest_base):
+            return verify_destination(self.dest_base, self.run_log, names, deep, budget_bytes,
+                                      self.settings["workers"], throttle, trigger)
+
+    def enforce_rotation(self):
+        # Applies max_backups, the GFS "retention" rules and the space limits
+        # using the catalog's version index. Returns the names deleted; returns
+        # nothing if another prune of this destination is already running.
+        dest_base = self.dest_base
+        lock = prune_lock(dest_base)
+        if not lock.acquire(blocking=False):
+            return []
+        try:
+            started = time.perf_counter()
+            with self.open_catalog() as catalog:
+                doomed = plan_retention(catalog.versions(), self.settings, free_space(dest_base))
+            if not doomed:
+                return []
+
+            removed = []
+            failed = []
+            for version in doomed:
+                if version["kind"] == "chunk store":
+                    continue
+                try:
+                    for file_name in volume_files(version):
+                        (dest_base / file_name).unlink(missing_ok=True)
+                    removed.append(version["name"])
+                except Exception as e:
+                    failed.append({"name": version["name"], "error": str(e)})
+            if removed:
+                with destination_lock(dest_base):
+                    manifest = BackupManifest(dest_base).load()
+                    for name in removed:
+                        manifest.remove_archive(name)
+                    manifest.save()
+
+            chunk_versions = [version["name"] for version in doomed if version["kind"] == "chunk store"]
+            if chunk_versions:
+                with destination_lock(dest_base):
+                    ChunkStore(dest_base).remove_versions(chunk_versions)
+                removed.extend(chunk_versions)
+
+            self._update_catalog(lambda catalog: [catalog.remove_version(name) for name in removed])
+            self.run_log.append({
+                "type": "prune", "removed": removed, "failed": failed,
+                "freed_bytes": sum(version["bytes"] for version in doomed if version["name"] in removed),
+                "errors": len(failed), "duration": round(time.perf_counter() - started, 3)
+            })
+            return removed
+        finally:
+            lock.release()
+
+    def open_catalog(self):
+        # Indexing an archive the catalog has not seen reads it: unlock an
+        # encrypted destination first.
+        unlock_destination(self.dest_base, self.settings)
+        catalog = Catalog(self.dest_base)
+        catalog.sync()
+        return catalog
+
+    def list_backups(self):
+        # Every restorable version in the destination, oldest first.
+        backups = []
+        with self.open_catalog() as catalog:
+            for record in catalog.versions():
+                if record["kind"] == "chunk store":
+                    location = str(ChunkStore(self.dest_base).versions_dir / f"{record['name']}.json")
+                else:
+                    location = record["location"] or str(self.dest_base / record["name"])
+                backups.append({"name": record["name"], "kind": record["kind"],
+                                "timestamp": datetime.fromtimestamp(record["created"]).strftime("%m-%d-%Y_%H-%M-%S"),
+                                "location": location})
+        return backups
+
+    def history(self, path):
+        with self.open_catalog() as catalog:
+            return catalog.history(path)
+
+    def tree(self, name=None, as_of=None, paths=None):
+        with self.open_catalog() as catalog:
+            return catalog.tree(catalog.find_version(name, as_of), paths)
+
+    def restore(self, name, target_dir, progress=None, paths=None, as_of=None):
+        # Restores a version (by name, the newest at or before `as_of`, or the
+        # newest overall), optionally only the given files/directories.
+        rows = self.tree(name, as_of, paths)
+        if paths and not rows:
+            raise Exception("None of the requested paths exist in that backup.")
+        return extract_members(self.dest_base, list(rows.values()), target_dir, self.settings["workers"], progress)
+
+
+def restore_path(path, target_dir, progress=None):
+    # Restores from a file picked in a dialog: a backup zip or a chunk store
+    # version index (<dest>/chunkstore/versions/<name>.json); any volume of a
+    # split archive stands for the whole archive.
+    path = Path(path)
+    if path.suffix == ".json":
+        dest_base = path.parent.parent.parent
+    else:
+        dest_base = path.parent
+    return BackupEngine({"dest_dir": str(dest_base)}).restore(archive_name(path.name), target_dir, progress)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from filevault.memory import read_blocks
+
+MANIFEST_FILE_NAME = "backup_manifest.json"
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class BackupManifest:
+    # Records the state of every source file as of the newest archive, plus the
+    # chain of archives (full + incrementals) needed to rebuild any version.
+
+    def __init__(self, dest_base):
+        self.path = Path(dest_base) / MANIFEST_FILE_NAME
+        self.source = None
+        self.files = {}
+        self.archives = []
+
+    def load(self):
+        if not self.path.exists():
+            return self
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        self.source = data.get("source")
+        self.files = data.get("files", {})
+        self.archives = data.get("archives", [])
+        return self
+
+    def save(self):
+        write_json_atomic(self.path, {
+            "version": 1,
+            "source": self.source,
+            "files": self.files,
+            "archives": self.archives
+        })
+
+    def needs_full_backup(self, src, full_every):
+        if self.source != str(src) or not self.archives:
+            return True
+        if full_every:
+            since_full = 0
+            for record in reversed(self.archives):
+                if record["kind"] == "full":
+                    break
+                since_full += 1
+            return since_full + 1 >= full_every
+        return False
+
+    def add_archive(self, name, kind, timestamp, changed, deleted, codecs=None, location=None, sha256=None,
+                    volumes=None):
+        # `sha256` is the digest of the (first volume) file; an archive split
+        # into volumes lists each one's name, bytes, digest and file count.
+        base = name if kind == "full" else self.archives[-1]["base"]
+        record = {
+            "name": name,
+            "kind": kind,
+            "base": base,
+            "timestamp": timestamp,
+            "changed": changed,
+            "deleted": deleted,
+            "codecs": codecs or {},
+            "location": location,
+            "sha256": sha256
+        }
+        if volumes:
+            record["volumes"] = volumes
+        self.archives.append(record)
+
+    def remove_archive(self, name):
+        self.archives = [record for record in self.archives if record["name"] != name]
+
+
+def write_json_atomic(path, data):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def stat_record(st, inode=None):
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino if inode is None else inode}
+
+
+def file_sha256(path, drop_cache=False, throttle=None):
+    digest = hashlib.sha256()
+    for block in read_blocks(path, bytearray(READ_BLOCK_SIZE), drop_cache, throttle):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def prefix_sha256(path, length):
+    # Unfinished hash object over the first `length` bytes of the file.
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while length > 0:
+            block = f.read(min(READ_BLOCK_SIZE, length))
+            if not block:
+                raise Exception(f"{path} is shorter than {length} bytes")
+            digest.update(block)
+            length -= len(block)
+    return digest
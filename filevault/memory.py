@@ -0,0 +1,100 @@
+import os
+import sys
+
+# The run's peak resident set, on Linux, comes from VmHWM, which writing "5"
+# to clear_refs resets; elsewhere getrusage() only knows the process peak.
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+# === Page cache ===
+def drop_cache(fd, offset=0, length=0):
+    # Tells the kernel the pages of this range (length 0: to the end) of an
+    # open file will not be needed again, so a backup streaming through
+    # large files does not evict everybody else's cached data. Dirty pages
+    # are only dropped once written back. A hint: no-op where unsupported.
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def read_blocks(path, buffer, drop=False, throttle=None):
+    # Reads a file sequentially into the one reusable `buffer`, yielding a
+    # memoryview of each block that is only valid until the next one is
+    # read. With `drop`, a file larger than the buffer leaves the page cache
+    # block by block as it is read. Unbuffered, so the data is read straight
+    # into `buffer`. Each block is charged to the `throttle` as it is read.
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        drop = drop and os.fstat(f.fileno()).st_size > len(buffer)
+        if drop and hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        offset = 0
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            if throttle:
+                throttle.read(n)
+            yield view[:n]
+            if drop:
+                drop_cache(f.fileno(), offset, n)
+            offset += n
+
+
+class BufferPool:
+    # Fixed-size bytearrays handed out again once released, so reading
+    # multi-GB files does not allocate (and fault in) a fresh block for
+    # every read. Used from one thread; the buffers themselves may be
+    # filled on others.
+
+    def __init__(self, size):
+        self.size = size
+        self.free = []
+
+    def acquire(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def release(self, buffer):
+        self.free.append(buffer)
+
+
+# === Resident set ===
+def reset_peak_rss():
+    # Starts a new peak for peak_rss(); the process-wide peak can only be
+    # reset on Linux. Runs of parallel jobs share one process and one peak.
+    try:
+        with open(PROC_CLEAR_REFS, "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # Peak resident set size in bytes since reset_peak_rss() (Linux) or
+    # since the process started; None when the platform cannot tell.
+    try:
+        with open(PROC_STATUS, "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def validate_memory(settings):
+    limit = settings.get("memory_limit_bytes")
+    if limit is not None and (not isinstance(limit, int) or limit <= 0):
+        raise ValueError(f"memory_limit_bytes must be a positive number of bytes, not {limit!r}.")
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+
+PROGRESS_INTERVAL = 0.1
+
+
+class ProgressMeter:
+    # Progress callback for BackupEngine/restore: turns the engine's
+    # (done, total, path, bytes_done) calls into snapshot dicts with files,
+    # bytes, current path, elapsed seconds, byte rate and ETA, and hands them
+    # to `publish`. Snapshots are rate limited to one per `interval` seconds
+    # (the final one always goes out) so the caller's loop never waits on a
+    # consumer.
+
+    def __init__(self, publish, interval=PROGRESS_INTERVAL):
+        self.publish = publish
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last = None
+
+    def __call__(self, done, total, path=None, bytes_done=0):
+        now = time.monotonic()
+        if done < total and self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.started
+        # Files are the only unit known up front; the ETA assumes the
+        # remaining files take as long on average as the finished ones.
+        eta = elapsed * (total - done) / done if done and total >= done else None
+        self.publish({
+            "files": done,
+            "total": total,
+            "bytes": bytes_done,
+            "path": path,
+            "elapsed": elapsed,
+            "bytes_per_s": bytes_done / elapsed if elapsed > 0 else None,
+            "eta": eta
+        })
+
+
+class EventQueue:
+    # Thread-safe hand-off of (name, event, data) tuples from engine and
+    # scheduler threads to a UI thread that drains it on a timer. put() never
+    # blocks on the consumer: a "progress" event replaces a still-undrained
+    # progress event of the same job, so the queue stays short however fast
+    # progress arrives and however slowly the UI renders.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = deque()
+
+    def put(self, name, event, data=None):
+        with self.lock:
+            if event == "progress" and self.events and self.events[-1][:2] == (name, "progress"):
+                self.events[-1] = (name, event, data)
+            else:
+                self.events.append((name, event, data))
+
+    def drain(self):
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+
+def format_duration(seconds):
+    h, rem = divmod(int(seconds), 3600)
+    m, s = divmod(rem, 60)
+    return f"{h:02}:{m:02}:{s:02}"
+
+
+def describe_progress(snapshot):
+    text = f"{snapshot['files']}/{snapshot['total']} files, {snapshot['bytes'] / 1e6:.1f} MB"
+    if snapshot["bytes_per_s"]:
+        text += f" at {snapshot['bytes_per_s'] / 1e6:.1f} MB/s"
+    if snapshot["eta"] is not None and snapshot["files"] < snapshot["total"]:
+        text += f", ETA {format_duration(snapshot['eta'])}"
+    return text
@@ -0,0 +1,106 @@
+import shutil
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# Bucket key per grandfather-father-son rule: the newest version in each of
+# the last N buckets that contain a version is kept.
+RETENTION_RULES = {
+    "hourly": "%Y-%m-%d %H",
+    "daily": "%Y-%m-%d",
+    "weekly": "%G-W%V",
+    "monthly": "%Y-%m"
+}
+
+_locks_guard = threading.Lock()
+_destination_locks = {}
+_prune_locks = {}
+
+
+def _lock_for(table, dest_base):
+    key = str(Path(dest_base).resolve())
+    with _locks_guard:
+        return table.setdefault(key, threading.Lock())
+
+
+def destination_lock(dest_base):
+    # Serializes manifest/version-list commits and chunk garbage collection
+    # for one destination between backups and background pruning.
+    return _lock_for(_destination_locks, dest_base)
+
+
+def prune_lock(dest_base):
+    return _lock_for(_prune_locks, dest_base)
+
+
+def select_versions(versions, max_backups=None, retention=None):
+    # Names kept by the count and GFS rules; `versions` is oldest first. With
+    # no rule configured every version is kept.
+    if not max_backups and not any((retention or {}).values()):
+        return {version["name"] for version in versions}
+
+    keep = set()
+    newest_first = versions[::-1]
+    if max_backups:
+        keep.update(version["name"] for version in newest_first[:max_backups])
+    for rule, count in (retention or {}).items():
+        if not count:
+            continue
+        if rule not in RETENTION_RULES:
+            raise ValueError(f"Unknown retention rule {rule!r}; use {', '.join(RETENTION_RULES)}.")
+        buckets = set()
+        for version in newest_first:
+            bucket = datetime.fromtimestamp(version["created"]).strftime(RETENTION_RULES[rule])
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(version["name"])
+                if len(buckets) >= count:
+                    break
+    return keep
+
+
+def plan_retention(versions, settings, free_bytes=None):
+    # Returns the versions to delete, oldest first. `versions` are catalog
+    # rows (oldest first) with name, base, created and bytes; nothing here
+    # touches the destination, so planning costs the same on a network share.
+    if not versions:
+        return []
+    keep = select_versions(versions, settings.get("max_backups"), settings.get("retention"))
+
+    # An incremental needs every earlier archive of its chain.
+    chains = {}
+    for version in versions:
+        chains.setdefault(version["base"], []).append(version)
+    for chain in chains.values():
+        kept = [i for i, version in enumerate(chain) if version["name"] in keep]
+        if kept:
+            keep.update(version["name"] for version in chain[:kept[-1] + 1])
+
+    # Space limits drop whole chains, oldest first, but never the newest
+    # chain of either storage kind, which the next backup builds on.
+    max_total = settings.get("max_total_bytes")
+    min_free = settings.get("min_free_bytes")
+    total = sum(version["bytes"] or 0 for version in versions if version["name"] in keep)
+    newest_bases = {version["kind"] == "chunk store": version["base"] for version in versions}
+    for base, chain in chains.items():
+        over_total = max_total is not None and total > max_total
+        under_free = min_free is not None and free_bytes is not None and free_bytes < min_free
+        if not over_total and not under_free:
+            break
+        if base in newest_bases.values():
+            continue
+        for version in chain:
+            if version["name"] in keep:
+                keep.discard(version["name"])
+                total -= version["bytes"] or 0
+                if free_bytes is not None:
+                    free_bytes += version["bytes"] or 0
+
+    return [version for version in versions if version["name"] not in keep]
+
+
+def free_space(dest_base):
+    try:
+        return shutil.disk_usage(dest_base).free
+    except OSError:
+        return None
@@ -0,0 +1,210 @@
+import os
+import re
+import time
+
+IGNORE_FILE_NAME = ".backupignore"
+
+
+# === Patterns ===
+def translate_pattern(line):
+    # One gitignore-style line -> (regex over a "/"-separated relative path,
+    # negated, directories only), or None for blanks and comments. A pattern
+    # without an inner "/" matches a name at any depth; "*" and "?" stop at
+    # "/", "**" crosses it.
+    line = line.rstrip("\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    if line.startswith("\\"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    anchored = "/" in line
+    line = line.lstrip("/")
+    if not line:
+        return None
+
+    out = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if line.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif line.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and "]" in line[i + 2:]:
+            end = line.index("]", i + 2)
+            body = line[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    body = "".join(out)
+    return (body if anchored else "(?:.*/)?" + body), negate, dir_only
+
+
+def compiles(body):
+    try:
+        re.compile(body)
+        return True
+    except re.error:
+        return False
+
+
+class RuleSet:
+    # A list of gitignore-style patterns compiled into two alternations (one
+    # for files, one for directories), so matching a path is one regex call
+    # whatever the number of rules. The last matching rule wins: rules are
+    # placed in reverse order and the capturing group that matched tells
+    # which one it was. A pattern that is not valid (an unclosed range like
+    # "[z-a]") is dropped, as git does.
+
+    def __init__(self, lines):
+        rules = [rule for rule in map(translate_pattern, lines) if rule and compiles(rule[0])]
+        self.empty = not rules
+        self.file_regex, self.file_negated = self._compile([rule for rule in rules if not rule[2]])
+        self.dir_regex, self.dir_negated = self._compile(rules)
+
+    @staticmethod
+    def _compile(rules):
+        if not rules:
+            return None, []
+        rules = rules[::-1]
+        regex = re.compile("|".join(f"({body})" for body, _, _ in rules), re.DOTALL)
+        return regex, [negate for _, negate, _ in rules]
+
+    def match(self, rel, is_dir):
+        # True (excluded), False (re-included by "!") or None (no rule).
+        regex, negated = (self.dir_regex, self.dir_negated) if is_dir else (self.file_regex, self.file_negated)
+        if regex is None:
+            return None
+        m = regex.fullmatch(rel)
+        if m is None:
+            return None
+        return not negated[m.lastindex - 1]
+
+
+def read_ignore_file(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.readlines()
+    except OSError:
+        return []
+
+
+# === Source filter ===
+class SourceRules:
+    # What to back up from one source tree: the "exclude" patterns of the
+    # settings, a .backupignore in any directory (applying below it and
+    # overriding the levels above, as .gitignore does), optional "include"
+    # patterns a file must match, and size / age limits. TreeScanner asks
+    # excludes_dir() before descending, so an excluded directory is never
+    # read or stat'ed; the size and age limits are the only checks that
+    # need a file's stat.
+    #
+    # A context is a tuple of (base prefix, RuleSet), outermost first, for
+    # the directory being scanned.
+
+    def __init__(self, root, settings):
+        self.root = str(root)
+        self.base_rules = RuleSet(settings.get("exclude") or [])
+        include = settings.get("include") or []
+        self.include = RuleSet(include) if include else None
+        self.min_size = settings.get("min_file_size")
+        self.max_size = settings.get("max_file_size")
+        max_age_days = settings.get("max_age_days")
+        self.oldest_mtime = time.time() - max_age_days * 86400 if max_age_days else None
+        self.needs_stat = self.min_size is not None or self.max_size is not None or self.oldest_mtime is not None
+        self.contexts = {}
+
+    def root_context(self):
+        return () if self.base_rules.empty else (("", self.base_rules),)
+
+    def enter(self, context, prefix, has_ignore_file):
+        # Context inside the directory `prefix` ("" or "a/b/"), adding its
+        # .backupignore when it has one.
+        if not has_ignore_file:
+            return context
+        path = os.path.join(self.root, *prefix.split("/"), IGNORE_FILE_NAME)
+        rules = RuleSet(read_ignore_file(path))
+        return context if rules.empty else context + ((prefix, rules),)
+
+    def _match(self, context, rel, is_dir):
+        for base, rules in reversed(context):
+            result = rules.match(rel[len(base):], is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def excludes_dir(self, context, rel):
+        return self._match(context, rel, True)
+
+    def excludes_file(self, context, rel, st=None):
+        # `st` is only needed (and may be a callable returning it) when size
+        # or age limits are set.
+        if self._match(context, rel, False):
+            return True
+        if self.include is not None and not self.include.match(rel, False):
+            return True
+        if self.needs_stat:
+            st = st() if callable(st) else st
+            if self.min_size is not None and st.st_size < self.min_size:
+                return True
+            if self.max_size is not None and st.st_size > self.max_size:
+                return True
+            if self.oldest_mtime is not None and st.st_mtime < self.oldest_mtime:
+                return True
+        return False
+
+    def outer_context(self, rel_dir):
+        # Context a walk starting at `rel_dir` (not at the root, e.g. a
+        # journal-dirty directory) begins with, before entering it; None
+        # when it or one of its ancestors is excluded.
+        if not rel_dir:
+            return self.root_context()
+        parent = rel_dir.rpartition("/")[0]
+        context = self.context_for(parent)
+        if context is None or self.excludes_dir(context, rel_dir):
+            return None
+        return context
+
+    def context_for(self, rel_dir):
+        if rel_dir not in self.contexts:
+            context = self.outer_context(rel_dir)
+            if context is not None:
+                prefix = rel_dir + "/" if rel_dir else ""
+                has_ignore_file = os.path.exists(os.path.join(self.root, *prefix.split("/"), IGNORE_FILE_NAME))
+                context = self.enter(context, prefix, has_ignore_file)
+            self.contexts[rel_dir] = context
+        return self.contexts[rel_dir]
+
+    def excludes_path(self, rel, is_dir, st=None):
+        context = self.context_for(rel.rpartition("/")[0])
+        if context is None:
+            return True
+        return self.excludes_dir(context, rel) if is_dir else self.excludes_file(context, rel, st)
+
+
+def validate_rules(settings):
+    for key in ("exclude", "include"):
+        for pattern in settings.get(key) or []:
+            rule = translate_pattern(pattern)
+            if rule and not compiles(rule[0]):
+                raise ValueError(f"Invalid {key} pattern {pattern!r}.")
+    for key in ("min_file_size", "max_file_size", "max_age_days"):
+        value = settings.get(key)
+        if value is not None and (not isinstance(value, (int, float)) or value < 0):
+            raise ValueError(f"{key} must be a non-negative number.")
@@ -0,0 +1,102 @@
+import csv
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+RUN_LOG_FILE_NAME = "backup_runs.jsonl"
+TREND_PERIODS = {"day": "%Y-%m-%d", "week": "%G-W%V", "month": "%Y-%m"}
+
+_locks_guard = threading.Lock()
+_run_log_locks = {}
+
+
+def now_iso():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class RunLog:
+    # Append-only JSON-lines journal of backup runs and prunes, one record per
+    # line, kept in the destination next to the archives. Every record has a
+    # "type" ("run", "prune" or "warning") and an ISO "time"; run records
+    # carry the per-run metrics and phase timings written by BackupEngine.
+
+    def __init__(self, dest_base):
+        self.path = Path(dest_base) / RUN_LOG_FILE_NAME
+        with _locks_guard:
+            self.lock = _run_log_locks.setdefault(str(self.path.resolve()), threading.Lock())
+
+    def append(self, record):
+        record = dict(record)
+        record.setdefault("time", now_iso())
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        # One write per record keeps lines whole even with several writers.
+        with self.lock, open(self.path, "a") as f:
+            f.write(line)
+
+    def warn(self, message):
+        self.append({"type": "warning", "message": message})
+
+    def records(self, type=None, since=None, until=None):
+        # Yields records oldest first, optionally filtered by type and by a
+        # [since, until) range of datetimes. A torn last line is skipped.
+        if not self.path.exists():
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if type and record.get("type") != type:
+                    continue
+                if since or until:
+                    when = datetime.fromisoformat(record["time"])
+                    if (since and when < since) or (until and when >= until):
+                        continue
+                yield record
+
+    def export(self, fp, format="jsonl", type="run", since=None, until=None):
+        # Writes the matching records as JSON lines or as CSV with nested
+        # dicts flattened ("phases": {"scan": 1} -> "phases.scan").
+        records = self.records(type, since, until)
+        if format == "jsonl":
+            for record in records:
+                fp.write(json.dumps(record) + "\n")
+            return
+        if format != "csv":
+            raise ValueError(f"Unknown export format {format!r}")
+        rows = [flatten_record(record) for record in records]
+        fields = []
+        for row in rows:
+            fields.extend(key for key in row if key not in fields)
+        writer = csv.DictWriter(fp, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def flatten_record(record, prefix=""):
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f"{prefix}{key}."))
+        elif isinstance(value, list):
+            flat[prefix + key] = len(value)
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def trend(records, field, period="month"):
+    # Mean / min / max of a numeric (possibly dotted, e.g. "phases.compress")
+    # field per day, week or month, for spotting throughput regressions and
+    # archive growth. Returns [(period, count, mean, min, max)] oldest first.
+    buckets = {}
+    for record in records:
+        value = flatten_record(record).get(field)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        key = datetime.fromisoformat(record["time"]).strftime(TREND_PERIODS[period])
+        buckets.setdefault(key, []).append(value)
+    return [(key, len(values), sum(values) / len(values), min(values), max(values))
+            for key, values in sorted(buckets.items())]
@@ -0,0 +1,92 @@
+import os
+
+from filevault.rules import IGNORE_FILE_NAME
+
+
+class TreeScanner:
+    # Single-pass generator over os.scandir. Yields (arcname, DirEntry) for
+    # every file; callers use entry.stat()/entry.inode(), which come from the
+    # directory read itself where the OS provides them and are cached otherwise.
+    # With `rules` (a filevault.rules.SourceRules) excluded directories are
+    # dropped by name before they are pushed, so they are never read or
+    # stat'ed, and excluded files are skipped; `rel_root` is where `root`
+    # sits in the tree the rules belong to ("" for its top). Directories and
+    # entries that cannot be read are skipped: `errors` gets a message and
+    # `unreadable` their path in that tree (see carry_forward()).
+
+    def __init__(self, root, rules=None, rel_root=""):
+        self.root = str(root)
+        self.rules = rules
+        self.rel_root = rel_root
+        self.files_seen = 0
+        self.dirs_done = 0
+        self.dirs_pending = 0
+        self.excluded = 0
+        self.errors = []
+        self.unreadable = []
+
+    def __iter__(self):
+        rules = self.rules
+        base = self.rel_root + "/" if self.rel_root else ""
+        context = rules.outer_context(self.rel_root) if rules else None
+        if rules and context is None:
+            return
+        stack = [(self.root, "", context)]
+        self.dirs_pending = 1
+        while stack:
+            path, prefix, context = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                entries = []
+            except OSError as e:
+                self.errors.append(f"{path}: {e}")
+                self.unreadable.append((base + prefix).rstrip("/"))
+                entries = []
+            if rules and entries:
+                context = rules.enter(context, base + prefix, any(e.name == IGNORE_FILE_NAME for e in entries))
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if rules and rules.excludes_dir(context, base + prefix + entry.name):
+                            self.excluded += 1
+                            continue
+                        stack.append((entry.path, prefix + entry.name + "/", context))
+                        self.dirs_pending += 1
+                    elif entry.is_file():
+                        if rules and rules.excludes_file(context, base + prefix + entry.name, entry.stat):
+                            self.excluded += 1
+                            continue
+                        self.files_seen += 1
+                        yield prefix + entry.name, entry
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.errors.append(f"{entry.path}: {e}")
+                    self.unreadable.append(base + prefix + entry.name)
+            self.dirs_pending -= 1
+            self.dirs_done += 1
+
+    def estimate_total(self, previous_total=None):
+        # Running estimate of the final file count: the previous run's total
+        # when known, otherwise extrapolated from files per directory so far.
+        seen = self.files_seen
+        if previous_total and previous_total > seen:
+            return previous_total
+        per_dir = seen / max(self.dirs_done, 1)
+        return max(seen + int(self.dirs_pending * per_dir), seen + 1 if self.dirs_pending else seen)
+
+
+def carry_forward(files, previous, unreadable):
+    # Copies into `files` the `previous` records under the paths that could
+    # not be read this time ("" for the whole tree), so a permission error
+    # keeps the last backed-up copy instead of counting as a deletion.
+    # Returns how many records were carried forward.
+    carried = 0
+    for path in set(unreadable):
+        for arcname, record in previous.items():
+            if arcname not in files and (not path or arcname == path or arcname.startswith(path + "/")):
+                files[arcname] = record
+                carried += 1
+    return carried
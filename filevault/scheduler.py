@@ -0,0 +1,341 @@
+import os
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from filevault.engine import SCHEDULE_INTERVALS, BackupEngine
+from filevault.progress import ProgressMeter
+from filevault.throttle import SharedBandwidth
+from filevault.watch import DebouncedTrigger, SourceWatch
+
+DEFAULT_JOB_NAME = "default"
+JOB_KEYS = ("name", "source_dir", "dest_dir", "schedule", "cron", "watch")
+
+
+# === Job registry ===
+def load_jobs(settings):
+    # The top-level settings are the "default" job (the one the GUI edits);
+    # every entry of settings["jobs"] is another backup set with its own
+    # source, destination, schedule and retention. Engine options a job does
+    # not set (codec, workers, ...) are inherited from the top level.
+    base = {key: value for key, value in settings.items() if key != "jobs" and key not in JOB_KEYS}
+    jobs = []
+    if settings["source_dir"] and settings["dest_dir"]:
+        jobs.append(dict(base, name=DEFAULT_JOB_NAME, source_dir=settings["source_dir"],
+                         dest_dir=settings["dest_dir"], schedule=settings["schedule"],
+                         cron=settings.get("cron"), watch=settings["watch"]))
+    for entry in settings.get("jobs") or []:
+        job = dict(base, schedule="None", cron=None, watch=False)
+        job.update(entry)
+        if not job.get("name") or not job.get("source_dir") or not job.get("dest_dir"):
+            raise ValueError(f"Job {job.get('name')!r} needs a name, source_dir and dest_dir.")
+        if job["cron"]:
+            CronSchedule(job["cron"])
+        jobs.append(job)
+
+    # Each destination holds one manifest/chunk store, so it cannot be shared.
+    names = set()
+    dests = {}
+    for job in jobs:
+        if job["name"] in names:
+            raise ValueError(f"Duplicate job name {job['name']!r}.")
+        names.add(job["name"])
+        dest = str(Path(job["dest_dir"]).resolve())
+        if dest in dests:
+            raise ValueError(f"Jobs {dests[dest]!r} and {job['name']!r} share the destination {dest}.")
+        dests[dest] = job["name"]
+    return jobs
+
+
+def find_job(settings, name):
+    for job in load_jobs(settings):
+        if job["name"] == name:
+            return job
+    raise ValueError(f"No job named {name!r}.")
+
+
+def describe_schedule(job):
+    if job.get("cron"):
+        return f"cron {job['cron']}"
+    return job["schedule"]
+
+
+def job_is_scheduled(job):
+    return bool(job.get("cron")) or job["schedule"] in SCHEDULE_INTERVALS or job["schedule"] == "On change"
+
+
+def job_devices(job):
+    devices = set()
+    for key in ("source_dir", "dest_dir"):
+        try:
+            devices.add(os.stat(job[key]).st_dev)
+        except OSError:
+            pass
+    return devices
+
+
+# === Cron expressions ===
+def parse_cron_field(text, low, high):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Invalid cron step: {step_text!r}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field {text!r} is outside {low}-{high}.")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    # Standard five-field cron expression: minute hour day-of-month month
+    # day-of-week (0 or 7 = Sunday). Supports *, lists, ranges and steps. As
+    # in cron, a restricted day-of-month and day-of-week match either one.
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression: {expression!r}")
+        try:
+            self.minutes = parse_cron_field(fields[0], 0, 59)
+            self.hours = parse_cron_field(fields[1], 0, 23)
+            self.days = parse_cron_field(fields[2], 1, 31)
+            self.months = parse_cron_field(fields[3], 1, 12)
+            self.weekdays = {day % 7 for day in parse_cron_field(fields[4], 0, 7)}
+        except ValueError as e:
+            raise ValueError(f"Invalid cron expression {expression!r}: {e}")
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, dt):
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=5 * 366)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        return None
+
+
+def next_run_after(job, now):
+    if job.get("cron"):
+        return CronSchedule(job["cron"]).next_after(now)
+    unit, amount = SCHEDULE_INTERVALS.get(job["schedule"], (None, None))
+    if unit:
+        return now + timedelta(**{unit: amount})
+    return None
+
+
+# === Scheduler ===
+class JobScheduler:
+    # Runs every registered job on its interval/cron schedule, on change, or
+    # when triggered. A trigger never gets dropped: the job is queued (at most
+    # once) and starts as soon as it is not already running and the global
+    # limits allow it: `max_parallel_jobs` jobs at a time, at most
+    # `max_jobs_per_device` jobs reading or writing the same disk, and
+    # `max_total_workers` compression threads shared between running jobs.
+    # `max_total_read_bytes_per_s` / `max_total_write_bytes_per_s` cap the
+    # I/O of all running jobs together, on top of each job's "throttle".
+    # Events are reported as on_event(job_name, event, data) with event one of
+    # "queued", "started", "progress" (ProgressMeter snapshot), "finished"
+    # (result dict) or "failed" (exception). on_event runs on scheduler and
+    # backup threads and must not block; a UI passes EventQueue.put.
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.next_runs = {}
+        self.queue = deque()
+        self.running = {}
+        self.max_parallel = 2
+        self.max_workers = os.cpu_count() or 1
+        self.max_per_device = 1
+        self.bandwidth = SharedBandwidth()
+        self.watch_lock = threading.Lock()
+        self.watches = {}
+        self.triggers = {}
+        self.stopping = False
+        self.thread = None
+
+    def set_limits(self, settings):
+        with self.cond:
+            self.max_parallel = max(1, settings["max_parallel_jobs"])
+            self.max_workers = settings["max_total_workers"] or os.cpu_count() or 1
+            self.max_per_device = max(1, settings["max_jobs_per_device"])
+            self.bandwidth.set_rates(settings["max_total_read_bytes_per_s"], settings["max_total_write_bytes_per_s"])
+            self.cond.notify_all()
+
+    def set_jobs(self, jobs):
+        # Replaces the registry. Jobs that keep their schedule keep their
+        # next run time; a running job finishes with its old settings.
+        now = datetime.now()
+        with self.cond:
+            old = self.jobs
+            self.jobs = {job["name"]: job for job in jobs}
+            for name, job in self.jobs.items():
+                previous = old.get(name)
+                if previous is None or describe_schedule(previous) != describe_schedule(job):
+                    self.next_runs[name] = next_run_after(job, now)
+            for name in list(self.next_runs):
+                if name not in self.jobs:
+                    del self.next_runs[name]
+            self.queue = deque(name for name in self.queue if name in self.jobs)
+            self.cond.notify_all()
+        self._update_watches()
+
+    def _update_watches(self):
+        with self.watch_lock:
+            with self.cond:
+                wanted = {name: (str(Path(job["source_dir"])), str(Path(job["dest_dir"])))
+                          for name, job in self.jobs.items()
+                          if job["watch"] or job["schedule"] == "On change"}
+            for name in list(self.watches):
+                watch = self.watches[name]
+                if wanted.get(name) != (str(watch.src), str(watch.journal.path.parent)):
+                    self.triggers.pop(name).cancel()
+                    self.watches.pop(name).stop()
+            for name, (src, dest) in wanted.items():
+                if name in self.watches or not Path(src).is_dir() or not Path(dest).is_dir():
+                    continue
+                trigger = DebouncedTrigger(lambda name=name: self.trigger(name))
+                watch = SourceWatch(src, dest, lambda name=name: self._changed(name))
+                self.triggers[name] = trigger
+                self.watches[name] = watch
+                watch.start()
+
+    def _changed(self, name):
+        with self.cond:
+            job = self.jobs.get(name)
+        with self.watch_lock:
+            trigger = self.triggers.get(name)
+        if job and trigger and job["schedule"] == "On change":
+            trigger.poke()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+        with self.watch_lock:
+            for trigger in self.triggers.values():
+                trigger.cancel()
+            for watch in self.watches.values():
+                watch.stop()
+            self.triggers.clear()
+            self.watches.clear()
+
+    def trigger(self, name):
+        # Returns False if the job is unknown or already waiting in the queue.
+        with self.cond:
+            if name not in self.jobs or name in self.queue:
+                return False
+            self.queue.append(name)
+            self.cond.notify_all()
+        self._emit(name, "queued", None)
+        return True
+
+    def next_run(self, name):
+        with self.cond:
+            return self.next_runs.get(name)
+
+    def state(self, name):
+        with self.cond:
+            if name in self.running:
+                return "running"
+            if name in self.queue:
+                return "queued"
+            return "idle"
+
+    def _emit(self, name, event, data):
+        if self.on_event:
+            self.on_event(name, event, data)
+
+    def _loop(self):
+        queued = []
+        while True:
+            for name in queued:
+                self._emit(name, "queued", None)
+            with self.cond:
+                if self.stopping:
+                    return
+                now = datetime.now()
+                queued = []
+                for name, when in self.next_runs.items():
+                    if when and when <= now:
+                        self.next_runs[name] = next_run_after(self.jobs[name], now)
+                        if name not in self.queue:
+                            self.queue.append(name)
+                            queued.append(name)
+                self._start_ready()
+                if not queued:
+                    self.cond.wait(1)
+
+    def _start_ready(self):
+        device_load = Counter(device for _, devices in self.running.values() for device in devices)
+        for name in list(self.queue):
+            if len(self.running) >= self.max_parallel:
+                return
+            free = self.max_workers - sum(workers for workers, _ in self.running.values())
+            if free < 1:
+                return
+            if name in self.running:
+                continue
+            job = self.jobs[name]
+            devices = job_devices(job)
+            if any(device_load[device] >= self.max_per_device for device in devices):
+                continue
+            workers = min(job["workers"] or max(1, self.max_workers // self.max_parallel), free)
+            self.queue.remove(name)
+            self.running[name] = (workers, devices)
+            device_load.update(devices)
+            threading.Thread(target=self._run_job, args=(job, workers), daemon=True).start()
+
+    def _run_job(self, job, workers):
+        name = job["name"]
+        with self.watch_lock:
+            watch = self.watches.get(name)
+        self._emit(name, "started", None)
+        try:
+            progress = ProgressMeter(lambda snapshot: self._emit(name, "progress", snapshot))
+            engine = BackupEngine(dict(job, workers=workers), progress, self.bandwidth)
+            result = engine.run(watch.journal if watch else None)
+            self._emit(name, "finished", result)
+        except Exception as e:
+            self._emit(name, "failed", e)
+        finally:
+            with self.cond:
+                del self.running[name]
+                self.cond.notify_all()
@@ -0,0 +1,119 @@
+import os
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+from filevault.memory import drop_cache
+
+
+def fsync_directory(path):
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicFileSink:
+    # Writes the archive as a temp file inside the destination, so nothing is
+    # staged on the source volume; it only gets its final name once fsynced.
+    # With resume_offset the existing temp file is reopened and cut back to
+    # that offset (the last checkpoint) instead of being started over. With
+    # `drop_cache` whatever has been fsynced leaves the page cache.
+
+    def __init__(self, final_path, resume_offset=None, drop_cache=False):
+        self.final_path = Path(final_path)
+        self.drop_cache = drop_cache
+        self.tmp_path = self.final_path.with_name(self.final_path.name + ".partial")
+        self.location = str(self.final_path)
+        if resume_offset is None:
+            self.fileobj = open(self.tmp_path, "wb")
+        else:
+            self.fileobj = open(self.tmp_path, "r+b")
+            self.fileobj.truncate(resume_offset)
+            self.fileobj.seek(resume_offset)
+
+    def sync(self):
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        if self.drop_cache:
+            drop_cache(self.fileobj.fileno())
+
+    def commit(self):
+        self.sync()
+        self.fileobj.close()
+        os.replace(self.tmp_path, self.final_path)
+        fsync_directory(self.final_path.parent)
+
+    def abort(self):
+        self.fileobj.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+class PipeSink:
+    # Streams the archive into the stdin of a shell command (or to our own
+    # stdout for "-"), e.g. an uploader, so no full-size file ever exists.
+
+    def __init__(self, command):
+        self.location = command
+        if command == "-":
+            self.process = None
+            self.fileobj = sys.stdout.buffer
+        else:
+            self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+            self.fileobj = self.process.stdin
+
+    def sync(self):
+        self.fileobj.flush()
+
+    def commit(self):
+        self.fileobj.flush()
+        if self.process:
+            self.fileobj.close()
+            if self.process.wait() != 0:
+                raise Exception(f"Stream command exited with code {self.process.returncode}: {self.location}")
+
+    def abort(self):
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+
+
+class SocketSink:
+
+    def __init__(self, host, port):
+        self.location = f"tcp:{host}:{port}"
+        self.sock = socket.create_connection((host, port))
+        self.fileobj = self.sock.makefile("wb")
+
+    def sync(self):
+        self.fileobj.flush()
+
+    def commit(self):
+        self.fileobj.flush()
+        self.fileobj.close()
+        self.sock.shutdown(socket.SHUT_WR)
+        self.sock.close()
+
+    def abort(self):
+        self.fileobj.close()
+        self.sock.close()
+
+
+def open_archive_sink(dest_base, zip_name, stream_target=None, resume_offset=None, drop_cache=False):
+    # stream_target: None for a file in dest_base, "-" for stdout,
+    # "cmd:<shell command>" for a pipe or "tcp:<host>:<port>" for a socket.
+    # Only a file in dest_base can be resumed (or dropped from the cache).
+    if not stream_target:
+        return AtomicFileSink(Path(dest_base) / zip_name, resume_offset, drop_cache)
+    if stream_target == "-":
+        return PipeSink("-")
+    if stream_target.startswith("cmd:"):
+        return PipeSink(stream_target[4:].replace("{name}", zip_name))
+    if stream_target.startswith("tcp:"):
+        host, _, port = stream_target[4:].rpartition(":")
+        return SocketSink(host, int(port))
+    raise ValueError(f"Unknown stream target: {stream_target}")
@@ -0,0 +1,229 @@
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+from filevault.rules import SourceRules
+from filevault.scanner import TreeScanner
+
+SNAPSHOT_MODES = ("auto", "reflink", "hardlink", "hook")
+MARKER_FILE_NAME = "FILEVAULT_SNAPSHOT"
+# _IOW(0x94, 9, int): clone a whole file, Linux 4.5+ (btrfs, XFS, bcachefs, ...).
+FICLONE = 0x40049409
+# Errors meaning the filesystem cannot clone at all, rather than that one
+# file failed.
+CLONE_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS}
+
+
+def default_snapshot_dir(src, dest_base):
+    # Next to the source: links and clones only work within one filesystem.
+    # One per destination, so two jobs of the same source never share it.
+    src = Path(src).absolute()
+    tag = hashlib.sha256(str(Path(dest_base).absolute()).encode("utf-8")).hexdigest()[:8]
+    return src.parent / f".{src.name}.snapshot-{tag}"
+
+
+def reflink(src, dst):
+    # Copy-on-write clone: shares the source's blocks, so it takes no time or
+    # space, but later writes to the source no longer show through.
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        Path(dst).unlink(missing_ok=True)
+        raise
+
+
+class Snapshot:
+    # A frozen view of the source for one backup run, so the archive holds
+    # every file as of one moment and the compression (which takes much
+    # longer) reads from that view while applications keep writing.
+    #
+    # "reflink" clones every file to be backed up into a tree under
+    # snapshot_dir; "hardlink" links them instead, which freezes which files
+    # exist and any file an application replaces (write + rename) but not
+    # writes in place; "auto" clones where the filesystem can and links
+    # otherwise. A file that can be neither is read live. "hook" leaves the
+    # snapshot to snapshot_freeze_command (e.g. lvcreate --snapshot + mount,
+    # btrfs subvolume snapshot) and reads the source where it shows up,
+    # snapshot_path.
+    #
+    # snapshot_freeze_command runs before the view is taken and
+    # snapshot_thaw_command right after, so a service only needs to pause
+    # for the seconds that takes; snapshot_release_command runs once the
+    # files are read. Commands get FILEVAULT_SOURCE and FILEVAULT_SNAPSHOT in
+    # their environment.
+
+    def __init__(self, src, dest_base, settings):
+        self.src = Path(src)
+        self.settings = settings
+        self.mode = settings["snapshot"]
+        self.dir = Path(settings.get("snapshot_dir") or default_snapshot_dir(src, dest_base))
+        # What the run reads instead of the source: the root, the rules still
+        # to apply there (a link tree only holds what they let through) and
+        # each file's inode in the source (clones have inodes of their own).
+        # `unreadable` lists the source paths left out because they could not
+        # be read (see filevault.scanner.carry_forward).
+        self.root = self.src
+        self.rules = None
+        self.inodes = None
+        self.method = self.mode
+        self.files = 0
+        self.live = 0
+        self.unreadable = []
+        self.seconds = 0.0
+        self.frozen = False
+        self.warnings = []
+        self.made_dirs = set()
+
+    def freeze(self, rules, paths=None):
+        # `rules` is the SourceRules of the source; `paths` limits the view
+        # to these files and directories (a journal-driven run), None takes
+        # the whole tree.
+        started = time.perf_counter()
+        if self.mode == "hook":
+            self.root = Path(self.settings["snapshot_path"])
+        else:
+            self._clear()
+            self.root = self.dir / "tree"
+        self.frozen = True
+        self._command("snapshot_freeze_command")
+        try:
+            if self.mode == "hook":
+                if not self.root.is_dir():
+                    raise Exception(f"The snapshot did not show up at {self.root}.")
+                self.rules = SourceRules(self.root, self.settings)
+            else:
+                self._link_tree(rules, paths)
+        finally:
+            self._command("snapshot_thaw_command", check=False)
+        self.seconds = time.perf_counter() - started
+
+    def release(self):
+        if not self.frozen:
+            return
+        self.frozen = False
+        if self.mode == "hook":
+            self._command("snapshot_release_command", check=False)
+            return
+        try:
+            self._clear()
+        except OSError as e:
+            self.warnings.append(f"Could not remove snapshot {self.dir}: {e}")
+
+    def _clear(self):
+        if not self.dir.exists():
+            return
+        if not (self.dir / MARKER_FILE_NAME).exists():
+            raise Exception(f"{self.dir} exists and is not a FileVault snapshot; set snapshot_dir elsewhere.")
+        shutil.rmtree(self.dir)
+
+    def _command(self, key, check=True):
+        command = self.settings.get(key)
+        if not command:
+            return
+        env = dict(os.environ, FILEVAULT_SOURCE=str(self.src), FILEVAULT_SNAPSHOT=str(self.root))
+        # Output is captured: the archive itself may be going to our stdout.
+        done = subprocess.run(command, shell=True, env=env, capture_output=True)
+        if done.returncode:
+            output = done.stderr.decode("utf-8", "replace").strip()[-500:]
+            message = f"{key} exited with code {done.returncode}: {command}" + (f"\n{output}" if output else "")
+            if check:
+                raise Exception(message)
+            self.warnings.append(message)
+
+    def _link_tree(self, rules, paths):
+        self.dir.mkdir(parents=True)
+        (self.dir / MARKER_FILE_NAME).touch()
+        self.root.mkdir()
+        self.made_dirs = {self.root}
+        self.inodes = {}
+        self.method = "hardlink" if self.mode == "hardlink" else "reflink"
+        if paths is None:
+            self._link_scan(TreeScanner(self.src, rules), "")
+            return
+        for rel in paths:
+            path = os.path.join(self.src, *rel.split("/"))
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self.warnings.append(f"{path}: {e}")
+                self.unreadable.append(rel)
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                self._link_scan(TreeScanner(path, rules, rel), rel + "/")
+            elif os.path.isfile(path) and not rules.excludes_path(rel, False, st):
+                self._add(rel, path, st.st_ino)
+
+    def _link_scan(self, scanner, base):
+        for sub, entry in scanner:
+            try:
+                inode = entry.inode()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self.warnings.append(f"{entry.path}: {e}")
+                self.unreadable.append(base + sub)
+                continue
+            self._add(base + sub, entry.path, inode)
+        self.warnings.extend(scanner.errors)
+        self.unreadable.extend(scanner.unreadable)
+
+    def _add(self, arcname, path, inode):
+        target = self.root.joinpath(*arcname.split("/"))
+        if target.parent not in self.made_dirs:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            self.made_dirs.add(target.parent)
+        try:
+            if self.method == "reflink":
+                try:
+                    reflink(path, target)
+                except OSError as e:
+                    if e.errno not in CLONE_UNSUPPORTED:
+                        raise
+                    if self.mode == "reflink":
+                        raise Exception(f"The filesystem of {self.src} cannot clone files ({e.strerror}); "
+                                        f"use the \"hardlink\" or \"hook\" snapshot.")
+                    self.method = "hardlink"
+            if self.method == "hardlink":
+                try:
+                    os.link(path, target)
+                except OSError as e:
+                    if e.errno == errno.EXDEV:
+                        raise Exception(f"snapshot_dir {self.dir} must be on the same filesystem as {self.src}.")
+                    raise
+        except FileNotFoundError:
+            # Deleted since the scan: it is not part of the snapshot.
+            return
+        except OSError:
+            # Neither clone nor link (e.g. a file we do not own under
+            # protected_hardlinks): read it live through a symlink.
+            os.symlink(os.path.abspath(path), target)
+            self.live += 1
+        self.inodes[arcname] = inode
+        self.files += 1
+
+
+def validate_snapshot(settings):
+    mode = settings.get("snapshot")
+    if not mode:
+        return
+    if mode not in SNAPSHOT_MODES:
+        raise ValueError(f"Unknown snapshot mode {mode!r}; use {', '.join(SNAPSHOT_MODES)}.")
+    if mode == "hook" and not settings.get("snapshot_path"):
+        raise ValueError("A \"hook\" snapshot needs snapshot_path, where the snapshot shows the source.")
+    if mode != "hook" and settings.get("snapshot_dir"):
+        src = Path(settings["source_dir"]).absolute()
+        snapshot_dir = Path(settings["snapshot_dir"]).absolute()
+        if snapshot_dir == src or src in snapshot_dir.parents:
+            raise ValueError("snapshot_dir must be outside the source folder.")
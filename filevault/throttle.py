@@ -0,0 +1,253 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+THROTTLE_LIMITS = ("read_bytes_per_s", "write_bytes_per_s", "files_per_s", "max_load")
+WINDOW_RECHECK_INTERVAL = 30
+LOAD_CHECK_INTERVAL = 1.0
+MAX_LOAD_BACKOFF = 8.0
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# ioprio_set(2) is not wrapped by the os module; syscall numbers per machine.
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i686": 289, "i386": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+IOPRIO_CLASSES = {"best-effort": 2, "idle": 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+
+# === Settings ===
+def parse_clock(text):
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_days(text):
+    # "mon-fri", "sat,sun" or "*"; returns weekday numbers (Monday = 0).
+    if not text or text == "*":
+        return set(range(7))
+    days = set()
+    for part in text.lower().split(","):
+        if "-" in part:
+            start, end = (WEEKDAYS.index(day.strip()) for day in part.split("-", 1))
+            days.update(range(start, end + 1) if start <= end else [*range(start, 7), *range(end + 1)])
+        else:
+            days.add(WEEKDAYS.index(part.strip()))
+    return days
+
+
+def window_matches(window, now):
+    # A window is {"start": "HH:MM", "end": "HH:MM", "days": "mon-fri", ...}
+    # and may wrap past midnight ("22:00"-"06:00"); the days apply to the
+    # day the window starts on.
+    start = parse_clock(window.get("start", "00:00"))
+    end = parse_clock(window.get("end", "24:00"))
+    minute = now.hour * 60 + now.minute
+    days = parse_days(window.get("days"))
+    if start <= end:
+        return start <= minute < end and now.weekday() in days
+    if minute >= start:
+        return now.weekday() in days
+    return minute < end and (now.weekday() - 1) % 7 in days
+
+
+def active_limits(config, now=None):
+    # Top-level limits of the "throttle" setting, overridden by the first
+    # matching entry of config["windows"]; a limit set to null there means
+    # unlimited during that window.
+    config = config or {}
+    limits = {key: config.get(key) for key in THROTTLE_LIMITS}
+    now = now or datetime.now()
+    for window in config.get("windows") or []:
+        if window_matches(window, now):
+            limits.update({key: window[key] for key in THROTTLE_LIMITS if key in window})
+            break
+    return limits
+
+
+def validate_throttle(config):
+    if not config:
+        return
+    for window in config.get("windows") or []:
+        try:
+            parse_clock(window.get("start", "00:00"))
+            parse_clock(window.get("end", "24:00"))
+            parse_days(window.get("days"))
+        except ValueError:
+            raise ValueError(f"Invalid throttle window {window!r}; use \"HH:MM\" times and days like \"mon-fri\".")
+    if config.get("io_priority") not in (None, *IOPRIO_CLASSES):
+        raise ValueError(f"Unknown io_priority {config['io_priority']!r}; use {', '.join(IOPRIO_CLASSES)}.")
+
+
+# === Priority ===
+def lower_priority(nice=None, io_priority=None):
+    # Lowers the CPU and I/O priority of the calling thread. On Linux both are
+    # per thread and inherited by threads it starts (the compression pool),
+    # so a backup run on its own thread leaves the rest of the process alone.
+    # Priorities can only be lowered, never raised back, without privileges.
+    # Raises OSError if the I/O priority could not be set.
+    if nice and hasattr(os, "setpriority"):
+        try:
+            tid = threading.get_native_id() if sys.platform.startswith("linux") else 0
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + nice))
+        except OSError:
+            pass
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if io_priority and sys.platform.startswith("linux") and syscall:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        level = 7 if io_priority == "best-effort" else 0
+        ioprio = (IOPRIO_CLASSES[io_priority] << IOPRIO_CLASS_SHIFT) | level
+        if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, ioprio) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+
+# === Rate limiting ===
+class TokenBucket:
+    # Classic token bucket holding up to one second of tokens. take() may
+    # overdraw the bucket (a 4 MiB block with a 1 MB/s limit); the caller
+    # then sleeps off the debt, and so does whoever comes next.
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate or 0
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, rate or 0)
+
+    def take(self, amount):
+        # Returns the seconds slept.
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - amount
+            self.stamp = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class SharedBandwidth:
+    # Read and write limits shared by every job a JobScheduler runs (the
+    # max_total_read/write_bytes_per_s settings): each job's Throttle also
+    # draws from these buckets, so parallel jobs split the bandwidth instead
+    # of each getting the whole per-job limit.
+
+    def __init__(self, read_rate=None, write_rate=None):
+        self.read_bucket = TokenBucket(read_rate)
+        self.write_bucket = TokenBucket(write_rate)
+
+    def set_rates(self, read_rate, write_rate):
+        self.read_bucket.set_rate(read_rate)
+        self.write_bucket.set_rate(write_rate)
+
+
+class Throttle:
+    # Read, write and file rate limits for one backup run, taken from the
+    # "throttle" setting and re-read every WINDOW_RECHECK_INTERVAL seconds so
+    # a long run follows the time windows; reads and writes are charged per
+    # block, so a window change takes effect mid-file. With max_load set, file() backs
+    # off (exponentially, up to MAX_LOAD_BACKOFF seconds per check) while the
+    # 1-minute load average per CPU is above it. Reads and writes are also
+    # charged to the `shared` SharedBandwidth of a scheduler, if any. Without
+    # either every call returns at once.
+
+    def __init__(self, config=None, shared=None):
+        self.config = config or {}
+        self.shared = shared
+        self.enabled = bool(config) or shared is not None
+        self.read_bucket = TokenBucket()
+        self.write_bucket = TokenBucket()
+        self.files_bucket = TokenBucket()
+        self.max_load = None
+        self.windows_checked = 0.0
+        self.load_checked = 0.0
+        self.backoff = 0.0
+        self.waited = 0.0
+        self.wait_lock = threading.Lock()
+        self.warnings = []
+        if self.enabled:
+            self._apply_window()
+
+    def _apply_window(self):
+        limits = active_limits(self.config)
+        self.read_bucket.set_rate(limits["read_bytes_per_s"])
+        self.write_bucket.set_rate(limits["write_bytes_per_s"])
+        self.files_bucket.set_rate(limits["files_per_s"])
+        self.max_load = limits["max_load"]
+        self.windows_checked = time.monotonic()
+
+    def _recheck_window(self, now):
+        if now - self.windows_checked >= WINDOW_RECHECK_INTERVAL:
+            self._apply_window()
+
+    def _account(self, seconds):
+        if seconds:
+            with self.wait_lock:
+                self.waited += seconds
+
+    def start_run(self):
+        # Called on the thread doing the backup, before any worker starts.
+        if self.config:
+            try:
+                lower_priority(self.config.get("nice"), self.config.get("io_priority"))
+            except OSError as e:
+                self.warnings.append(f"Could not lower the I/O priority: {e.strerror}")
+
+    def read(self, amount):
+        if self.enabled:
+            self._recheck_window(time.monotonic())
+            self._account(self.read_bucket.take(amount))
+            if self.shared:
+                self._account(self.shared.read_bucket.take(amount))
+
+    def write(self, amount):
+        if self.enabled:
+            self._recheck_window(time.monotonic())
+            self._account(self.write_bucket.take(amount))
+            if self.shared:
+                self._account(self.shared.write_bucket.take(amount))
+
+    def file(self):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self._recheck_window(now)
+        self._account(self.files_bucket.take(1))
+        if self.max_load and hasattr(os, "getloadavg") and now - self.load_checked >= LOAD_CHECK_INTERVAL:
+            self.load_checked = now
+            if os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load:
+                self.backoff = min(MAX_LOAD_BACKOFF, self.backoff * 2 or 0.5)
+                time.sleep(self.backoff)
+                self._account(self.backoff)
+            else:
+                self.backoff = 0.0
+
+    def wrap(self, fileobj):
+        return ThrottledWriter(fileobj, self) if self.enabled else fileobj
+
+
+class ThrottledWriter:
+    # Write-only file wrapper that charges every write to the write bucket.
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        self.throttle.write(len(data))
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from filevault.catalog import Catalog, iter_member
+from filevault.chunkstore import ChunkStore
+from filevault.encryption import open_archive
+from filevault.manifest import READ_BLOCK_SIZE
+from filevault.throttle import Throttle
+from filevault.volumes import volume_files
+
+MAX_REPORTED_ERRORS = 20
+
+
+class ChunkChecks:
+    # Chunks are shared between versions; each one is read and hashed once
+    # per verify pass, whichever version asks first.
+
+    def __init__(self, store, throttle):
+        self.store = store
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def check(self, digest):
+        with self.lock:
+            if digest in self.results:
+                return self.results[digest]
+        try:
+            self.throttle.read(len(self.store.get_chunk(digest)))
+            error = None
+        except Exception as e:
+            error = str(e)
+        with self.lock:
+            self.results[digest] = error
+        return error
+
+
+def hash_file(path, throttle):
+    # Digests are taken over the plaintext archive, so an encrypted one is
+    # hashed decrypted, which also checks every segment's tag.
+    digest = hashlib.sha256()
+    with open_archive(path) as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            throttle.read(len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify_zip(dest_base, version, deep, throttle):
+    # Fast check: hash the archive file (each volume of a split archive) and
+    # compare it with the digest taken while it was written; no
+    # decompression. Deep check (or an archive from before digests were
+    # recorded): decompress every member, checking its CRC and the SHA-256
+    # of its content.
+    dest_base = Path(dest_base)
+    files = volume_files(version)
+    if not (dest_base / files[0]).exists():
+        return "skipped" if version["location"] else "missing", []
+    missing = [f"{name}: volume is missing" for name in files if not (dest_base / name).exists()]
+    if missing:
+        return "missing", missing
+    if version["sha256"] and not deep:
+        digests = ([volume["sha256"] for volume in json.loads(version["volumes"])] if version["volumes"]
+                   else [version["sha256"]])
+        errors = [f"{name}: archive SHA-256 mismatch" for name, sha256 in zip(files, digests)
+                  if hash_file(dest_base / name, throttle) != sha256]
+        return ("corrupt" if errors else "ok"), errors
+
+    errors = []
+    # One SQLite connection per thread: verify tasks run on a pool.
+    with Catalog(dest_base) as catalog:
+        rows = catalog.entries(version)
+    for number, name in enumerate(files, start=1):
+        with open_archive(dest_base / name) as fp:
+            for row in rows:
+                if (row["volume"] or 1) != number:
+                    continue
+                row["archive"] = name
+                digest = hashlib.sha256()
+                try:
+                    for data in iter_member(fp, row):
+                        throttle.read(len(data))
+                        digest.update(data)
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                # A patch only has its CRC; its SHA-256 is the rebuilt file's.
+                if row["sha256"] and not row["delta"] and digest.hexdigest() != row["sha256"]:
+                    errors.append(f"{name}: SHA-256 mismatch in {row['path']}")
+    if len(errors) > MAX_REPORTED_ERRORS:
+        errors[MAX_REPORTED_ERRORS:] = [f"{version['name']}: ... and {len(errors) - MAX_REPORTED_ERRORS} more"]
+    return ("corrupt" if errors else "ok"), errors
+
+
+def verify_chunk_version(store, chunks, version):
+    try:
+        files = store.load_version(version["name"])["files"]
+    except OSError:
+        return "missing", []
+    except ValueError as e:
+        return "corrupt", [f"{version['name']}: unreadable version index: {e}"]
+    errors = []
+    for path, record in files.items():
+        for digest in record["chunks"]:
+            error = chunks.check(digest)
+            if error:
+                errors.append(f"{version['name']}: {path}: {error}")
+    if len(errors) > MAX_REPORTED_ERRORS:
+        errors[MAX_REPORTED_ERRORS:] = [f"{version['name']}: ... and {len(errors) - MAX_REPORTED_ERRORS} more"]
+    return ("corrupt" if errors else "ok"), errors
+
+
+def verify_versions(dest_base, versions, deep=False, workers=None, throttle=None):
+    # Verifies catalog version rows on a thread pool (hashing and
+    # decompression release the GIL). Returns one result per version:
+    # {"name", "kind", "status" ("ok", "corrupt", "missing" or "skipped" for
+    # archives streamed elsewhere), "errors", "bytes"}.
+    throttle = throttle or Throttle()
+    store = ChunkStore(dest_base)
+    chunks = ChunkChecks(store, throttle)
+
+    def verify_one(version):
+        try:
+            if version["kind"] == "chunk store":
+                status, errors = verify_chunk_version(store, chunks, version)
+            else:
+                status, errors = verify_zip(dest_base, version, deep, throttle)
+        except Exception as e:
+            status, errors = "corrupt", [f"{version['name']}: {e}"]
+        return {"name": version["name"], "kind": version["kind"], "status": status, "errors": errors,
+                "bytes": version["bytes"] or 0}
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        return list(pool.map(verify_one, versions))
+
+
+def scrub_slice(versions, budget_bytes):
+    # The next versions to re-verify: in scrub order (see
+    # Catalog.scrub_order) until `budget_bytes` is used up, at least one.
+    chosen = []
+    used = 0
+    for version in versions:
+        if chosen and used + (version["bytes"] or 0) > budget_bytes:
+            break
+        chosen.append(version)
+        used += version["bytes"] or 0
+    return chosen
+
+
+def verify_destination(dest_base, run_log, names=None, deep=False, budget_bytes=None, workers=None,
+                       throttle=None, trigger="manual"):
+    # Verifies the named versions, a scrub slice of `budget_bytes`, or every
+    # version; records the outcome in the catalog (for the scrub order) and
+    # as a "verify" record plus one warning per damaged version in the run
+    # journal. Returns the per-version results.
+    started = time.perf_counter()
+    with Catalog(dest_base) as catalog:
+        catalog.sync()
+        if names:
+            versions = [catalog.find_version(name) for name in names]
+        elif budget_bytes:
+            versions = scrub_slice(catalog.scrub_order(), budget_bytes)
+        else:
+            versions = catalog.versions()
+    results = verify_versions(dest_base, versions, deep, workers, throttle)
+
+    now = time.time()
+    with Catalog(dest_base) as catalog:
+        for result in results:
+            if result["status"] != "skipped":
+                catalog.mark_verified(result["name"], result["status"], now)
+    damaged = [result for result in results if result["status"] in ("corrupt", "missing")]
+    for result in damaged:
+        run_log.warn(f"Verify: {result['name']} is {result['status']}"
+                     + (f" ({result['errors'][0]})" if result["errors"] else ""))
+    run_log.append({
+        "type": "verify",
+        "trigger": trigger,
+        "deep": deep,
+        "checked": len(results),
+        "bytes": sum(result["bytes"] for result in results if result["status"] != "skipped"),
+        "ok": sum(1 for result in results if result["status"] == "ok"),
+        "corrupt": [result["name"] for result in damaged if result["status"] == "corrupt"],
+        "missing": [result["name"] for result in damaged if result["status"] == "missing"],
+        "errors": [error for result in damaged for error in result["errors"]][:MAX_REPORTED_ERRORS],
+        "duration": round(time.perf_counter() - started, 3)
+    })
+    return results
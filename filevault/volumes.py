@@ -0,0 +1,168 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from filevault.manifest import prefix_sha256
+from filevault.throttle import Throttle
+from filevault.zipwriter import ZipStreamWriter
+
+# Central directory record (46 bytes) plus room for a zip64 extra field.
+CENTRAL_ENTRY_BYTES = 80
+VOLUME_SUFFIX = re.compile(r"\.(\d{3,})\.zip$")
+
+
+def volume_name(name, number):
+    # Volume 1 keeps the archive's own name, so an archive that fits in one
+    # volume looks like any other; the next ones are backup_<ts>.002.zip, ...
+    if number <= 1:
+        return name
+    return f"{name[:-4] if name.endswith('.zip') else name}.{number:03}.zip"
+
+
+def archive_name(file_name):
+    # The archive a volume file belongs to.
+    return VOLUME_SUFFIX.sub(".zip", file_name)
+
+
+def volume_files(version):
+    # File names of a manifest record or catalog row, first volume first.
+    volumes = version.get("volumes")
+    if isinstance(volumes, str):
+        volumes = json.loads(volumes)
+    return [volume["name"] for volume in volumes] if volumes else [version["name"]]
+
+
+def remove_partials(dest_base, name):
+    # Drops the .partial files of every volume of an unfinished archive.
+    for path in Path(dest_base).glob(f"{name[:-4]}*.zip.partial"):
+        if archive_name(path.name[:-len(".partial")]) == name:
+            path.unlink(missing_ok=True)
+
+
+class VolumeWriter:
+    # Writes one archive as a series of volumes of at most `volume_bytes`
+    # each (a single volume without a limit). Every volume is a complete zip
+    # of whole files, so each one can be verified and extracted on its own;
+    # a file larger than the limit gets a volume to itself. Stands in for
+    # ZipStreamWriter: entries carry their "volume" number and their offset
+    # within it, and `offset` counts the bytes of all volumes so far.
+    #
+    # A full volume gets its central directory on the writer thread and is
+    # then fsynced on a background thread while the next one fills up.
+    # Volumes keep their .partial names until commit(), so a failed run
+    # leaves no archive behind.
+
+    def __init__(self, open_sink, name, volume_bytes=None, throttle=None, resume=None, encrypt=None):
+        # open_sink(file_name, resume_offset) opens the sink of one volume;
+        # `resume` is a checkpoint state to continue from. `encrypt(fileobj)`
+        # wraps each volume's sink in a filevault.encryption.EncryptingWriter.
+        self.open_sink = open_sink
+        self.name = name
+        self.volume_bytes = volume_bytes
+        self.throttle = throttle or Throttle()
+        self.encrypt = encrypt
+        self.cipher = None
+        self.syncer = ThreadPoolExecutor(max_workers=1)
+        self.syncing = []
+        self.volumes = []
+        self.sinks = []
+        self.entries = []
+        self.base_offset = 0
+        self.closed = False
+        if resume:
+            for volume in resume["volumes"]:
+                self.sinks.append(open_sink(volume["name"], volume["bytes"]))
+                self.volumes.append(volume)
+                self.base_offset += volume["bytes"]
+            self.entries = list(resume["entries"])
+            self._open(resume["volume"], resume["volume_offset"])
+        else:
+            self._open(1)
+
+    def _open(self, number, resume_offset=None):
+        self.number = number
+        self.sink = self.open_sink(volume_name(self.name, number), resume_offset)
+        self.sinks.append(self.sink)
+        fileobj = self.throttle.wrap(self.sink.fileobj)
+        if self.encrypt:
+            self.cipher = fileobj = self.encrypt(fileobj)
+        entries = [entry for entry in self.entries if entry.get("volume", 1) == number]
+        if resume_offset:
+            self.current = ZipStreamWriter(fileobj, resume_offset, entries,
+                                           prefix_sha256(self.sink.tmp_path, resume_offset))
+        else:
+            self.current = ZipStreamWriter(fileobj)
+        self.central_bytes = sum(len(entry["name"]) + CENTRAL_ENTRY_BYTES for entry in entries)
+
+    @property
+    def offset(self):
+        return self.base_offset + (0 if self.closed else self.current.offset)
+
+    def _close_volume(self):
+        self.current.close()
+        if self.cipher:
+            self.cipher.close()
+        self.volumes.append({"name": volume_name(self.name, self.number), "bytes": self.current.offset,
+                             "sha256": self.current.digest.hexdigest(), "files": len(self.current.entries)})
+        self.base_offset += self.current.offset
+        self.syncing.append(self.syncer.submit(self.sink.sync))
+
+    def reserve(self, size):
+        # Called before an entry of about `size` bytes: starts the next
+        # volume when it would not fit in this one (with its directory record).
+        projected = self.current.offset + self.central_bytes + size + CENTRAL_ENTRY_BYTES
+        if self.volume_bytes and self.current.entries and projected > self.volume_bytes:
+            self._close_volume()
+            self._open(self.number + 1)
+
+    def _added(self):
+        entry = self.current.entries[-1]
+        entry["volume"] = self.number
+        self.central_bytes += len(entry["name"]) + CENTRAL_ENTRY_BYTES
+        self.entries.append(entry)
+
+    def write_entry(self, arcname, mtime, mode, method, crc, file_size, payload):
+        self.current.write_entry(arcname, mtime, mode, method, crc, file_size, payload)
+        self._added()
+
+    def begin_entry(self, arcname, mtime, mode, method):
+        return self.current.begin_entry(arcname, mtime, mode, method)
+
+    def write_data(self, entry, data):
+        self.current.write_data(entry, data)
+
+    def end_entry(self, entry, crc, file_size):
+        self.current.end_entry(entry, crc, file_size)
+        self._added()
+
+    def position(self):
+        # Where the writer stands, for a checkpoint: the current volume and
+        # offset in it, and the volumes already finished.
+        return {"volume": self.number, "volume_offset": self.current.offset, "volumes": list(self.volumes)}
+
+    def sync(self):
+        # Everything written so far is on disk once this returns.
+        for future in self.syncing:
+            future.result()
+        self.sink.sync()
+
+    def close(self):
+        self._close_volume()
+        self.closed = True
+        try:
+            for future in self.syncing:
+                future.result()
+        finally:
+            self.syncer.shutdown()
+
+    def commit(self):
+        for sink in self.sinks:
+            sink.commit()
+
+    def abort(self):
+        if self.cipher:
+            self.cipher.abort()
+        self.syncer.shutdown()
+        for sink in self.sinks:
+            sink.abort()
@@ -0,0 +1,338 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import shutil
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+from filevault.runlog import RunLog
+from filevault.scanner import TreeScanner
+
+CHANGE_JOURNAL_FILE_NAME = "backup_changes.jsonl"
+WATCH_POLL_INTERVAL = 30
+
+
+class ChangeJournal:
+    # Append-only list of source paths touched since the last backup, kept in
+    # the destination. A {"rescan": true} line means the journal cannot be
+    # trusted (watcher restarted, event queue overflowed) and the next run must
+    # walk the whole tree.
+
+    def __init__(self, dest_base):
+        self.path = Path(dest_base) / CHANGE_JOURNAL_FILE_NAME
+        self.consuming_path = self.path.with_name(self.path.name + ".consuming")
+        self.lock = threading.Lock()
+        self.recorded = set()
+        self.fp = None
+
+    def open(self):
+        with self.lock:
+            self.fp = open(self.path, "a")
+            self._append({"rescan": True})
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+
+    def _append(self, item):
+        self.fp.write(json.dumps(item) + "\n")
+        self.fp.flush()
+
+    def record(self, rel):
+        with self.lock:
+            if self.fp is None or rel in self.recorded:
+                return
+            self.recorded.add(rel)
+            self._append({"path": rel})
+
+    def mark_rescan(self):
+        with self.lock:
+            if self.fp:
+                self._append({"rescan": True})
+
+    def begin(self):
+        # Moves the current journal aside and returns (dirty_paths, needs_rescan).
+        # Changes arriving during the backup go to a fresh journal.
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+            if self.path.exists():
+                if self.consuming_path.exists():
+                    with open(self.path, "r") as src, open(self.consuming_path, "a") as dst:
+                        shutil.copyfileobj(src, dst)
+                    self.path.unlink()
+                else:
+                    os.replace(self.path, self.consuming_path)
+            self.recorded.clear()
+            if self.fp:
+                self.fp = open(self.path, "a")
+
+        dirty = set()
+        rescan = not self.consuming_path.exists()
+        if not rescan:
+            with open(self.consuming_path, "r") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        rescan = True
+                        continue
+                    if item.get("rescan"):
+                        rescan = True
+                    elif "path" in item:
+                        dirty.add(item["path"])
+        return dirty, rescan
+
+    def commit(self):
+        self.consuming_path.unlink(missing_ok=True)
+
+    def rollback(self):
+        # Leave the consumed journal in place; the next begin() merges it again.
+        pass
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                      | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+
+class InotifyWatcher:
+    # Linux only: one inotify watch per directory, added recursively and kept
+    # up to date as directories appear or move. Reports relative paths to
+    # on_change; None means events were lost and the tree must be rescanned.
+
+    def __init__(self, root, on_change):
+        self.root = str(root)
+        self.on_change = on_change
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = None
+        self.watches = {}
+        self.running = False
+
+    def start(self):
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self._watch_tree(self.root, "")
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _watch_tree(self, path, rel):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if path == self.root or errno == 28:  # ENOSPC: out of watches
+                raise OSError(errno, f"inotify_add_watch failed for {path}")
+            return
+        self.watches[wd] = rel
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self._watch_tree(entry.path, f"{rel}/{entry.name}" if rel else entry.name)
+        except OSError:
+            pass
+
+    def _forget_tree(self, rel):
+        for wd, watched in list(self.watches.items()):
+            if watched == rel or watched.startswith(rel + "/"):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def _loop(self):
+        try:
+            while self.running:
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                self._handle(data)
+        finally:
+            os.close(self.fd)
+
+    def _handle(self, data):
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.on_change(None)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None or not name:
+                continue
+            rel = f"{parent}/{name}" if parent else name
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._forget_tree(rel)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watch_tree(os.path.join(self.root, *rel.split("/")), rel)
+                    except OSError:
+                        self.on_change(None)
+            self.on_change(rel)
+
+
+class PollingWatcher:
+    # Fallback for platforms without inotify: periodically rescans the tree in
+    # the background and reports files whose size, mtime or inode changed.
+
+    def __init__(self, root, on_change, interval=WATCH_POLL_INTERVAL):
+        self.root = str(root)
+        self.on_change = on_change
+        self.interval = interval
+        self.running = False
+
+    def _snapshot(self):
+        snapshot = {}
+        for arcname, entry in TreeScanner(self.root):
+            try:
+                st = entry.stat()
+                snapshot[arcname] = (st.st_size, st.st_mtime_ns, entry.inode())
+            except OSError:
+                pass
+        return snapshot
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _loop(self):
+        previous = self._snapshot()
+        while self.running:
+            time.sleep(self.interval)
+            if not self.running:
+                break
+            current = self._snapshot()
+            for arcname in set(previous) | set(current):
+                if previous.get(arcname) != current.get(arcname):
+                    self.on_change(arcname)
+            previous = current
+
+
+def create_watcher(root, on_change, warn=None):
+    # `warn(message)` hears about falling back to polling.
+    if sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher(root, on_change)
+            watcher.start()
+            return watcher
+        except OSError as e:
+            if warn:
+                warn(f"Watching {root}: inotify unavailable, falling back to polling: {e}")
+    watcher = PollingWatcher(root, on_change)
+    watcher.start()
+    return watcher
+
+
+class DebouncedTrigger:
+    # Calls `callback` once changes have been quiet for `quiet` seconds, but
+    # never later than `max_delay` seconds after the first pending change.
+
+    def __init__(self, callback, quiet=10, max_delay=300):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.first = None
+
+    def poke(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.first is None:
+                self.first = now
+            delay = min(self.quiet, max(0, self.first + self.max_delay - now))
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(delay, self._fire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            self.timer = None
+            self.first = None
+
+    def _fire(self):
+        with self.lock:
+            self.timer = None
+            self.first = None
+        self.callback()
+
+
+class SourceWatch:
+    # A watcher feeding the change journal of one source/destination pair.
+    # Changes inside the destination (when it lives under the source) are
+    # ignored so backups do not trigger themselves. Problems setting up the
+    # watch are logged as warnings in the destination's run journal.
+
+    def __init__(self, src, dest_base, on_change=None):
+        self.src = Path(src)
+        self.journal = ChangeJournal(dest_base)
+        self.run_log = RunLog(dest_base)
+        self.on_change = on_change
+        self.watcher = None
+        try:
+            self.dest_inside = Path(dest_base).resolve().relative_to(self.src.resolve()).as_posix()
+        except ValueError:
+            self.dest_inside = None
+
+    def start(self):
+        self.journal.open()
+        self.watcher = create_watcher(self.src, self._changed, self.run_log.warn)
+
+    def stop(self):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        self.journal.close()
+
+    def _changed(self, rel):
+        if rel is None:
+            self.journal.mark_rescan()
+        elif self.dest_inside and (rel == self.dest_inside or rel.startswith(self.dest_inside + "/")):
+            return
+        else:
+            self.journal.record(rel)
+        if self.on_change:
+            self.on_change()
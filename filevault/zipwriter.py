@@ -0,0 +1,131 @@
+import hashlib
+import struct
+import time
+import zipfile
+
+
+def dos_date_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStreamWriter:
+    # Minimal zip writer that appends entries whose payload has already been
+    # compressed elsewhere. It only ever writes forward, tracking offsets itself.
+
+    def __init__(self, fileobj, offset=0, entries=None, digest=None):
+        # offset/entries continue an archive whose first entries are already
+        # in fileobj (a resumed checkpoint); `digest` then holds the SHA-256
+        # state of those first bytes.
+        self.fp = fileobj
+        self.offset = offset
+        self.entries = list(entries or [])
+        self.digest = digest or hashlib.sha256()
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.digest.update(data)
+        self.offset += len(data)
+
+    def _local_header(self, entry, crc, compress_size, file_size, extra):
+        self._write(struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, entry["version"], entry["flags"], entry["method"],
+            entry["time"], entry["date"], crc, compress_size, file_size,
+            len(entry["name"]), len(extra)) + entry["name"] + extra)
+
+    def _new_entry(self, arcname, mtime, mode, method, streamed):
+        try:
+            name = arcname.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            name = arcname.encode("utf-8")
+            flags = 0x800
+        if streamed:
+            flags |= 0x08
+        version = 45 if streamed else 20
+        if method == zipfile.ZIP_BZIP2:
+            version = 46
+        elif method == zipfile.ZIP_LZMA:
+            # zipfile's LZMA streams end with an end-of-stream marker.
+            flags |= 0x02
+            version = 63
+        dos_time, dos_date = dos_date_time(mtime)
+        return {
+            "name": name, "flags": flags, "method": method, "time": dos_time, "date": dos_date,
+            "mode": mode, "offset": self.offset, "version": version,
+            "crc": 0, "compress_size": 0, "file_size": 0
+        }
+
+    def reserve(self, size):
+        # Announces an entry of about `size` bytes; only VolumeWriter, which
+        # may start a new volume for it, has anything to do here.
+        pass
+
+    def write_entry(self, arcname, mtime, mode, method, crc, file_size, payload):
+        entry = self._new_entry(arcname, mtime, mode, method, streamed=False)
+        compress_size = len(payload)
+        if max(file_size, compress_size) >= 0xFFFFFFFF:
+            entry["version"] = max(entry["version"], 45)
+            extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            self._local_header(entry, crc, 0xFFFFFFFF, 0xFFFFFFFF, extra)
+        else:
+            self._local_header(entry, crc, compress_size, file_size, b"")
+        self._write(payload)
+        entry.update(crc=crc, compress_size=compress_size, file_size=file_size)
+        self.entries.append(entry)
+
+    def begin_entry(self, arcname, mtime, mode, method):
+        # Sizes are not known yet: they follow the data in a zip64 data descriptor.
+        entry = self._new_entry(arcname, mtime, mode, method, streamed=True)
+        self._local_header(entry, 0, 0xFFFFFFFF, 0xFFFFFFFF, struct.pack("<HHQQ", 1, 16, 0, 0))
+        entry["data_start"] = self.offset
+        return entry
+
+    def write_data(self, entry, data):
+        self._write(data)
+
+    def end_entry(self, entry, crc, file_size):
+        compress_size = self.offset - entry["data_start"]
+        self._write(struct.pack("<IIQQ", 0x08074b50, crc, compress_size, file_size))
+        entry.update(crc=crc, compress_size=compress_size, file_size=file_size)
+        self.entries.append(entry)
+
+    def close(self):
+        cd_start = self.offset
+        for entry in self.entries:
+            extra_fields = []
+            compress_size, file_size, offset = entry["compress_size"], entry["file_size"], entry["offset"]
+            if file_size >= 0xFFFFFFFF:
+                extra_fields.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size >= 0xFFFFFFFF:
+                extra_fields.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if offset >= 0xFFFFFFFF:
+                extra_fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            version = entry["version"]
+            if extra_fields:
+                extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+                version = max(version, 45)
+            self._write(struct.pack(
+                "<IBBHHHHHIIIHHHHHII", 0x02014b50, version, 3, version, entry["flags"], entry["method"],
+                entry["time"], entry["date"], entry["crc"], compress_size, file_size,
+                len(entry["name"]), len(extra), 0, 0, 0, (entry["mode"] & 0xFFFF) << 16, offset
+            ) + entry["name"] + extra)
+
+        cd_size = self.offset - cd_start
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_start >= 0xFFFFFFFF or cd_size >= 0xFFFFFFFF:
+            zip64_end = self.offset
+            self._write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_start))
+            self._write(struct.pack("<IIQI", 0x07064b50, 0, zip64_end, 1))
+            self._write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+        else:
+            self._write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, cd_size, cd_start, 0))
+        self.fp.flush()
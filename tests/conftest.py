@@ -0,0 +1,74 @@
+import io
+
+import pytest
+
+from filevault.compression import ParallelArchiver
+from filevault.engine import BackupEngine
+from filevault.zipwriter import ZipStreamWriter
+from tests.helpers import read_tree, write_tree
+
+
+class Vault:
+    # A source tree and a destination in a pytest tmp_path, with the
+    # engine calls the tests share.
+
+    def __init__(self, base):
+        self.src = base / "src"
+        self.dest = base / "dest"
+        self.restored = base / "restored"
+        self.src.mkdir()
+        self.dest.mkdir()
+
+    def write(self, rel, data):
+        write_tree(self.src, {rel: data})
+        return self.src / rel
+
+    def settings(self, **settings):
+        return dict({"source_dir": str(self.src), "dest_dir": str(self.dest), "scrub_bytes": 0}, **settings)
+
+    def engine(self, **settings):
+        return BackupEngine(self.settings(**settings))
+
+    def run(self, **settings):
+        # Waits for the background prune so tests see its result.
+        engine = self.engine(**settings)
+        try:
+            return engine.run()
+        finally:
+            if engine.prune_thread:
+                engine.prune_thread.join()
+
+    def restore(self, name, **settings):
+        target = self.restored / name
+        self.engine(**settings).restore(name, target)
+        return target
+
+    def matches(self, target):
+        # True when `target` holds the source's files with the same bytes.
+        return read_tree(target) == read_tree(self.src)
+
+
+@pytest.fixture
+def vault(tmp_path):
+    return Vault(tmp_path)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    # Writes {arcname: bytes} through a ParallelArchiver and returns the
+    # zip bytes, the digests it reported and its per-codec stats.
+    def build(files, workers=3, policy=None):
+        src = tmp_path / "src"
+        write_tree(src, files)
+        out = io.BytesIO()
+        writer = ZipStreamWriter(out)
+        archiver = ParallelArchiver(writer, workers, policy)
+        digests = {}
+        archiver.on_written = digests.__setitem__
+        for arcname in files:
+            path = src / arcname
+            archiver.add_file(path, arcname, path.stat())
+        archiver.finish()
+        writer.close()
+        return out.getvalue(), digests, archiver.stats
+    return build
@@ -0,0 +1,13 @@
+from pathlib import Path
+
+
+def write_tree(root, files):
+    # Writes {relative path: bytes} under `root`.
+    for rel, data in files.items():
+        path = Path(root) / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def read_tree(root):
+    return {path.relative_to(root).as_posix(): path.read_bytes() for path in Path(root).rglob("*") if path.is_file()}
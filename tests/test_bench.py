@@ -0,0 +1,52 @@
+import pytest
+
+from filevault.bench import (BENCH_PHASES, BENCH_REPORT_VERSION, compare_reports, ensure_corpus, load_report,
+                             run_benchmarks, save_report)
+from tests.helpers import read_tree
+
+
+def test_corpora_are_seeded_and_cached(tmp_path):
+    first = ensure_corpus(tmp_path / "a", "tiny", 0.005, 7)
+    assert len(read_tree(first)) == 100
+    assert read_tree(ensure_corpus(tmp_path / "b", "tiny", 0.005, 7)) == read_tree(first)
+    assert read_tree(ensure_corpus(tmp_path / "c", "tiny", 0.005, 8)) != read_tree(first)
+
+    (first / "d000" / "f000000.txt").write_bytes(b"kept")
+    assert ensure_corpus(tmp_path / "a", "tiny", 0.005, 7) == first
+    assert (first / "d000" / "f000000.txt").read_bytes() == b"kept"
+
+
+def test_report_times_every_phase(tmp_path):
+    report = run_benchmarks(["deep"], scale=0.01, workdir=tmp_path, settings={"workers": 2})
+    assert report["version"] == BENCH_REPORT_VERSION
+    result = report["corpora"]["deep"]
+    assert (result["files"], set(result["phases"])) == (64, set(BENCH_PHASES))
+    assert all(seconds >= 0 for seconds in result["phases"].values())
+    # The corpus stays cached; the backups and the restore are cleaned up.
+    assert list((tmp_path / "run").iterdir()) == []
+    assert read_tree(ensure_corpus(tmp_path, "deep", 0.01, 1))
+
+
+def report_with(phases):
+    return {"version": BENCH_REPORT_VERSION, "corpora": {"tiny": {"phases": phases}}}
+
+
+def test_only_real_slowdowns_are_regressions():
+    baseline = report_with({"scan": 1.0, "compress": 0.01, "write": 2.0, "rotate": 0.5})
+    current = report_with({"scan": 1.3, "compress": 0.05, "write": 2.4, "restore": 1.0})
+    rows = {row["phase"]: row for row in compare_reports(current, baseline)}
+    assert set(rows) == {"scan", "compress", "write"}
+    # compress is 5x slower but only by 40 ms; write is 20% slower.
+    assert [phase for phase, row in rows.items() if row["regressed"]] == ["scan"]
+    assert rows["scan"]["change"] == 0.3
+    assert not any(row["regressed"] for row in compare_reports(current, baseline, tolerance=0.5))
+    assert compare_reports(current, {"corpora": {}}) == []
+
+
+def test_reports_round_trip_and_old_versions_are_refused(tmp_path):
+    report = report_with({"scan": 1.0})
+    save_report(report, tmp_path / "report.json")
+    assert load_report(tmp_path / "report.json") == report
+    save_report(dict(report, version=0), tmp_path / "old.json")
+    with pytest.raises(ValueError, match="benchmark report"):
+        load_report(tmp_path / "old.json")
@@ -0,0 +1,139 @@
+import http.client
+import random
+import threading
+
+import pytest
+
+from filevault import browse
+from filevault.browse import VersionTree, serve_tree
+
+DATA = random.Random(7).randbytes(20000) * 3
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # Several blocks per member, so ranges cross block boundaries.
+    monkeypatch.setattr(browse, "BLOCK_BYTES", 4096)
+
+
+def read_range(tree, version, path, start, size):
+    with tree.open(version, path) as f:
+        f.seek(start)
+        return f.read(size)
+
+
+def test_listings_and_stat_come_from_the_catalog(vault):
+    vault.write("top.txt", b"top")
+    vault.write("sub/deep/a.bin", DATA)
+    first = vault.run()["name"]
+    vault.write("top.txt", b"top, again")
+    second = vault.run()["name"]
+    tree = VersionTree(vault.dest)
+    assert [entry["name"] for entry in tree.listdir()] == [first, second]
+    assert [(entry["name"], entry["dir"]) for entry in tree.listdir(first)] == [("sub", True), ("top.txt", False)]
+    assert tree.stat(first, "sub/deep/a.bin")["size"] == len(DATA)
+    assert tree.stat(second, "top.txt")["size"] == len(b"top, again")
+    assert tree.stat(first, "missing") is None
+    with pytest.raises(NotADirectoryError):
+        tree.listdir(first, "top.txt")
+    with pytest.raises(IsADirectoryError):
+        tree.open(first, "sub")
+
+
+@pytest.mark.parametrize("codec", ["store", "deflate", "lzma"])
+def test_byte_ranges_of_archive_members(vault, small_blocks, codec):
+    vault.write("a.bin", DATA)
+    name = vault.run(codec=codec)["name"]
+    tree = VersionTree(vault.dest)
+    # Forward, backward and across block boundaries, then past the end.
+    for start, size in [(0, 10), (5000, 9000), (100, 50), (len(DATA) - 7, 100), (len(DATA) + 5, 10)]:
+        assert read_range(tree, name, "a.bin", start, size) == DATA[start:start + size]
+    with tree.open(name, "a.bin") as f:
+        assert f.read() == DATA
+        assert f.seek(-3, 2) == len(DATA) - 3
+        assert f.read() == DATA[-3:]
+
+
+def test_compressed_blocks_are_cached(vault, small_blocks):
+    vault.write("a.bin", DATA)
+    name = vault.run(codec="deflate")["name"]
+    tree = VersionTree(vault.dest)
+    read_range(tree, name, "a.bin", 9000, 100)
+    misses = tree.cache.misses
+    assert read_range(tree, name, "a.bin", 9000, 100) == DATA[9000:9100]
+    assert tree.cache.misses == misses
+
+
+def test_cache_drops_the_least_recently_used_blocks():
+    cache = browse.BlockCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.get("a")
+    cache.put("c", b"1234")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (b"1234", None, b"1234")
+    assert cache.bytes == 8
+
+
+def test_byte_ranges_of_chunk_store_files(vault):
+    vault.write("a.bin", DATA)
+    name = vault.run(storage="Chunk Store")["name"]
+    tree = VersionTree(vault.dest)
+    for start, size in [(0, 10), (30000, 25000), (len(DATA) - 7, 100)]:
+        assert read_range(tree, name, "a.bin", start, size) == DATA[start:start + size]
+
+
+@pytest.fixture
+def server(vault):
+    vault.write("docs/a.bin", DATA)
+    vault.write("docs/empty.txt", b"")
+    name = vault.run()["name"]
+    server = serve_tree(VersionTree(vault.dest), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def request(method, path, **headers):
+        conn = http.client.HTTPConnection(*server.server_address[:2])
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+    yield name, request
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_get_with_ranges(server):
+    name, request = server
+    status, headers, body = request("GET", f"/{name}/docs/a.bin")
+    assert (status, body, headers["Accept-Ranges"]) == (200, DATA, "bytes")
+    status, headers, body = request("GET", f"/{name}/docs/a.bin", Range="bytes=1000-1999")
+    assert (status, body) == (206, DATA[1000:2000])
+    assert headers["Content-Range"] == f"bytes 1000-1999/{len(DATA)}"
+    status, headers, body = request("GET", f"/{name}/docs/a.bin", Range="bytes=-10")
+    assert (status, body) == (206, DATA[-10:])
+    status, headers, body = request("GET", f"/{name}/docs/a.bin", Range="bytes=59990-")
+    assert (status, body) == (206, DATA[59990:])
+    status, headers, _ = request("GET", f"/{name}/docs/a.bin", Range=f"bytes={len(DATA)}-")
+    assert (status, headers["Content-Range"]) == (416, f"bytes */{len(DATA)}")
+    status, headers, body = request("HEAD", f"/{name}/docs/a.bin")
+    assert (status, headers["Content-Length"], body) == (200, str(len(DATA)), b"")
+    assert request("GET", f"/{name}/docs/empty.txt")[::2] == (200, b"")
+    assert request("GET", f"/{name}/docs/missing")[0] == 404
+
+
+def test_http_listings_and_propfind(server):
+    name, request = server
+    status, _, body = request("GET", "/")
+    assert status == 200 and f"href=\"/{name}/\"".encode() in body
+    status, _, body = request("GET", f"/{name}/docs/")
+    assert status == 200 and f"/{name}/docs/a.bin".encode() in body
+    status, _, body = request("PROPFIND", f"/{name}/docs/", Depth="1")
+    assert status == 207
+    assert body.count(b"<D:response>") == 3
+    assert f"<D:getcontentlength>{len(DATA)}</D:getcontentlength>".encode() in body
+    status, _, body = request("PROPFIND", f"/{name}/docs/", Depth="0")
+    assert body.count(b"<D:response>") == 1
+    status, headers, _ = request("OPTIONS", "/")
+    assert (status, headers["DAV"]) == (200, "1")
@@ -0,0 +1,154 @@
+import ntpath
+import os
+import zipfile
+
+import pytest
+
+from filevault.catalog import CATALOG_FILE_NAME, Catalog, extract_members, safe_target
+from filevault.compression import CODEC_METHODS
+from tests.helpers import read_tree
+
+
+@pytest.fixture
+def versions(vault):
+    # Three incremental runs: edit, add, delete and re-add across the chain.
+    vault.write("a.txt", b"a1" * 5000)
+    vault.write("b.txt", b"b1")
+    vault.write("sub/c.txt", b"c1")
+    states = [(vault.run(incremental=True)["name"], read_tree(vault.src))]
+    vault.write("a.txt", b"a2" * 7000)
+    (vault.src / "b.txt").unlink()
+    states.append((vault.run(incremental=True)["name"], read_tree(vault.src)))
+    vault.write("b.txt", b"b3")
+    vault.write("sub/d.txt", b"d3")
+    states.append((vault.run(incremental=True)["name"], read_tree(vault.src)))
+    return states
+
+
+def test_history_lists_every_write_and_delete(vault, versions):
+    history = vault.engine().history("b.txt")
+    assert [(row["version"], row["deleted"]) for row in history] == [
+        (versions[0][0], 0), (versions[1][0], 1), (versions[2][0], 0)]
+    assert [row["size"] for row in vault.engine().history("a.txt")] == [10000, 14000]
+
+
+def test_tree_and_restore_of_every_version(vault, versions):
+    engine = vault.engine()
+    for name, state in versions:
+        tree = engine.tree(name)
+        assert sorted(tree) == sorted(state)
+        assert {path: row["size"] for path, row in tree.items()} == {path: len(data) for path, data in state.items()}
+        assert read_tree(vault.restore(name)) == state
+    # The middle version reads a.txt from itself and sub/c.txt from the full backup.
+    tree = engine.tree(versions[1][0])
+    assert (tree["a.txt"]["archive"], tree["sub/c.txt"]["archive"]) == (versions[1][0], versions[0][0])
+
+
+def test_as_of_picks_the_newest_version_at_that_time(vault, versions):
+    with Catalog(vault.dest) as catalog:
+        created = [catalog.find_version(name)["created"] for name, _ in versions]
+        assert catalog.find_version(as_of=created[1] + 0.5)["name"] == versions[1][0]
+        assert catalog.find_version()["name"] == versions[2][0]
+        with pytest.raises(Exception, match="No backup found"):
+            catalog.find_version(as_of=created[0] - 60)
+
+
+def test_partial_restore_extracts_only_the_requested_paths(vault, versions):
+    target = vault.restored / "partial"
+    assert vault.engine().restore(versions[2][0], target, paths=["sub", "b.txt"]) == 3
+    assert read_tree(target) == {"b.txt": b"b3", "sub/c.txt": b"c1", "sub/d.txt": b"d3"}
+    with pytest.raises(Exception, match="None of the requested paths"):
+        vault.engine().restore(versions[2][0], target, paths=["missing"])
+
+
+@pytest.mark.parametrize("codec", ["store", "deflate", "bzip2", "lzma"])
+def test_members_are_extracted_by_offset_for_every_codec(vault, codec):
+    files = {f"dir/file{i}.txt": (f"line {i}\n" * (i * 700 + 1)).encode() for i in range(8)}
+    for rel, data in files.items():
+        vault.write(rel, data)
+    name = vault.run(codec=codec)["name"]
+    with zipfile.ZipFile(vault.dest / name) as zipf:
+        methods = {info.compress_type for info in zipf.infolist() if info.file_size > 1000}
+    assert methods == {CODEC_METHODS[codec]}
+    target = vault.restored / codec
+    vault.engine().restore(name, target, paths=["dir/file5.txt", "dir/file2.txt"])
+    assert read_tree(target) == {"dir/file5.txt": files["dir/file5.txt"], "dir/file2.txt": files["dir/file2.txt"]}
+
+
+def test_corrupt_member_fails_its_crc(vault):
+    vault.write("a.txt", b"x" * 1000)
+    name = vault.run(codec="store")["name"]
+    path = vault.dest / name
+    data = bytearray(path.read_bytes())
+    data[data.index(b"x" * 1000) + 10] ^= 1
+    path.write_bytes(bytes(data))
+    with pytest.raises(Exception, match="CRC mismatch"):
+        vault.restore(name)
+
+
+def test_lost_catalog_is_rebuilt(vault, versions):
+    before = {name: vault.engine().tree(name) for name, _ in versions}
+    (vault.dest / CATALOG_FILE_NAME).unlink()
+    assert [record["name"] for record in vault.engine().list_backups()] == [name for name, _ in versions]
+    for name, state in versions:
+        tree = vault.engine().tree(name)
+        assert {path: row["size"] for path, row in tree.items()} == {
+            path: row["size"] for path, row in before[name].items()}
+        assert read_tree(vault.restore(name)) == state
+
+
+@pytest.mark.parametrize("path", ["../evil.txt", "a/../../evil.txt", "/etc/evil", "a//b.txt", "./a.txt", "a/", ""])
+def test_unsafe_restore_paths_are_refused(tmp_path, path):
+    with pytest.raises(Exception, match="unsafe path"):
+        safe_target(tmp_path, path)
+
+
+@pytest.mark.parametrize("path", ["C:/evil.txt", "a/D:evil.txt", "a\\..\\..\\evil.txt", "C:"])
+def test_drives_and_backslashes_are_refused_on_windows(tmp_path, monkeypatch, path):
+    with monkeypatch.context() as windows:
+        windows.setattr(os, "path", ntpath)
+        windows.setattr(os, "sep", "\\")
+        windows.setattr(os, "altsep", "/")
+        with pytest.raises(Exception, match="unsafe path"):
+            safe_target(tmp_path, path)
+
+
+def test_safe_restore_path_stays_in_the_target(tmp_path):
+    assert safe_target(tmp_path, "a/b..c/.d.txt") == tmp_path / "a" / "b..c" / ".d.txt"
+    if os.name != "nt":
+        # Only a name elsewhere.
+        assert safe_target(tmp_path, "C:/a\\b") == tmp_path / "C:" / "a\\b"
+
+
+def test_restore_refuses_a_member_outside_the_target(vault):
+    vault.write("a.txt", b"a")
+    name = vault.run()["name"]
+    row = vault.engine().tree(name)["a.txt"]
+    row["path"] = "../evil.txt"
+    target = vault.restored / "inside"
+    with pytest.raises(Exception, match="unsafe path"):
+        extract_members(vault.dest, [row], target)
+    assert not (vault.restored / "evil.txt").exists()
+
+
+def test_rotation_drops_catalog_versions(vault):
+    names = []
+    for i in range(3):
+        vault.write("a.txt", str(i).encode())
+        names.append(vault.run(max_backups=2)["name"])
+    assert [record["name"] for record in vault.engine().list_backups()] == names[1:]
+    with Catalog(vault.dest) as catalog:
+        assert [version["name"] for version in catalog.versions()] == names[1:]
+
+
+def test_chunk_store_versions_are_catalogued(vault):
+    vault.write("a.txt", b"a1")
+    first = vault.run(storage="Chunk Store")["name"]
+    vault.write("a.txt", b"a2")
+    vault.write("b.txt", b"b2")
+    second = vault.run(storage="Chunk Store")["name"]
+    assert [row["version"] for row in vault.engine().history("a.txt")] == [first, second]
+    assert read_tree(vault.restore(first)) == {"a.txt": b"a1"}
+    target = vault.restored / "b"
+    vault.engine().restore(second, target, paths=["b.txt"])
+    assert read_tree(target) == {"b.txt": b"b2"}
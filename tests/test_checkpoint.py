@@ -0,0 +1,104 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from filevault.checkpoint import CHECKPOINT_FILE_NAME, ZipCheckpoint
+from filevault.runlog import RunLog
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Runs a backup that dies without any cleanup (as on a power cut or a kill)
+# once `stop_after` files have been archived.
+CRASHING_RUN = """
+import os
+from filevault.engine import BackupEngine
+
+def progress(done, total, path=None, bytes_done=0):
+    if done >= {stop_after}:
+        os._exit(3)
+
+BackupEngine({settings!r}, progress).run()
+"""
+
+
+def crash_backup(vault, stop_after, **settings):
+    script = CRASHING_RUN.format(settings=vault.settings(**settings), stop_after=stop_after)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get("PYTHONPATH")])))
+    assert subprocess.run([sys.executable, "-c", script], env=env).returncode == 3
+
+
+# The archiver queues up to 64 small files per worker before writing them,
+# so the crash has to come later than that for a checkpoint to exist.
+FILES = 200
+CRASH_AFTER = 150
+SETTINGS = {"workers": 1, "checkpoint_files": 5}
+
+
+def make_source(vault, count=FILES):
+    for i in range(count):
+        vault.write(f"d{i % 4}/f{i:03}.bin", os.urandom(4096 + i))
+
+
+def test_interrupted_backup_resumes(vault):
+    make_source(vault)
+    crash_backup(vault, CRASH_AFTER, **SETTINGS)
+    checkpoint = vault.dest / CHECKPOINT_FILE_NAME
+    assert checkpoint.exists()
+    assert list(vault.dest.glob("*.zip.partial"))
+    assert not list(vault.dest.glob("*.zip"))
+    # A line torn by the crash is ignored.
+    with open(checkpoint, "a") as f:
+        f.write('{"offset": 12')
+
+    result = vault.run(**SETTINGS)
+    assert result["status"] == "success"
+    assert result["metrics"]["resumed_files"] >= 5
+    assert result["metrics"]["files_scanned"] == FILES
+    assert not checkpoint.exists()
+    assert not list(vault.dest.glob("*.partial"))
+    assert vault.matches(vault.restore(result["name"]))
+    assert [item["status"] for item in vault.engine().verify(deep=True)] == ["ok"]
+
+    runs = list(RunLog(vault.dest).records("run"))
+    assert runs[-1]["resumed_files"] == result["metrics"]["resumed_files"]
+
+
+def test_interrupted_split_backup_resumes(vault):
+    make_source(vault)
+    crash_backup(vault, CRASH_AFTER, volume_bytes=64 * 1024, **SETTINGS)
+    result = vault.run(volume_bytes=64 * 1024, **SETTINGS)
+    assert result["metrics"]["resumed_files"] >= 5
+    assert result["metrics"]["volumes"] > 1
+    assert vault.matches(vault.restore(result["name"]))
+    assert [item["status"] for item in vault.engine().verify()] == ["ok"]
+
+
+def test_resumed_incremental_picks_up_later_changes(vault):
+    make_source(vault)
+    vault.run(incremental=True, **SETTINGS)
+    for i in range(FILES):
+        vault.write(f"d{i % 4}/f{i:03}.bin", os.urandom(4096 + i))
+    crash_backup(vault, CRASH_AFTER, incremental=True, **SETTINGS)
+    checkpointed = ZipCheckpoint(vault.dest).load()["files"]
+    vault.write(next(iter(checkpointed)), b"changed after the crash")
+
+    resumed = vault.run(incremental=True, **SETTINGS)
+    assert resumed["kind"] == "incremental" and resumed["metrics"]["resumed_files"] >= 5
+    latest = vault.run(incremental=True, **SETTINGS)
+    assert (latest["status"], latest["changed"]) == ("success", 1)
+    assert vault.matches(vault.restore(latest["name"]))
+
+
+def test_checkpoint_of_another_source_is_discarded(vault, tmp_path):
+    make_source(vault)
+    crash_backup(vault, CRASH_AFTER, **SETTINGS)
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "x.txt").write_bytes(b"x")
+
+    result = vault.run(source_dir=str(other))
+    assert "resumed_files" not in result["metrics"]
+    assert result["metrics"]["files_scanned"] == 1
+    assert not (vault.dest / CHECKPOINT_FILE_NAME).exists()
+    assert not list(vault.dest.glob("*.partial"))
@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+from filevault import chunkstore
+from filevault.catalog import Catalog, extract_members
+from tests.helpers import read_tree, write_tree
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Chunks of 4-64 KiB (about 8 KiB on average) keep the pure-Python
+    # cut search fast on test-sized files.
+    monkeypatch.setattr(chunkstore, "CHUNK_MIN_SIZE", 4 * 1024)
+    monkeypatch.setattr(chunkstore, "CHUNK_MAX_SIZE", 64 * 1024)
+    monkeypatch.setattr(chunkstore, "CHUNK_MASK", ((1 << 12) - 1) << 52)
+    return chunkstore
+
+
+def restore(dest, name, target):
+    with Catalog(dest) as catalog:
+        catalog.sync()
+        rows = catalog.tree(catalog.find_version(name))
+    extract_members(dest, rows.values(), target)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src = tmp_path / "src"
+    dest = tmp_path / "dest"
+    src.mkdir()
+    dest.mkdir()
+    return src, dest
+
+
+def test_cut_points_follow_the_content(small_chunks):
+    data = os.urandom(300 * 1024)
+    shifted = data[:1000] + b"inserted" + data[1000:]
+
+    def chunks(blob):
+        buf = memoryview(blob)
+        out = []
+        while buf:
+            cut = small_chunks.find_chunk_cut(bytes(buf), True)
+            out.append(bytes(buf[:cut]))
+            buf = buf[cut:]
+        return out
+
+    before, after = chunks(data), chunks(shifted)
+    assert b"".join(after) == shifted
+    assert all(4 * 1024 <= len(chunk) <= 64 * 1024 for chunk in before[:-1])
+    # Only the chunk holding the insert differs.
+    assert len(set(before) - set(after)) == 1
+
+
+@pytest.mark.skipif(chunkstore.numpy is None, reason="needs numpy")
+def test_numpy_scan_finds_the_python_cut_points(small_chunks, monkeypatch):
+    # A short step, so the scan crosses several numpy passes.
+    monkeypatch.setattr(chunkstore, "GEAR_SCAN_STEP", 1000)
+    data = os.urandom(200 * 1024)
+    start = chunkstore.GEAR_WINDOW
+    while True:
+        cut = chunkstore.gear_scan_python(data, start, len(data))
+        assert chunkstore.gear_scan_numpy(data, start, len(data)) == cut
+        if cut is None:
+            break
+        start = cut + chunkstore.GEAR_WINDOW
+    assert start > 10 * chunkstore.GEAR_WINDOW
+
+
+def test_workers_store_the_same_version(small_chunks, tmp_path):
+    src = tmp_path / "src"
+    write_tree(src, {f"d{i % 3}/f{i}.bin": os.urandom(i * 3000) for i in range(20)})
+    versions = []
+    for workers in (1, 4):
+        store = small_chunks.ChunkStore(tmp_path / f"dest{workers}", workers=workers)
+        store.backup(src, "v1")
+        versions.append(store.load_version("v1")["files"])
+    assert {path: record["chunks"] for path, record in versions[0].items()} == {
+        path: record["chunks"] for path, record in versions[1].items()}
+
+
+def test_shifted_file_stores_only_new_chunks(small_chunks, dirs, tmp_path):
+    src, dest = dirs
+    store = small_chunks.ChunkStore(dest)
+    data = os.urandom(400 * 1024)
+    write_tree(src, {"big.bin": data, "small.txt": b"small"})
+    first = store.backup(src, "v1")
+    assert first["changed"] == 2 and first["new_bytes"] >= len(data)
+
+    write_tree(src, {"big.bin": data[:5000] + b"inserted" + data[5000:]})
+    second = store.backup(src, "v2")
+    assert second["changed"] == 1
+    assert second["new_bytes"] < len(data) // 5
+
+    state = read_tree(src)
+    restore(dest, "v2", tmp_path / "v2")
+    assert read_tree(tmp_path / "v2") == state
+    restore(dest, "v1", tmp_path / "v1")
+    assert read_tree(tmp_path / "v1")["big.bin"] == data
+
+
+def test_unchanged_source_makes_no_version(small_chunks, dirs):
+    src, dest = dirs
+    store = small_chunks.ChunkStore(dest)
+    write_tree(src, {"a.txt": b"a"})
+    assert store.backup(src, "v1")
+    assert store.backup(src, "v2") is None
+    assert [version["name"] for version in store.list_versions()] == ["v1"]
+
+
+def test_removing_versions_collects_unreferenced_chunks(small_chunks, dirs, tmp_path):
+    src, dest = dirs
+    store = small_chunks.ChunkStore(dest)
+    shared = os.urandom(100 * 1024)
+    write_tree(src, {"shared.bin": shared, "gone.bin": os.urandom(100 * 1024)})
+    store.backup(src, "v1")
+    (src / "gone.bin").unlink()
+    write_tree(src, {"new.bin": os.urandom(50 * 1024)})
+    store.backup(src, "v2")
+    before = {path.name: path.stat().st_size for path in store.chunks_dir.glob("*/*")}
+
+    freed = store.remove_versions(["v1"])
+    assert [version["name"] for version in store.list_versions()] == ["v2"]
+    assert not (store.versions_dir / "v1.json").exists()
+    after = set(path.name for path in store.chunks_dir.glob("*/*"))
+    assert after < set(before)
+    assert freed == sum(size for name, size in before.items() if name not in after)
+    referenced = {digest for record in store.load_version("v2")["files"].values() for digest in record["chunks"]}
+    assert after == referenced
+    restore(dest, "v2", tmp_path / "v2")
+    assert read_tree(tmp_path / "v2") == read_tree(src)
+    assert store.remove_versions([]) == 0
+
+
+def test_damaged_chunk_is_detected(small_chunks, dirs):
+    src, dest = dirs
+    store = small_chunks.ChunkStore(dest)
+    write_tree(src, {"a.bin": os.urandom(20 * 1024)})
+    store.backup(src, "v1")
+    digest = store.load_version("v1")["files"]["a.bin"]["chunks"][0]
+    path = store.chunk_path(digest)
+    path.write_bytes(path.read_bytes()[:-1] + b"!")
+    with pytest.raises(Exception, match="Corrupt chunk"):
+        store.get_chunk(digest)
@@ -0,0 +1,57 @@
+import json
+
+from filevault.cli import main
+
+
+def cli(vault, capsys, *argv, settings=None):
+    path = vault.dest.parent / "settings.json"
+    path.write_text(json.dumps(settings or {}))
+    code = main(["--settings", str(path), "--source", str(vault.src), "--dest", str(vault.dest), *argv])
+    out, err = capsys.readouterr()
+    return code, out, err
+
+
+def test_run_list_and_restore(vault, capsys):
+    vault.write("a.txt", b"a")
+    vault.write("sub/b.txt", b"b")
+    code, out, _ = cli(vault, capsys, "run", "--codec", "lzma")
+    assert code == 0 and "(full, 2 changed, 0 deleted)" in out
+    name = out.split()[0]
+
+    code, out, _ = cli(vault, capsys, "list")
+    assert code == 0 and out.split()[:2] == [name, "full"]
+
+    code, out, _ = cli(vault, capsys, "restore", str(vault.restored), "--version", name)
+    assert (code, out) == (0, f"Restored 2 files to {vault.restored}.\n")
+    assert vault.matches(vault.restored)
+
+
+def test_prune_applies_the_retention_setting(vault, capsys):
+    vault.write("a.txt", b"a")
+    first = vault.run()
+    vault.write("a.txt", b"a2")
+    second = vault.run()
+    code, out, _ = cli(vault, capsys, "prune", settings={"max_backups": 1})
+    assert (code, out) == (0, f"Deleted {first['name']}\n")
+    assert [path.name for path in vault.dest.glob("backup_*.zip")] == [second["name"]]
+
+
+def test_errors_are_reported_with_a_nonzero_exit(vault, capsys):
+    code, _, err = cli(vault, capsys, "restore", str(vault.restored), "--version", "backup_missing.zip")
+    assert code == 1 and err.startswith("Error: ")
+
+
+def test_jobs_are_listed_and_selected_by_name(vault, capsys, tmp_path):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "d.txt").write_bytes(b"d")
+    (tmp_path / "docs_dest").mkdir()
+    jobs = [{"name": "docs", "source_dir": str(tmp_path / "docs"), "dest_dir": str(tmp_path / "docs_dest"),
+             "cron": "0 3 * * *"}]
+    code, out, _ = cli(vault, capsys, "jobs", settings={"jobs": jobs})
+    assert code == 0
+    assert [line.split()[:2] for line in out.splitlines()] == [["default", "None"], ["docs", "cron"]]
+
+    path = vault.dest.parent / "settings.json"
+    assert main(["--settings", str(path), "--job", "docs", "run"]) == 0
+    assert len(list((tmp_path / "docs_dest").glob("backup_*.zip"))) == 1
+    assert main(["--settings", str(path), "--job", "missing", "run"]) == 1
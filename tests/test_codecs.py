@@ -0,0 +1,49 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from filevault.compression import CODEC_METHODS, COMPRESS_BLOCK_SIZE, CodecPolicy
+
+
+def test_policy_stores_known_compressed_and_incompressible_files(tmp_path):
+    policy = CodecPolicy("deflate", 6)
+    photo = tmp_path / "photo.JPG"
+    photo.write_bytes(b"x" * 100)
+    noise = tmp_path / "noise.dat"
+    noise.write_bytes(os.urandom(COMPRESS_BLOCK_SIZE + 1))
+    text = tmp_path / "notes.txt"
+    text.write_bytes(b"a" * (COMPRESS_BLOCK_SIZE + 1))
+    assert policy.choose(photo, 100) == (zipfile.ZIP_STORED, "extension")
+    assert policy.choose(noise, noise.stat().st_size) == (zipfile.ZIP_STORED, "probe")
+    assert policy.choose(text, text.stat().st_size) == (zipfile.ZIP_DEFLATED, None)
+    assert CodecPolicy("store").choose(text, 10) == (zipfile.ZIP_STORED, "policy")
+    with pytest.raises(ValueError):
+        CodecPolicy("zstd")
+
+
+@pytest.mark.parametrize("codec", ["store", "deflate", "bzip2", "lzma"])
+def test_every_codec_round_trips(archive, codec):
+    block = COMPRESS_BLOCK_SIZE
+    files = {
+        "small.txt": b"small text " * 100,
+        # Several blocks: bzip2 and lzma spool the whole file on one worker.
+        "large.txt": b"".join(b"line %d\n" % i for i in range(block // 3)),
+        "photo.png": b"\x89PNG" + os.urandom(1000),
+    }
+    data, _, stats = archive(files, policy=CodecPolicy(codec, 6))
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert zipf.testzip() is None
+        for arcname, content in files.items():
+            assert zipf.read(arcname) == content
+        methods = {info.filename: info.compress_type for info in zipf.infolist()}
+    assert methods["large.txt"] == CODEC_METHODS[codec]
+    assert methods["photo.png"] == zipfile.ZIP_STORED
+    if codec == "store":
+        assert stats == {"store": {"files": 3, "bytes_in": sum(map(len, files.values())),
+                                   "bytes_out": sum(map(len, files.values()))}}
+    else:
+        assert stats["store (extension)"]["files"] == 1
+        assert stats[codec]["files"] == 2
+        assert stats[codec]["bytes_out"] < stats[codec]["bytes_in"]
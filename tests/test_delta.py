@@ -0,0 +1,173 @@
+import hashlib
+import io
+import os
+import shutil
+import struct
+
+import pytest
+
+from filevault.browse import VersionTree
+from filevault.catalog import CATALOG_FILE_NAME
+from filevault.delta import PATCH_MAGIC_V1, DELTA_PREFIX, DeltaEncoder, PatchWriter, apply_patch, read_patch_header
+from filevault.throttle import Throttle
+
+BLOCK = 4096
+
+
+def patch_bytes(ops, target):
+    # A patch whose header describes `target`.
+    out = io.BytesIO()
+    patch = PatchWriter(out)
+    for op in ops:
+        if isinstance(op, bytes):
+            patch.add_literal(op)
+        else:
+            patch.add_copy(*op)
+    patch.close(len(target), hashlib.sha256(target).hexdigest())
+    return out.getvalue()
+
+
+def test_patch_copies_and_literals(tmp_path):
+    base = tmp_path / "base"
+    base.write_bytes(b"0123456789")
+    target = tmp_path / "target"
+    data = patch_bytes([(0, 4), (4, 2), b"xy", (8, 2)], b"012345xy89")
+    # The two adjacent copies are merged into one record.
+    assert data.count(b"C") == 2
+    apply_patch(base, [data[:7], data[7:]], target)
+    assert target.read_bytes() == b"012345xy89"
+    assert read_patch_header(io.BytesIO(data).read) == (10, hashlib.sha256(b"012345xy89").hexdigest())
+
+
+def test_patch_is_checked(tmp_path):
+    base = tmp_path / "base"
+    base.write_bytes(b"0123456789")
+    target = tmp_path / "target"
+    with pytest.raises(Exception, match="instead of"):
+        apply_patch(base, [patch_bytes([(0, 4)], b"01234")], target)
+    with pytest.raises(Exception, match="does not match"):
+        apply_patch(base, [patch_bytes([(0, 4)], b"0123")], target, "0" * 64)
+    # The digest in the header is checked when none is given.
+    with pytest.raises(Exception, match="does not match"):
+        apply_patch(base, [patch_bytes([(0, 4)], b"0124")], target)
+    with pytest.raises(Exception, match="shorter"):
+        apply_patch(base, [patch_bytes([(5, 20)], b"5" * 20)], target)
+    with pytest.raises(Exception, match="Not a delta patch"):
+        apply_patch(base, [b"garbage!" * 4], target)
+    with pytest.raises(Exception, match="Truncated"):
+        apply_patch(base, [patch_bytes([], b"")[:20]], target)
+
+
+def test_patches_without_a_digest_still_apply(tmp_path):
+    base = tmp_path / "base"
+    base.write_bytes(b"0123456789")
+    target = tmp_path / "target"
+    data = PATCH_MAGIC_V1 + struct.pack("<Q", 6) + b"C" + struct.pack("<QQ", 2, 4) + b"L" + struct.pack("<Q", 2) + b"ab"
+    assert read_patch_header(io.BytesIO(data).read) == (6, None)
+    apply_patch(base, [data], target)
+    assert target.read_bytes() == b"2345ab"
+
+
+def test_encoder_round_trip_with_shifted_data(tmp_path):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    path = tmp_path / "big.bin"
+    original = os.urandom(64 * BLOCK)
+    path.write_bytes(original)
+    base = tmp_path / "base.bin"
+    shutil.copy(path, base)
+
+    encoder = DeltaEncoder(dest, BLOCK, BLOCK)
+    first = {}
+    source, arcname, _, temporary = encoder.prepare(path, "big.bin", path.stat(), None, first, Throttle())
+    assert (source, arcname, temporary) == (path, "big.bin", False)
+
+    # An insert shifts everything after it off the block grid.
+    changed = original[:10 * BLOCK + 7] + b"inserted" + original[10 * BLOCK + 7:]
+    path.write_bytes(changed)
+    second = {}
+    source, arcname, st, temporary = encoder.prepare(path, "big.bin", path.stat(), first, second, Throttle())
+    try:
+        assert temporary and arcname == DELTA_PREFIX + "big.bin"
+        assert st.st_size < len(changed) // 4
+        assert second["delta_depth"] == 1
+        rebuilt = tmp_path / "rebuilt.bin"
+        with open(source, "rb") as f:
+            apply_patch(base, [f.read()], rebuilt, second["sha256"])
+        assert rebuilt.read_bytes() == changed
+    finally:
+        encoder.close()
+    assert not list(dest.glob("delta-staging-*"))
+
+
+def test_incremental_backup_stores_and_restores_patches(vault):
+    original = os.urandom(256 * BLOCK)
+    vault.write("big.bin", original)
+    vault.write("small.txt", b"small")
+    settings = {"incremental": True, "delta_min_bytes": 16 * BLOCK, "delta_block_bytes": BLOCK}
+    first = vault.run(**settings)
+
+    changed = bytearray(original)
+    changed[100 * BLOCK:100 * BLOCK + 10] = b"x" * 10
+    vault.write("big.bin", bytes(changed))
+    second = vault.run(**settings)
+    assert second["kind"] == "incremental"
+    assert second["metrics"]["delta_files"] == 1
+    assert second["metrics"]["bytes_written"] < len(original) // 4
+
+    vault.write("big.bin", bytes(changed) + b"tail")
+    third = vault.run(**settings)
+    assert third["metrics"]["delta_files"] == 1
+    assert vault.matches(vault.restore(third["name"], **settings))
+
+    restored = vault.restore(second["name"], **settings)
+    assert (restored / "big.bin").read_bytes() == bytes(changed)
+    assert (vault.restore(first["name"], **settings) / "big.bin").read_bytes() == original
+    assert [item["status"] for item in vault.engine().verify(deep=True)] == ["ok"] * 3
+
+
+def test_chains_are_rebased_and_rewrites_stored_whole(vault):
+    data = bytearray(os.urandom(64 * BLOCK))
+    vault.write("big.bin", bytes(data))
+    settings = {"incremental": True, "delta_min_bytes": 16 * BLOCK, "delta_block_bytes": BLOCK,
+                "delta_rebase_after": 2}
+    vault.run(**settings)
+    deltas = []
+    for i in range(4):
+        data[i * BLOCK] ^= 0xFF
+        vault.write("big.bin", bytes(data))
+        deltas.append(vault.run(**settings)["metrics"].get("delta_files", 0))
+    # Two patches in a row, then a full copy starts a new chain.
+    assert deltas == [1, 1, 0, 1]
+
+    vault.write("big.bin", os.urandom(64 * BLOCK))
+    rewritten = vault.run(**settings)
+    assert "delta_files" not in rewritten["metrics"]
+    assert vault.matches(vault.restore(rewritten["name"]))
+
+
+def test_rebuilt_catalog_keeps_older_patched_versions(vault):
+    # Only the newest archive's files are in the manifest table; the older
+    # patch's size and digest come from its header.
+    data = bytearray(os.urandom(64 * BLOCK))
+    vault.write("big.bin", bytes(data))
+    settings = {"incremental": True, "delta_min_bytes": 16 * BLOCK, "delta_block_bytes": BLOCK}
+    vault.run(**settings)
+    versions = []
+    for tail in (b"one", b"second tail"):
+        data[5 * BLOCK] ^= 0xFF
+        vault.write("big.bin", bytes(data) + tail)
+        result = vault.run(**settings)
+        assert result["metrics"]["delta_files"] == 1
+        versions.append((result["name"], bytes(data) + tail))
+    (vault.dest / CATALOG_FILE_NAME).unlink()
+
+    name, expected = versions[0]
+    [row] = [row for row in vault.engine().history("big.bin") if row["version"] == name]
+    assert (row["size"], row["sha256"]) == (len(expected), hashlib.sha256(expected).hexdigest())
+    tree = VersionTree(vault.dest)
+    assert tree.stat(name, "big.bin")["size"] == len(expected)
+    with tree.open(name, "big.bin") as f:
+        assert f.seek(-3, 2) == len(expected) - 3
+        assert f.read() == expected[-3:]
+    assert (vault.restore(name) / "big.bin").read_bytes() == expected
@@ -0,0 +1,89 @@
+import io
+import os
+
+import pytest
+
+from filevault.encryption import HEADER, SEGMENT_BYTES, TAG_BYTES, DecryptingReader, EncryptingWriter
+
+pytest.importorskip("cryptography")
+
+MASTER = bytes(range(32))
+SEALED = SEGMENT_BYTES + TAG_BYTES
+
+
+def encrypt(data, cipher="aes-256-gcm"):
+    out = io.BytesIO()
+    writer = EncryptingWriter(out, MASTER, cipher, workers=2)
+    # Uneven writes, so segments straddle write() calls.
+    for i in range(0, len(data), 100_000):
+        writer.write(data[i:i + 100_000])
+    writer.close()
+    return out.getvalue()
+
+
+def decrypt(sealed):
+    return io.BufferedReader(DecryptingReader(io.BytesIO(sealed), MASTER, "test.zip")).read()
+
+
+@pytest.mark.parametrize("cipher", ["aes-256-gcm", "chacha20-poly1305"])
+@pytest.mark.parametrize("size", [0, 1, SEGMENT_BYTES, 3 * SEGMENT_BYTES + 5, 40 * SEGMENT_BYTES])
+def test_round_trip(cipher, size):
+    data = os.urandom(size)
+    sealed = encrypt(data, cipher)
+    assert len(sealed) == HEADER.size + size + max(1, -(-size // SEGMENT_BYTES)) * TAG_BYTES
+    assert decrypt(sealed) == data
+
+
+def test_seek_reads_only_what_it_needs():
+    data = os.urandom(5 * SEGMENT_BYTES)
+    reader = DecryptingReader(io.BytesIO(encrypt(data)), MASTER)
+    reader.seek(3 * SEGMENT_BYTES - 10)
+    buffer = bytearray(20)
+    assert reader.readinto(buffer) == 20
+    assert bytes(buffer) == data[3 * SEGMENT_BYTES - 10:3 * SEGMENT_BYTES + 10]
+
+
+def test_truncation_at_a_segment_boundary_is_detected():
+    sealed = encrypt(os.urandom(4 * SEGMENT_BYTES + 100))
+    # Dropping the last segment leaves an inner segment at the end.
+    with pytest.raises(Exception, match="segment 3 failed authentication"):
+        decrypt(sealed[:HEADER.size + 4 * SEALED])
+    with pytest.raises(Exception, match="failed authentication"):
+        decrypt(sealed[:-1])
+    with pytest.raises(Exception, match="truncated encrypted archive"):
+        DecryptingReader(io.BytesIO(sealed[:HEADER.size + 5]), MASTER)
+
+
+def test_reordered_segments_are_detected():
+    sealed = encrypt(os.urandom(4 * SEGMENT_BYTES + 100))
+    segments = [sealed[HEADER.size + i * SEALED:HEADER.size + (i + 1) * SEALED] for i in range(5)]
+    swapped = sealed[:HEADER.size] + segments[1] + segments[0] + b"".join(segments[2:])
+    with pytest.raises(Exception, match="segment 0 failed authentication"):
+        decrypt(swapped)
+
+
+def test_tampered_header_or_wrong_key_is_detected():
+    sealed = bytearray(encrypt(os.urandom(1000)))
+    with pytest.raises(Exception, match="failed authentication"):
+        io.BufferedReader(DecryptingReader(io.BytesIO(bytes(sealed)), bytes(32))).read()
+    sealed[HEADER.size - 1] ^= 1
+    with pytest.raises(Exception, match="failed authentication"):
+        decrypt(bytes(sealed))
+
+
+def test_encrypted_backup_round_trips_and_verifies(vault, tmp_path):
+    key_file = tmp_path / "backup.key"
+    key_file.write_bytes(os.urandom(32))
+    vault.write("a.bin", os.urandom(3 * SEGMENT_BYTES))
+    vault.write("b/c.txt", b"hello")
+    settings = {"encryption": "aes-256-gcm", "key_file": str(key_file)}
+    result = vault.run(**settings)
+    archive = vault.dest / result["name"]
+    assert b"hello" not in archive.read_bytes()
+    assert vault.matches(vault.restore(result["name"], **settings))
+    assert [item["status"] for item in vault.engine(**settings).verify(deep=True)] == ["ok"]
+
+    archive.write_bytes(archive.read_bytes()[:-TAG_BYTES - 1])
+    [item] = vault.engine(**settings).verify()
+    assert item["status"] == "corrupt"
+    assert "failed authentication" in item["errors"][0]
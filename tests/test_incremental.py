@@ -0,0 +1,97 @@
+import os
+import zipfile
+
+import pytest
+
+from filevault.manifest import BackupManifest
+from tests.helpers import read_tree
+
+
+def members(vault, name):
+    with zipfile.ZipFile(vault.dest / name) as zipf:
+        return sorted(zipf.namelist())
+
+
+def test_incrementals_hold_only_changes_and_restore_every_version(vault):
+    vault.write("a.txt", b"a1")
+    vault.write("b.txt", b"b1")
+    vault.write("sub/c.txt", b"c1")
+    first = vault.run(incremental=True)
+    assert first["kind"] == "full"
+    states = {first["name"]: read_tree(vault.src)}
+
+    vault.write("a.txt", b"a2 changed")
+    vault.write("sub/d.txt", b"d1")
+    (vault.src / "b.txt").unlink()
+    second = vault.run(incremental=True)
+    assert (second["kind"], second["changed"], second["deleted"]) == ("incremental", 2, 1)
+    assert members(vault, second["name"]) == ["a.txt", "sub/d.txt"]
+    states[second["name"]] = read_tree(vault.src)
+
+    (vault.src / "sub" / "c.txt").unlink()
+    vault.write("b.txt", b"b returns")
+    third = vault.run(incremental=True)
+    assert members(vault, third["name"]) == ["b.txt"]
+    states[third["name"]] = read_tree(vault.src)
+
+    manifest = BackupManifest(vault.dest).load()
+    assert [(record["kind"], record["base"], record["deleted"]) for record in manifest.archives] == [
+        ("full", first["name"], []), ("incremental", first["name"], ["b.txt"]),
+        ("incremental", first["name"], ["sub/c.txt"])]
+    # The middle version first: it needs the full backup and one incremental.
+    for name in (second["name"], first["name"], third["name"]):
+        assert read_tree(vault.restore(name)) == states[name]
+
+
+def test_unchanged_run_writes_no_archive(vault):
+    vault.write("a.txt", b"a")
+    first = vault.run(incremental=True)
+    result = vault.run(incremental=True)
+    assert (result["status"], result["name"]) == ("no_changes", None)
+    assert [path.name for path in vault.dest.glob("*.zip")] == [first["name"]]
+
+
+def test_touched_but_identical_file_is_not_archived(vault):
+    vault.write("a.txt", b"same")
+    vault.write("b.txt", b"b")
+    vault.run(incremental=True)
+    st = (vault.src / "a.txt").stat()
+    os.utime(vault.src / "a.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 5_000_000_000))
+    vault.write("b.txt", b"b2")
+    assert members(vault, vault.run(incremental=True)["name"]) == ["b.txt"]
+
+
+def test_full_backup_every_n_runs_and_on_a_new_source(vault, tmp_path):
+    kinds = []
+    for i in range(4):
+        vault.write("a.txt", str(i).encode())
+        kinds.append(vault.run(incremental=True, full_every=3)["kind"])
+    assert kinds == ["full", "incremental", "incremental", "full"]
+    assert vault.run(incremental=False)["kind"] == "full"
+
+    manifest = BackupManifest(vault.dest).load()
+    assert manifest.needs_full_backup(tmp_path / "elsewhere", 3)
+    assert not manifest.needs_full_backup(vault.src, 0)
+
+
+def test_missing_archive_in_chain_fails_restore(vault):
+    vault.write("a.txt", b"a")
+    vault.write("b.txt", b"only in the full backup")
+    first = vault.run(incremental=True)
+    vault.write("a.txt", b"a2")
+    second = vault.run(incremental=True)
+    (vault.dest / first["name"]).unlink()
+    with pytest.raises(Exception, match="Missing archive"):
+        vault.restore(second["name"])
+
+
+def test_back_to_back_runs_never_share_a_name(vault):
+    states = {}
+    for storage in ("Zip Archives", "Chunk Store"):
+        for i in range(2):
+            vault.write("a.txt", f"{storage} {i}".encode())
+            states[vault.run(storage=storage)["name"]] = read_tree(vault.src)
+    assert len(states) == 4
+    assert len(list(vault.dest.glob("backup_*.zip"))) == 2
+    for name, state in states.items():
+        assert read_tree(vault.restore(name)) == state
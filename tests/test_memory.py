@@ -0,0 +1,87 @@
+import io
+import random
+import zipfile
+
+import pytest
+
+from filevault import compression
+from filevault.compression import CodecPolicy, ParallelArchiver
+from filevault.memory import BufferPool, read_blocks, validate_memory
+from filevault.zipwriter import ZipStreamWriter
+
+BLOCK = 4096
+
+
+def test_buffer_pool_hands_released_buffers_out_again():
+    pool = BufferPool(BLOCK)
+    first, second = pool.acquire(), pool.acquire()
+    assert first is not second and len(first) == BLOCK
+    pool.release(first)
+    assert pool.acquire() is first
+    assert len(pool.acquire()) == BLOCK and not pool.free
+
+
+@pytest.mark.parametrize("drop", [False, True])
+def test_read_blocks_reads_into_the_one_buffer(tmp_path, drop):
+    data = random.Random(1).randbytes(10 * BLOCK + 17)
+    path = tmp_path / "a.bin"
+    path.write_bytes(data)
+    buffer = bytearray(BLOCK)
+    out = bytearray()
+    for block in read_blocks(path, buffer, drop):
+        assert block.obj is buffer
+        out += block
+    assert out == data
+
+
+def test_archiver_stays_within_its_memory_limit_and_reuses_buffers(monkeypatch, tmp_path):
+    monkeypatch.setattr(compression, "COMPRESS_BLOCK_SIZE", BLOCK)
+    files = {"big.bin": random.Random(2).randbytes(60 * BLOCK + 5), "text.txt": b"text " * 30000,
+             "small.txt": b"small"}
+    out = io.BytesIO()
+    writer = ZipStreamWriter(out)
+    limit = 6 * BLOCK
+    archiver = ParallelArchiver(writer, 4, CodecPolicy("deflate"), memory_limit=limit)
+    for arcname, data in files.items():
+        path = tmp_path / arcname
+        path.write_bytes(data)
+        archiver.add_file(path, arcname, path.stat())
+    archiver.finish()
+    writer.close()
+    # Blocks take twice their size (raw and compressed) while in flight.
+    assert 0 < archiver.peak_inflight_bytes <= limit
+    # Every pooled buffer is back in the pool, and only as many were ever
+    # allocated as fit in the limit at once.
+    assert 0 < len(archiver.buffers.free) <= limit // (2 * BLOCK)
+    assert archiver.inflight_bytes == 0
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zipf:
+        assert {name: zipf.read(name) for name in zipf.namelist()} == files
+
+
+def test_a_block_larger_than_the_limit_still_runs(monkeypatch, tmp_path):
+    monkeypatch.setattr(compression, "COMPRESS_BLOCK_SIZE", BLOCK)
+    path = tmp_path / "a.bin"
+    path.write_bytes(b"a" * 5 * BLOCK)
+    out = io.BytesIO()
+    writer = ZipStreamWriter(out)
+    archiver = ParallelArchiver(writer, 2, memory_limit=1)
+    archiver.add_file(path, "a.bin", path.stat())
+    archiver.finish()
+    writer.close()
+    assert archiver.peak_inflight_bytes == 2 * BLOCK
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zipf:
+        assert zipf.read("a.bin") == b"a" * 5 * BLOCK
+
+
+def test_run_records_its_peak_buffered_bytes(vault):
+    vault.write("a.bin", random.Random(3).randbytes(3 * compression.COMPRESS_BLOCK_SIZE))
+    limit = 4 * compression.COMPRESS_BLOCK_SIZE
+    result = vault.run(memory_limit_bytes=limit)
+    assert 0 < result["metrics"]["peak_buffered_bytes"] <= limit
+    assert vault.matches(vault.restore(result["name"]))
+
+
+@pytest.mark.parametrize("limit", [0, -1, "1M", 1.5])
+def test_invalid_memory_limit(limit):
+    with pytest.raises(ValueError, match="memory_limit_bytes"):
+        validate_memory({"memory_limit_bytes": limit})
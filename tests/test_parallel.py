@@ -0,0 +1,38 @@
+import hashlib
+import io
+import os
+import zipfile
+
+from filevault.compression import COMPRESS_BLOCK_SIZE
+
+
+def test_entries_keep_submission_order_and_content(archive):
+    block = COMPRESS_BLOCK_SIZE
+    files = {
+        "text.txt": b"hello world\n" * 50_000,
+        "random.bin": os.urandom(block // 3),
+        "multi/block.bin": os.urandom(block) + b"z" * (block + 123),
+        "empty": b"",
+        "ünïcode.txt": b"name",
+    }
+    data, digests, _ = archive(files)
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == list(files)
+        for arcname, content in files.items():
+            assert zipf.read(arcname) == content
+        infos = {info.filename: info for info in zipf.infolist()}
+    assert infos["text.txt"].compress_type == zipfile.ZIP_DEFLATED
+    assert infos["text.txt"].compress_size < len(files["text.txt"]) // 10
+    # A block that does not shrink is stored as it is.
+    assert infos["random.bin"].compress_type == zipfile.ZIP_STORED
+    assert digests == {arcname: hashlib.sha256(content).hexdigest() for arcname, content in files.items()}
+
+
+def test_many_small_files_with_one_worker(archive):
+    files = {f"d/{i:04}.txt": str(i).encode() * (i % 7) for i in range(300)}
+    data, digests, _ = archive(files, workers=1)
+    with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+        assert zipf.namelist() == list(files)
+        assert zipf.testzip() is None
+    assert len(digests) == 300
@@ -0,0 +1,56 @@
+from filevault.engine import BackupEngine
+from filevault.progress import EventQueue, ProgressMeter, describe_progress, format_duration
+
+
+def test_meter_rate_limits_but_always_publishes_the_end():
+    snapshots = []
+    meter = ProgressMeter(snapshots.append, interval=60)
+    meter(1, 4, "a.txt", 100)
+    meter(2, 4, "b.txt", 200)
+    meter(3, 4, "c.txt", 300)
+    meter(4, 4, None, 400)
+    assert [(s["files"], s["total"], s["path"], s["bytes"]) for s in snapshots] == [
+        (1, 4, "a.txt", 100), (4, 4, None, 400)]
+    assert snapshots[1]["eta"] == 0 and snapshots[1]["bytes_per_s"] > 0
+
+    snapshots.clear()
+    meter = ProgressMeter(snapshots.append, interval=0)
+    meter(0, 4)
+    meter(1, 4)
+    assert snapshots[0]["eta"] is None and snapshots[1]["eta"] >= 0
+
+
+def test_queued_progress_is_replaced_by_the_next_one():
+    events = EventQueue()
+    events.put("a", "started")
+    events.put("a", "progress", 1)
+    events.put("a", "progress", 2)
+    events.put("b", "progress", 1)
+    events.put("a", "progress", 3)
+    events.put("a", "progress", 4)
+    events.put("a", "finished", "done")
+    assert events.drain() == [("a", "started", None), ("a", "progress", 2), ("b", "progress", 1),
+                              ("a", "progress", 4), ("a", "finished", "done")]
+    assert events.drain() == []
+
+
+def test_describe_progress():
+    snapshot = {"files": 5, "total": 10, "bytes": 12_500_000, "bytes_per_s": 2_500_000, "eta": 3725}
+    assert describe_progress(snapshot) == "5/10 files, 12.5 MB at 2.5 MB/s, ETA 01:02:05"
+    assert describe_progress(dict(snapshot, files=10, bytes_per_s=None)) == "10/10 files, 12.5 MB"
+    assert format_duration(59.9) == "00:00:59"
+
+
+def test_engine_reports_paths_and_bytes(vault):
+    for i in range(25):
+        vault.write(f"d/f{i:02}.txt", b"x" * i)
+    calls = []
+    BackupEngine(vault.settings(), lambda *args: calls.append(args)).run()
+    assert [call[0] for call in calls] == [10, 20, 25]
+    # The walk is in directory order: the tenth file is any of them.
+    assert calls[0][2].startswith("d/f") and 0 < calls[0][3] < sum(range(25))
+    assert calls[-1] == (25, 25, None, sum(range(25)))
+
+    calls.clear()
+    vault.engine().restore(None, vault.restored, lambda *args: calls.append(args))
+    assert calls[-1][0::3] == (25, sum(range(25)))
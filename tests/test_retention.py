@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from filevault.catalog import Catalog
+from filevault.retention import plan_retention, select_versions
+
+
+def version(name, created, base=None, kind="full", size=100):
+    kind = kind if base is None or base == name else "incremental"
+    return {"name": name, "created": created.timestamp(), "base": base or name, "kind": kind, "bytes": size}
+
+
+def every_six_hours(start, end):
+    versions = []
+    when = start
+    while when <= end:
+        versions.append(version(when.strftime("%m-%d %H"), when))
+        when += timedelta(hours=6)
+    return versions
+
+
+def kept(versions, settings, free_bytes=None):
+    doomed = {version["name"] for version in plan_retention(versions, settings, free_bytes)}
+    return [version["name"] for version in versions if version["name"] not in doomed]
+
+
+def test_gfs_buckets_cross_day_week_and_month_boundaries():
+    # 2026-02-09 is the Monday starting ISO week 7; 01-31 closes January.
+    versions = every_six_hours(datetime(2026, 1, 28), datetime(2026, 2, 10, 18))
+    assert sorted(select_versions(versions, retention={"hourly": 2})) == ["02-10 12", "02-10 18"]
+    assert sorted(select_versions(versions, retention={"daily": 3})) == ["02-08 18", "02-09 18", "02-10 18"]
+    assert sorted(select_versions(versions, retention={"weekly": 3})) == ["02-01 18", "02-08 18", "02-10 18"]
+    assert sorted(select_versions(versions, retention={"monthly": 2})) == ["01-31 18", "02-10 18"]
+    assert kept(versions, {"max_backups": 2, "retention": {"daily": 2, "monthly": 3}}) == [
+        "01-31 18", "02-09 18", "02-10 12", "02-10 18"]
+
+
+def test_buckets_without_versions_are_skipped():
+    versions = [version("jan", datetime(2026, 1, 5)), version("apr", datetime(2026, 4, 5)),
+                version("apr2", datetime(2026, 4, 6)), version("may", datetime(2026, 5, 5))]
+    assert kept(versions, {"retention": {"monthly": 3}}) == ["jan", "apr2", "may"]
+
+
+def test_no_rule_keeps_everything_and_unknown_rules_fail():
+    versions = every_six_hours(datetime(2026, 1, 1), datetime(2026, 1, 2))
+    assert plan_retention(versions, {"max_backups": 0, "retention": {"daily": 0}}) == []
+    assert plan_retention([], {"max_backups": 1}) == []
+    with pytest.raises(ValueError, match="Unknown retention rule"):
+        plan_retention(versions, {"retention": {"yearly": 1}})
+
+
+def chains():
+    # Three chains of one full backup and its incrementals, oldest first.
+    day = datetime(2026, 3, 1)
+    versions = []
+    for i, (base, length) in enumerate([("a", 3), ("b", 2), ("c", 2)]):
+        for j in range(length):
+            versions.append(version(f"{base}{j}", day + timedelta(days=i, hours=j), f"{base}0"))
+    return versions
+
+
+def test_kept_incrementals_keep_their_whole_chain():
+    versions = chains()
+    assert kept(versions, {"max_backups": 1}) == ["c0", "c1"]
+    assert kept(versions, {"max_backups": 3}) == ["b0", "b1", "c0", "c1"]
+    assert kept(versions, {"max_backups": 5}) == ["a0", "a1", "a2", "b0", "b1", "c0", "c1"]
+
+
+def test_space_limits_drop_whole_chains_oldest_first():
+    versions = chains()
+    # 700 bytes kept; dropping chain "a" alone brings it to 400.
+    assert kept(versions, {"max_backups": 5, "max_total_bytes": 450}) == ["b0", "b1", "c0", "c1"]
+    assert kept(versions, {"max_backups": 5, "min_free_bytes": 250}, free_bytes=50) == ["b0", "b1", "c0", "c1"]
+    assert kept(versions, {"max_backups": 5, "min_free_bytes": 250}, free_bytes=250) == [v["name"] for v in versions]
+
+
+def test_newest_chain_is_never_dropped():
+    versions = chains()
+    assert kept(versions, {"max_total_bytes": 0}) == ["c0", "c1"]
+    assert kept(versions, {"max_backups": 1, "min_free_bytes": 10 ** 12}, free_bytes=0) == ["c0", "c1"]
+    # One chain of each storage kind survives.
+    versions.insert(1, version("chunks", datetime(2026, 3, 1, 0, 30), kind="chunk store"))
+    assert kept(versions, {"max_total_bytes": 0}) == ["chunks", "c0", "c1"]
+
+
+def test_runs_prune_in_the_background_from_the_catalog(vault):
+    names = []
+    for i in range(4):
+        vault.write("a.txt", str(i).encode() * 100)
+        names.append(vault.run(incremental=True, full_every=2, max_backups=1)["name"])
+    # The last run is an incremental on the third run's full backup.
+    assert sorted(path.name for path in vault.dest.glob("backup_*.zip")) == sorted(names[2:])
+    with Catalog(vault.dest) as catalog:
+        assert [row["name"] for row in catalog.versions()] == names[2:]
+        assert all(row["bytes"] == (vault.dest / row["name"]).stat().st_size for row in catalog.versions())
+    assert vault.engine(max_backups=1).enforce_rotation() == []
@@ -0,0 +1,129 @@
+import os
+import time
+
+import pytest
+
+from filevault.rules import IGNORE_FILE_NAME, RuleSet, SourceRules, translate_pattern, validate_rules
+from filevault.scanner import TreeScanner
+from tests.helpers import read_tree, write_tree
+
+
+def test_blank_and_comment_lines_are_skipped():
+    assert translate_pattern("") is None
+    assert translate_pattern("# comment") is None
+    assert translate_pattern("/") is None
+
+
+def test_unanchored_pattern_matches_at_any_depth():
+    rules = RuleSet(["*.tmp"])
+    assert rules.match("a.tmp", False)
+    assert rules.match("deep/down/a.tmp", False)
+    assert rules.match("a.tmpx", False) is None
+
+
+def test_anchored_pattern_and_double_star():
+    rules = RuleSet(["/build", "docs/**/*.pdf"])
+    assert rules.match("build", True)
+    assert rules.match("src/build", True) is None
+    assert rules.match("docs/a.pdf", False)
+    assert rules.match("docs/x/y/a.pdf", False)
+    assert rules.match("other/docs/a.pdf", False) is None
+
+
+def test_star_does_not_cross_directories():
+    rules = RuleSet(["logs/*.log"])
+    assert rules.match("logs/a.log", False)
+    assert rules.match("logs/old/a.log", False) is None
+
+
+def test_last_matching_rule_wins():
+    rules = RuleSet(["*.log", "!keep.log"])
+    assert rules.match("drop.log", False) is True
+    assert rules.match("keep.log", False) is False
+    assert RuleSet(["!keep.log", "*.log"]).match("keep.log", False) is True
+
+
+def test_directory_only_pattern_skips_files():
+    rules = RuleSet(["cache/"])
+    assert rules.match("cache", True)
+    assert rules.match("cache", False) is None
+
+
+def test_invalid_range_is_dropped():
+    rules = RuleSet(["[z-a]", "*.bak"])
+    assert rules.match("a.bak", False)
+
+
+def test_ignore_file_applies_below_its_directory(tmp_path):
+    (tmp_path / "project").mkdir()
+    (tmp_path / "project" / IGNORE_FILE_NAME).write_text("*.o\n!main.o\n")
+    rules = SourceRules(tmp_path, {"exclude": ["*.o", "node_modules/"]})
+    assert rules.excludes_path("a.o", False)
+    assert rules.excludes_path("project/a.o", False)
+    assert not rules.excludes_path("project/main.o", False)
+    assert rules.excludes_path("main.o", False)
+    assert rules.excludes_path("project/node_modules", True)
+    assert rules.excludes_path("node_modules/pkg/index.js", False)
+
+
+def test_include_and_size_limits(tmp_path):
+    rules = SourceRules(tmp_path, {"include": ["*.txt"], "max_file_size": 10})
+    small = (tmp_path / "small.txt")
+    small.write_bytes(b"x" * 5)
+    large = (tmp_path / "large.txt")
+    large.write_bytes(b"x" * 50)
+    assert not rules.excludes_path("small.txt", False, small.stat())
+    assert rules.excludes_path("large.txt", False, large.stat())
+    assert rules.excludes_path("small.bin", False, small.stat())
+
+
+def test_age_limit(tmp_path):
+    write_tree(tmp_path, {"old.txt": b"o", "new.txt": b"n"})
+    week_ago = time.time() - 7 * 86400
+    os.utime(tmp_path / "old.txt", (week_ago, week_ago))
+    rules = SourceRules(tmp_path, {"max_age_days": 3})
+    assert rules.excludes_path("old.txt", False, (tmp_path / "old.txt").stat())
+    assert not rules.excludes_path("new.txt", False, (tmp_path / "new.txt").stat())
+
+
+def test_excluded_directories_are_never_entered(tmp_path):
+    write_tree(tmp_path, {"a.txt": b"a", "node_modules/x/y.js": b"y", "src/node_modules/z.js": b"z",
+                          f"src/{IGNORE_FILE_NAME}": b"gen/\n", "src/gen/g.c": b"g", "src/main.c": b"m"})
+    scanner = TreeScanner(tmp_path, SourceRules(tmp_path, {"exclude": ["node_modules/"]}))
+    assert sorted(arcname for arcname, _ in scanner) == ["a.txt", f"src/{IGNORE_FILE_NAME}", "src/main.c"]
+    assert scanner.excluded == 3
+
+
+@pytest.mark.parametrize("settings, message", [
+    ({"exclude": ["[z-a]"]}, "Invalid exclude pattern"),
+    ({"max_file_size": -1}, "non-negative"),
+    ({"max_age_days": "week"}, "non-negative"),
+])
+def test_invalid_rules_are_refused(settings, message):
+    with pytest.raises(ValueError, match=message):
+        validate_rules(settings)
+
+
+def test_backup_leaves_excluded_files_out(vault):
+    vault.write("keep/a.txt", b"a")
+    vault.write("keep/b.tmp", b"b")
+    vault.write("cache/c.txt", b"c")
+    vault.write(f"keep/{IGNORE_FILE_NAME}", b"a.txt\n")
+    result = vault.run(exclude=["*.tmp", "cache/"])
+    assert read_tree(vault.restore(result["name"])) == {f"keep/{IGNORE_FILE_NAME}": b"a.txt\n"}
+
+
+def test_newly_excluded_files_count_as_deleted(vault):
+    vault.write("a.txt", b"a")
+    vault.write("b.log", b"b")
+    vault.run(incremental=True)
+    result = vault.run(incremental=True, exclude=["*.log"])
+    assert (result["kind"], result["changed"], result["deleted"]) == ("incremental", 0, 1)
+    assert read_tree(vault.restore(result["name"])) == {"a.txt": b"a"}
+
+
+def test_chunk_store_applies_the_rules(vault):
+    vault.write("a.txt", b"a")
+    vault.write("big.bin", b"x" * 1000)
+    result = vault.run(storage="Chunk Store", max_file_size=100)
+    assert read_tree(vault.restore(result["name"])) == {"a.txt": b"a"}
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from filevault.runlog import RUN_LOG_FILE_NAME, RunLog, flatten_record, trend
+
+
+def test_records_filter_by_type_and_time(tmp_path):
+    run_log = RunLog(tmp_path)
+    run_log.append({"type": "run", "time": "2026-03-01T10:00:00", "n": 1})
+    run_log.warn("disk nearly full")
+    run_log.append({"type": "run", "time": "2026-03-02T10:00:00", "n": 2})
+    # A torn last line from an interrupted append is skipped.
+    with open(tmp_path / RUN_LOG_FILE_NAME, "a") as f:
+        f.write('{"type": "run", "ti')
+
+    assert [record["type"] for record in run_log.records()] == ["run", "warning", "run"]
+    assert [record["n"] for record in run_log.records("run")] == [1, 2]
+    assert [record["n"] for record in run_log.records("run", since=datetime(2026, 3, 2))] == [2]
+    assert [record["n"] for record in run_log.records("run", until=datetime(2026, 3, 2))] == [1]
+    assert [record["message"] for record in run_log.records("warning")] == ["disk nearly full"]
+    assert list(RunLog(tmp_path / "elsewhere").records()) == []
+
+
+def test_export_as_json_lines_and_flattened_csv(tmp_path):
+    run_log = RunLog(tmp_path)
+    run_log.append({"type": "run", "time": "2026-03-01T10:00:00", "phases": {"scan": 1.5}, "removed": ["a", "b"]})
+    run_log.append({"type": "run", "time": "2026-03-02T10:00:00", "phases": {"scan": 2, "chunk": 3}})
+    run_log.append({"type": "prune", "time": "2026-03-02T10:00:01"})
+
+    out = io.StringIO()
+    run_log.export(out, "jsonl")
+    assert [json.loads(line)["time"] for line in out.getvalue().splitlines()] == [
+        "2026-03-01T10:00:00", "2026-03-02T10:00:00"]
+
+    out = io.StringIO()
+    run_log.export(out, "csv")
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert list(rows[0]) == ["type", "time", "phases.scan", "removed", "phases.chunk"]
+    assert [(row["phases.scan"], row["removed"], row["phases.chunk"]) for row in rows] == [
+        ("1.5", "2", ""), ("2", "", "3")]
+    with pytest.raises(ValueError, match="Unknown export format"):
+        run_log.export(out, "xml")
+
+
+def test_trend_aggregates_a_numeric_field_per_period():
+    records = [{"time": "2026-02-27T10:00:00", "phases": {"scan": 1.0}},
+               {"time": "2026-02-28T10:00:00", "phases": {"scan": 3.0}},
+               {"time": "2026-03-01T10:00:00", "phases": {"scan": 5}},
+               {"time": "2026-03-01T11:00:00", "phases": {"scan": None}},
+               {"time": "2026-03-01T12:00:00", "phases": {"scan": True}}]
+    assert trend(records, "phases.scan") == [("2026-02", 2, 2.0, 1.0, 3.0), ("2026-03", 1, 5.0, 5, 5)]
+    assert [row[0] for row in trend(records, "phases.scan", "day")] == ["2026-02-27", "2026-02-28", "2026-03-01"]
+    assert [row[:2] for row in trend(records, "phases.scan", "week")] == [("2026-W09", 3)]
+    assert flatten_record({"a": {"b": {"c": 1}}, "d": [1, 2]}) == {"a.b.c": 1, "d": 2}
+
+
+def test_runs_and_prunes_are_journaled_with_metrics(vault):
+    vault.write("a.txt", b"hello " * 10000)
+    first = vault.run(incremental=True, max_backups=1)
+    assert vault.run(incremental=True, max_backups=1)["status"] == "no_changes"
+    vault.write("a.txt", b"changed")
+    second = vault.run(max_backups=1)
+    with pytest.raises(Exception, match="exited with code 3"):
+        vault.run(stream_target="cmd:cat > /dev/null; exit 3")
+
+    run_log = RunLog(vault.dest)
+    runs = list(run_log.records("run"))
+    assert [(record["status"], record.get("name")) for record in runs] == [
+        ("success", first["name"]), ("no_changes", None), ("success", second["name"]), ("failed", None)]
+    record = runs[0]
+    assert (record["kind"], record["files_scanned"], record["files_changed"], record["files_deleted"]) == (
+        "full", 1, 1, 0)
+    assert record["bytes_read"] == 60000
+    assert record["bytes_written"] > 0
+    assert record["compression_ratio"] == round(record["bytes_written"] / 60000, 4) < 0.1
+    assert set(record["phases"]) == {"scan", "compress", "wait", "write", "finish", "commit"}
+    assert record["codecs"]["deflate"]["files"] == 1
+    assert runs[3]["error"] and runs[3]["errors"] == 1
+
+    prunes = list(run_log.records("prune"))
+    assert [prune["removed"] for prune in prunes] == [[first["name"]]]
+    assert prunes[0]["freed_bytes"] > 0 and prunes[0]["errors"] == 0
+
+
+def test_chunk_store_runs_report_chunking_time(vault):
+    vault.write("a.bin", b"x" * 100000)
+    vault.run(storage="Chunk Store")
+    record = next(RunLog(vault.dest).records("run"))
+    assert (record["kind"], record["files_changed"], record["bytes_read"]) == ("chunk store", 1, 100000)
+    assert set(record["phases"]) == {"scan", "chunk", "wait", "commit"}
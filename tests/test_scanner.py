@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from filevault.engine import archive_tree
+from filevault.manifest import BackupManifest
+from filevault.scanner import TreeScanner, carry_forward
+from tests.helpers import write_tree
+
+
+def lock_directory(monkeypatch, name):
+    # Makes listing directories called `name` fail, as a permission error would.
+    scandir = os.scandir
+
+    def refuse(path):
+        if os.path.basename(path) == name:
+            raise PermissionError("denied")
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", refuse)
+
+
+def test_walk_yields_every_file_once(tmp_path):
+    files = {"a.txt": b"a", "d/b.txt": b"b", "d/e/f/c.txt": b"c", "ü/ñ.txt": b"u"}
+    write_tree(tmp_path, files)
+    (tmp_path / "empty").mkdir()
+    scanner = TreeScanner(tmp_path)
+    seen = {arcname: entry for arcname, entry in scanner}
+    assert sorted(seen) == sorted(files)
+    assert all(entry.stat().st_size == len(files[arcname]) for arcname, entry in seen.items())
+    assert scanner.errors == []
+    assert scanner.dirs_pending == 0
+    assert scanner.estimate_total() == len(files)
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+def test_directory_symlinks_are_not_followed(tmp_path):
+    write_tree(tmp_path / "src", {"real/a.txt": b"a"})
+    os.symlink(tmp_path / "src" / "real", tmp_path / "src" / "loop", target_is_directory=True)
+    assert [arcname for arcname, _ in TreeScanner(tmp_path / "src")] == ["real/a.txt"]
+
+
+def test_missing_root_is_empty(tmp_path):
+    scanner = TreeScanner(tmp_path / "missing")
+    assert list(scanner) == []
+    assert (scanner.errors, scanner.unreadable) == ([], [])
+
+
+def test_unreadable_directory_is_reported(tmp_path, monkeypatch):
+    write_tree(tmp_path, {"ok/a.txt": b"a", "locked/b.txt": b"b", "locked/deep/c.txt": b"c"})
+    lock_directory(monkeypatch, "locked")
+    scanner = TreeScanner(tmp_path)
+    assert [arcname for arcname, _ in scanner] == ["ok/a.txt"]
+    assert scanner.unreadable == ["locked"]
+    assert len(scanner.errors) == 1 and "denied" in scanner.errors[0]
+
+
+def test_carry_forward_keeps_records_under_unreadable_paths():
+    previous = {"a.txt": {"size": 1}, "locked/b.txt": {"size": 2}, "locked/deep/c.txt": {"size": 3},
+                "lockedx.txt": {"size": 4}}
+    files = {"a.txt": {"size": 5}}
+    assert carry_forward(files, previous, ["locked"]) == 2
+    assert files == {"a.txt": {"size": 5}, "locked/b.txt": {"size": 2}, "locked/deep/c.txt": {"size": 3}}
+    # "" stands for the whole tree.
+    assert carry_forward(files, previous, [""]) == 1 and "lockedx.txt" in files
+
+
+def test_incremental_run_keeps_unreadable_directories(vault, monkeypatch):
+    vault.write("ok/a.txt", b"a")
+    vault.write("locked/b.txt", b"b")
+    vault.run(incremental=True)
+    lock_directory(monkeypatch, "locked")
+    vault.write("ok/a.txt", b"a2")
+    engine = vault.engine(incremental=True)
+    name = engine.run()["name"]
+    assert any("denied" in warning for warning in engine.warnings)
+    monkeypatch.undo()
+    assert vault.matches(vault.restore(name))
+
+
+def test_estimate_prefers_the_previous_total(tmp_path):
+    write_tree(tmp_path, {f"d{i}/f.txt": b"x" for i in range(4)})
+    scanner = TreeScanner(tmp_path)
+    iterator = iter(scanner)
+    next(iterator)
+    assert scanner.estimate_total(100) == 100
+    assert scanner.estimate_total() >= scanner.files_seen
+    list(iterator)
+    assert scanner.estimate_total(2) == 4
+
+
+def test_empty_source_is_refused(tmp_path):
+    (tmp_path / "src").mkdir()
+    manifest = BackupManifest(tmp_path)
+
+    class NoArchiver:
+        def finish(self):
+            pass
+
+    with pytest.raises(Exception, match="No files to back up"):
+        archive_tree(NoArchiver(), tmp_path / "src", manifest, True)
@@ -0,0 +1,98 @@
+import queue
+from datetime import datetime
+
+import pytest
+
+from filevault.engine import DEFAULT_SETTINGS
+from filevault.scheduler import CronSchedule, JobScheduler, load_jobs, next_run_after
+
+
+@pytest.mark.parametrize("expression, now, expected", [
+    ("*/15 * * * *", datetime(2026, 3, 1, 10, 7, 30), datetime(2026, 3, 1, 10, 15)),
+    ("0 2 * * *", datetime(2026, 3, 1, 2, 0), datetime(2026, 3, 2, 2, 0)),
+    ("30 9-17/4 * * *", datetime(2026, 3, 1, 13, 30), datetime(2026, 3, 1, 17, 30)),
+    ("0 0 1 * *", datetime(2026, 12, 15, 8, 0), datetime(2027, 1, 1, 0, 0)),
+    ("0 0 31 * *", datetime(2026, 4, 1, 0, 0), datetime(2026, 5, 31, 0, 0)),
+    ("0 0 29 2 *", datetime(2026, 3, 1, 0, 0), datetime(2028, 2, 29, 0, 0)),
+    # 2026-03-01 is a Sunday; 7 means Sunday too.
+    ("0 12 * * 1-5", datetime(2026, 2, 27, 12, 0), datetime(2026, 3, 2, 12, 0)),
+    ("0 12 * * 7", datetime(2026, 2, 27, 12, 0), datetime(2026, 3, 1, 12, 0)),
+    # A restricted day-of-month and day-of-week match either one.
+    ("0 0 13 * 5", datetime(2026, 3, 1, 0, 0), datetime(2026, 3, 6, 0, 0)),
+    ("0 0 1,15 6 *", datetime(2026, 6, 1, 0, 0), datetime(2026, 6, 15, 0, 0)),
+])
+def test_cron_next_fire_time(expression, now, expected):
+    assert CronSchedule(expression).next_after(now) == expected
+
+
+@pytest.mark.parametrize("expression", [
+    "* * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *", "* * * * 8",
+    "*/0 * * * *", "5-1 * * * *", "a * * * *",
+])
+def test_invalid_cron_expressions(expression):
+    with pytest.raises(ValueError, match="Invalid cron"):
+        CronSchedule(expression)
+
+
+def test_interval_and_cron_jobs():
+    now = datetime(2026, 3, 1, 10, 7)
+    assert next_run_after({"schedule": "3 hours"}, now) == datetime(2026, 3, 1, 13, 7)
+    assert next_run_after({"schedule": "1 hour", "cron": "0 0 * * *"}, now) == datetime(2026, 3, 2)
+    assert next_run_after({"schedule": "None"}, now) is None
+
+
+def test_jobs_inherit_the_top_level_options(tmp_path):
+    settings = dict(DEFAULT_SETTINGS, source_dir=str(tmp_path / "a"), dest_dir=str(tmp_path / "a_dest"),
+                    codec="lzma", jobs=[{"name": "docs", "source_dir": str(tmp_path / "b"),
+                                         "dest_dir": str(tmp_path / "b_dest"), "cron": "0 3 * * *",
+                                         "max_backups": 2}])
+    default, docs = load_jobs(settings)
+    assert (default["name"], default["codec"], default["max_backups"]) == ("default", "lzma", 5)
+    assert (docs["name"], docs["codec"], docs["max_backups"], docs["cron"]) == ("docs", "lzma", 2, "0 3 * * *")
+    assert "jobs" not in docs
+
+
+@pytest.mark.parametrize("entry, message", [
+    ({"name": "default", "dest_dir": "other"}, "Duplicate job name"),
+    ({"name": "b", "dest_dir": "dest"}, "share the destination"),
+    ({"name": "b", "dest_dir": "other", "cron": "daily"}, "Invalid cron"),
+    ({"name": "b"}, "needs a name, source_dir and dest_dir"),
+])
+def test_invalid_jobs_are_refused(tmp_path, entry, message):
+    entry = dict({"source_dir": str(tmp_path / "b")}, **entry)
+    if "dest_dir" in entry:
+        entry["dest_dir"] = str(tmp_path / entry["dest_dir"])
+    settings = dict(DEFAULT_SETTINGS, source_dir=str(tmp_path / "a"), dest_dir=str(tmp_path / "dest"), jobs=[entry])
+    with pytest.raises(ValueError, match=message):
+        load_jobs(settings)
+
+
+def test_triggered_jobs_are_queued_once_and_all_run(tmp_path):
+    jobs = []
+    for name in ("one", "two", "three"):
+        (tmp_path / name / "src").mkdir(parents=True)
+        (tmp_path / name / "dest").mkdir()
+        (tmp_path / name / "src" / "a.txt").write_text(name)
+        jobs.append(dict(DEFAULT_SETTINGS, name=name, source_dir=str(tmp_path / name / "src"),
+                         dest_dir=str(tmp_path / name / "dest")))
+    events = queue.Queue()
+    scheduler = JobScheduler(lambda name, event, data: events.put((name, event, data)))
+    scheduler.set_limits(dict(DEFAULT_SETTINGS, max_parallel_jobs=1, max_jobs_per_device=1))
+    scheduler.set_jobs(jobs)
+    assert scheduler.trigger("one") and scheduler.trigger("two") and scheduler.trigger("three")
+    assert not scheduler.trigger("two")
+    assert not scheduler.trigger("missing")
+    assert scheduler.state("two") == "queued"
+
+    scheduler.start()
+    try:
+        finished = {}
+        while len(finished) < 3:
+            name, event, data = events.get(timeout=30)
+            assert event != "failed", data
+            if event == "finished":
+                finished[name] = data
+    finally:
+        scheduler.stop()
+    assert all(result["kind"] == "full" for result in finished.values())
+    assert all(len(list((tmp_path / name / "dest").glob("backup_*.zip"))) == 1 for name in finished)
@@ -0,0 +1,67 @@
+import socket
+import sys
+import threading
+
+import pytest
+
+from filevault.sinks import open_archive_sink
+
+
+def test_file_sink_only_appears_on_commit(tmp_path):
+    sink = open_archive_sink(tmp_path, "backup_x.zip")
+    sink.fileobj.write(b"data")
+    assert not (tmp_path / "backup_x.zip").exists()
+    assert (tmp_path / "backup_x.zip.partial").exists()
+    sink.commit()
+    assert (tmp_path / "backup_x.zip").read_bytes() == b"data"
+    assert not (tmp_path / "backup_x.zip.partial").exists()
+
+
+def test_aborted_file_sink_leaves_nothing(tmp_path):
+    sink = open_archive_sink(tmp_path, "backup_x.zip")
+    sink.fileobj.write(b"data")
+    sink.abort()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses a POSIX shell command")
+def test_command_sink_gets_the_stream_and_the_name(tmp_path):
+    sink = open_archive_sink(tmp_path, "backup_x.zip", f"cmd:cat > '{tmp_path}/{{name}}.out'")
+    assert sink.location.endswith("backup_x.zip.out'")
+    sink.fileobj.write(b"streamed")
+    sink.commit()
+    assert (tmp_path / "backup_x.zip.out").read_bytes() == b"streamed"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses a POSIX shell command")
+def test_failing_command_fails_the_commit(tmp_path):
+    sink = open_archive_sink(tmp_path, "backup_x.zip", "cmd:cat > /dev/null; exit 3")
+    sink.fileobj.write(b"streamed")
+    with pytest.raises(Exception, match="exited with code 3"):
+        sink.commit()
+
+
+def test_socket_sink():
+    server = socket.create_server(("127.0.0.1", 0))
+    received = []
+
+    def accept():
+        conn, _ = server.accept()
+        with conn:
+            received.append(b"".join(iter(lambda: conn.recv(65536), b"")))
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+    port = server.getsockname()[1]
+    sink = open_archive_sink(None, "backup_x.zip", f"tcp:127.0.0.1:{port}")
+    assert sink.location == f"tcp:127.0.0.1:{port}"
+    sink.fileobj.write(b"over the wire" * 1000)
+    sink.commit()
+    thread.join()
+    server.close()
+    assert received == [b"over the wire" * 1000]
+
+
+def test_unknown_target(tmp_path):
+    with pytest.raises(ValueError, match="Unknown stream target"):
+        open_archive_sink(tmp_path, "backup_x.zip", "ftp://host")
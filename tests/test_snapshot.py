@@ -0,0 +1,92 @@
+import pytest
+
+from filevault.runlog import RunLog
+from filevault.snapshot import MARKER_FILE_NAME, Snapshot, default_snapshot_dir, validate_snapshot
+from tests.helpers import read_tree
+
+# Replaces a.txt (write + rename) and adds a file once the view is taken.
+CHANGE_SOURCE = ('printf new > "$FILEVAULT_SOURCE/a.tmp" && mv "$FILEVAULT_SOURCE/a.tmp" "$FILEVAULT_SOURCE/a.txt"'
+                 ' && printf late > "$FILEVAULT_SOURCE/late.txt"')
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "auto"])
+def test_archive_holds_the_source_as_of_the_snapshot(vault, mode):
+    vault.write("a.txt", b"old")
+    vault.write("sub/b.txt", b"b")
+    vault.write("skip.tmp", b"skip")
+    result = vault.run(snapshot=mode, snapshot_thaw_command=CHANGE_SOURCE, exclude=["*.tmp"])
+    assert read_tree(vault.restore(result["name"])) == {"a.txt": b"old", "sub/b.txt": b"b"}
+    metrics = result["metrics"]
+    assert metrics["snapshot"]["files"] == 2 and metrics["snapshot"]["method"] in ("reflink", "hardlink")
+    assert "snapshot" in metrics["phases"]
+    # The view is gone once the files are read.
+    assert not default_snapshot_dir(vault.src, vault.dest).exists()
+
+
+def test_snapshot_files_keep_their_source_inodes(vault):
+    vault.write("a.txt", b"a")
+    vault.write("b.txt", b"b")
+    vault.run(snapshot="hardlink", incremental=True)
+    assert vault.run(snapshot="hardlink", incremental=True)["status"] == "no_changes"
+    vault.write("b.txt", b"b2")
+    assert vault.run(incremental=True)["changed"] == 1
+
+
+def test_hook_snapshot_reads_where_the_snapshot_shows_up(vault, tmp_path):
+    vault.write("a.txt", b"live")
+    frozen = tmp_path / "frozen"
+    log = tmp_path / "hooks.log"
+    settings = {
+        "snapshot": "hook",
+        "snapshot_path": str(frozen),
+        "snapshot_freeze_command": f'echo freeze >> {log} && cp -r "$FILEVAULT_SOURCE" "$FILEVAULT_SNAPSHOT"'
+                                   f' && printf frozen > "$FILEVAULT_SNAPSHOT/a.txt"',
+        "snapshot_thaw_command": f"echo thaw >> {log}",
+        "snapshot_release_command": f'echo release >> {log} && rm -r "$FILEVAULT_SNAPSHOT"',
+    }
+    for storage in ("Zip Archives", "Chunk Store"):
+        result = vault.run(storage=storage, **settings)
+        assert read_tree(vault.restore(result["name"])) == {"a.txt": b"frozen"}
+    assert log.read_text().split() == ["freeze", "thaw", "release"] * 2
+    assert not frozen.exists()
+
+
+def test_failing_hooks(vault, tmp_path):
+    vault.write("a.txt", b"a")
+    with pytest.raises(Exception, match="snapshot_freeze_command exited with code 4"):
+        vault.run(snapshot="hardlink", snapshot_freeze_command="exit 4")
+    result = vault.run(snapshot="hardlink", snapshot_thaw_command="exit 5")
+    assert result["status"] == "success"
+    [warning] = RunLog(vault.dest).records("warning")
+    assert "snapshot_thaw_command exited with code 5" in warning["message"]
+    with pytest.raises(Exception, match="did not show up"):
+        vault.run(snapshot="hook", snapshot_path=str(tmp_path / "nowhere"))
+
+
+def test_foreign_snapshot_dir_is_never_removed(vault, tmp_path):
+    vault.write("a.txt", b"a")
+    foreign = tmp_path / "mine"
+    foreign.mkdir()
+    (foreign / "keep.txt").write_bytes(b"keep")
+    with pytest.raises(Exception, match="is not a FileVault snapshot"):
+        vault.run(snapshot="hardlink", snapshot_dir=str(foreign))
+    assert read_tree(foreign) == {"keep.txt": b"keep"}
+
+    snapshot = Snapshot(vault.src, vault.dest, vault.engine(snapshot="hardlink").settings)
+    snapshot.dir.mkdir()
+    (snapshot.dir / MARKER_FILE_NAME).touch()
+    (snapshot.dir / "tree").mkdir()
+    assert vault.run(snapshot="hardlink")["status"] == "success"
+
+
+@pytest.mark.parametrize("settings, message", [
+    ({"snapshot": "lvm"}, "Unknown snapshot mode"),
+    ({"snapshot": "hook"}, "needs snapshot_path"),
+    ({"snapshot": "hardlink", "snapshot_dir": "src/.snap"}, "outside the source folder"),
+])
+def test_invalid_snapshot_settings(tmp_path, settings, message):
+    settings = dict(settings, source_dir=str(tmp_path / "src"))
+    if "snapshot_dir" in settings:
+        settings["snapshot_dir"] = str(tmp_path / settings["snapshot_dir"])
+    with pytest.raises(ValueError, match=message):
+        validate_snapshot(settings)
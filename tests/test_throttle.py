@@ -0,0 +1,138 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from filevault import throttle
+from filevault.runlog import RunLog
+from filevault.throttle import Throttle, TokenBucket, active_limits, parse_days, validate_throttle, window_matches
+
+
+class FakeClock:
+    # Stands in for the time module: sleeping advances the clock.
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, "time", clock)
+    return clock
+
+
+def test_bucket_holds_one_second_then_paces_to_the_rate(clock):
+    bucket = TokenBucket(1000)
+    assert bucket.take(1000) == 0
+    for _ in range(20):
+        bucket.take(100)
+    assert clock.slept == pytest.approx(2.0)
+    # An overdraw is slept off by the caller.
+    assert bucket.take(4000) == pytest.approx(4.0)
+    clock.now += 10
+    assert bucket.take(1000) == 0
+
+
+def test_bucket_rate_changes(clock):
+    bucket = TokenBucket()
+    assert bucket.take(10 ** 9) == 0
+    bucket.set_rate(100)
+    assert bucket.take(50) == pytest.approx(0.5)
+    bucket.set_rate(1000)
+    clock.now += 5
+    assert bucket.take(1500) == pytest.approx(0.5)
+    bucket.set_rate(None)
+    assert bucket.take(10 ** 9) == 0
+
+
+def test_jobs_split_the_shared_bandwidth(clock):
+    shared = throttle.SharedBandwidth(read_rate=1000)
+    first, second = Throttle(None, shared), Throttle(None, shared)
+    assert first.enabled
+    first.read(1000)
+    assert clock.slept == 0
+    # The first job used up the shared second of reads.
+    second.read(500)
+    assert clock.slept == pytest.approx(0.5) and second.waited == pytest.approx(0.5)
+    first.write(10 ** 9)
+    assert clock.slept == pytest.approx(0.5)
+    shared.set_rates(None, None)
+    second.read(10 ** 6)
+    assert clock.slept == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize("window, now, expected", [
+    ({"start": "09:00", "end": "17:00"}, datetime(2026, 3, 2, 9, 0), True),
+    ({"start": "09:00", "end": "17:00"}, datetime(2026, 3, 2, 17, 0), False),
+    ({"start": "09:00", "end": "17:00", "days": "mon-fri"}, datetime(2026, 3, 1, 12, 0), False),
+    # Past midnight the days of the start count: Friday night runs into Saturday.
+    ({"start": "22:00", "end": "06:00", "days": "mon-fri"}, datetime(2026, 3, 7, 3, 0), True),
+    ({"start": "22:00", "end": "06:00", "days": "mon-fri"}, datetime(2026, 3, 2, 3, 0), False),
+    ({"start": "22:00", "end": "06:00", "days": "mon-fri"}, datetime(2026, 3, 6, 23, 0), True),
+    ({"start": "22:00", "end": "06:00"}, datetime(2026, 3, 2, 12, 0), False),
+    ({"days": "sat,sun"}, datetime(2026, 3, 1, 23, 59), True),
+])
+def test_window_matches(window, now, expected):
+    assert window_matches(window, now) is expected
+
+
+def test_days_and_window_overrides():
+    assert parse_days("fri-mon") == {4, 5, 6, 0}
+    assert parse_days("*") == parse_days(None) == set(range(7))
+    config = {"read_bytes_per_s": 1000, "files_per_s": 5,
+              "windows": [{"start": "22:00", "end": "06:00", "read_bytes_per_s": None},
+                          {"start": "00:00", "end": "12:00", "files_per_s": 1}]}
+    assert active_limits(config, datetime(2026, 3, 2, 3, 0)) == {
+        "read_bytes_per_s": None, "write_bytes_per_s": None, "files_per_s": 5, "max_load": None}
+    assert active_limits(config, datetime(2026, 3, 2, 8, 0))["files_per_s"] == 1
+    assert active_limits(config, datetime(2026, 3, 2, 13, 0))["read_bytes_per_s"] == 1000
+    assert active_limits(None) == dict.fromkeys(active_limits(config))
+
+
+@pytest.mark.parametrize("config, message", [
+    ({"windows": [{"start": "late"}]}, "Invalid throttle window"),
+    ({"windows": [{"days": "someday"}]}, "Invalid throttle window"),
+    ({"io_priority": "low"}, "Unknown io_priority"),
+])
+def test_invalid_throttle_settings(config, message):
+    with pytest.raises(ValueError, match=message):
+        validate_throttle(config)
+
+
+def test_throttle_accounts_its_waits(clock):
+    limiter = Throttle({"read_bytes_per_s": 100, "write_bytes_per_s": 100, "files_per_s": 10})
+    out = io.BytesIO()
+    writer = limiter.wrap(out)
+    writer.write(b"x" * 300)
+    limiter.read(300)
+    for _ in range(20):
+        limiter.file()
+    assert out.getvalue() == b"x" * 300
+    # The buckets start empty; the write's wait refills the read bucket.
+    assert limiter.waited == pytest.approx(3.0 + 2.0 + 1.0)
+
+    unlimited = Throttle()
+    assert unlimited.wrap(out) is out
+    unlimited.read(10 ** 9)
+    assert unlimited.waited == 0
+
+
+def test_runs_record_the_time_spent_throttled(vault):
+    vault.write("a.bin", b"x" * 300_000)
+    vault.run(throttle={"write_bytes_per_s": 10 ** 9})
+    vault.write("a.bin", b"y" * 300_000)
+    vault.run(throttle={"read_bytes_per_s": 1_000_000}, codec="store")
+    first, second = RunLog(vault.dest).records("run")
+    assert first["throttled_seconds"] == 0
+    assert second["throttled_seconds"] >= 0.2
+    with pytest.raises(ValueError, match="Unknown io_priority"):
+        vault.run(throttle={"io_priority": "low"})
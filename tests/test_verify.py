@@ -0,0 +1,81 @@
+import os
+
+from filevault.chunkstore import ChunkStore
+from filevault.runlog import RunLog
+from filevault.verify import scrub_slice
+
+
+def corrupt(path, offset):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def test_clean_backup_verifies(vault):
+    vault.write("a.bin", os.urandom(50 * 1024))
+    vault.run()
+    results = vault.engine().verify()
+    assert [item["status"] for item in results] == ["ok"]
+    assert [item["status"] for item in vault.engine().verify(deep=True)] == ["ok"]
+
+
+def test_flipped_byte_is_corrupt(vault):
+    vault.write("a.bin", os.urandom(50 * 1024))
+    result = vault.run()
+    corrupt(vault.dest / result["name"], 1000)
+
+    [fast] = vault.engine().verify()
+    assert fast["status"] == "corrupt"
+    assert "SHA-256 mismatch" in fast["errors"][0]
+    [deep] = vault.engine().verify(deep=True)
+    assert deep["status"] == "corrupt"
+
+    verifies = list(RunLog(vault.dest).records("verify"))
+    assert verifies[-1]["corrupt"] == [result["name"]]
+    assert any(result["name"] in warning["message"] for warning in RunLog(vault.dest).records("warning"))
+
+
+def test_missing_archive(vault):
+    vault.write("a.txt", b"a")
+    result = vault.run()
+    (vault.dest / result["name"]).unlink()
+    [item] = vault.engine().verify()
+    assert item["status"] == "missing"
+
+
+def test_chunk_store_detects_damaged_chunk(vault):
+    vault.write("a.bin", os.urandom(300 * 1024))
+    vault.run(storage="Chunk Store")
+    assert [item["status"] for item in vault.engine().verify()] == ["ok"]
+    chunk = next(ChunkStore(vault.dest).chunks_dir.glob("*/*"))
+    corrupt(chunk, chunk.stat().st_size // 2)
+    [item] = vault.engine().verify()
+    assert item["status"] == "corrupt"
+
+
+def test_scrub_slice_respects_budget():
+    versions = [{"name": str(i), "bytes": 100} for i in range(5)]
+    assert [version["name"] for version in scrub_slice(versions, 250)] == ["0", "1"]
+    assert [version["name"] for version in scrub_slice(versions, 10)] == ["0"]
+    assert len(scrub_slice(versions, 10_000)) == 5
+
+
+def test_scrub_checks_least_recently_verified_first(vault):
+    names = []
+    for i in range(3):
+        vault.write(f"f{i}.bin", os.urandom(10 * 1024))
+        names.append(vault.run()["name"])
+    budget = 12 * 1024
+    seen = [item["name"] for _ in names for item in vault.engine().verify(budget_bytes=budget, trigger="scrub")]
+    assert sorted(seen) == sorted(names)
+
+
+def test_runs_scrub_in_the_background(vault):
+    vault.write("a.bin", os.urandom(10 * 1024))
+    vault.run(scrub_bytes=1)
+    vault.write("b.bin", os.urandom(10 * 1024))
+    vault.run()
+    [record] = RunLog(vault.dest).records("verify")
+    assert (record["trigger"], record["checked"], record["ok"], record["corrupt"]) == ("scrub", 1, 1, [])
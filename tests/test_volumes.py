@@ -0,0 +1,74 @@
+import os
+
+from filevault.catalog import CATALOG_FILE_NAME, Catalog
+from filevault.volumes import archive_name, volume_files, volume_name
+from tests.helpers import read_tree
+
+
+def test_volume_names():
+    assert volume_name("backup_x.zip", 1) == "backup_x.zip"
+    assert volume_name("backup_x.zip", 2) == "backup_x.002.zip"
+    assert archive_name("backup_x.002.zip") == "backup_x.zip"
+    assert archive_name("backup_x.zip") == "backup_x.zip"
+    assert volume_files({"name": "backup_x.zip", "volumes": None}) == ["backup_x.zip"]
+    assert volume_files({"name": "backup_x.zip", "volumes": '[{"name": "backup_x.zip"}, '
+                                                            '{"name": "backup_x.002.zip"}]'}) == [
+        "backup_x.zip", "backup_x.002.zip"]
+
+
+def test_split_archive_round_trips(vault):
+    for i in range(12):
+        vault.write(f"dir{i % 3}/file{i}.bin", os.urandom(20 * 1024))
+    vault.write("big.bin", os.urandom(200 * 1024))
+    result = vault.run(volume_bytes=64 * 1024)
+    volumes = result["metrics"]["volumes"]
+    assert volumes > 2
+
+    stem = result["name"][:-len(".zip")]
+    names = sorted(path.name for path in vault.dest.glob(f"{stem}*.zip"))
+    assert len(names) == volumes
+    assert not list(vault.dest.glob("*.partial"))
+    # Only the file larger than the limit may make its volume overflow.
+    oversized = [name for name in names if (vault.dest / name).stat().st_size > 64 * 1024]
+    assert len(oversized) == 1
+    assert result["metrics"]["bytes_written"] == sum((vault.dest / name).stat().st_size for name in names)
+
+    assert all(item["status"] == "ok" for item in vault.engine().verify(deep=True))
+    assert vault.matches(vault.restore(result["name"]))
+
+
+def test_missing_volume_is_reported(vault):
+    for i in range(8):
+        vault.write(f"file{i}.bin", os.urandom(20 * 1024))
+    result = vault.run(volume_bytes=48 * 1024)
+    (vault.dest / volume_name(result["name"], 2)).unlink()
+    [item] = vault.engine().verify()
+    assert item["status"] == "missing"
+
+
+def test_single_file_comes_from_its_own_volume(vault):
+    files = {f"file{i}.bin": os.urandom(20 * 1024) for i in range(8)}
+    for rel, data in files.items():
+        vault.write(rel, data)
+    name = vault.run(volume_bytes=48 * 1024)["name"]
+    with Catalog(vault.dest) as catalog:
+        tree = catalog.tree(catalog.find_version(name))
+    last = max(files, key=lambda rel: tree[rel]["volume"])
+    assert tree[last]["volume"] > 1
+    # Every other volume can go: the file is read from its volume alone.
+    for volume in range(1, tree[last]["volume"]):
+        (vault.dest / volume_name(name, volume)).unlink()
+    target = vault.restored / "one"
+    vault.engine().restore(name, target, paths=[last])
+    assert read_tree(target) == {last: files[last]}
+
+
+def test_catalog_rebuild_finds_every_volume(vault):
+    for i in range(8):
+        vault.write(f"file{i}.bin", os.urandom(20 * 1024))
+    name = vault.run(volume_bytes=48 * 1024)["name"]
+    before = vault.engine().tree(name)
+    (vault.dest / CATALOG_FILE_NAME).unlink()
+    after = vault.engine().tree(name)
+    assert {path: row["volume"] for path, row in after.items()} == {path: row["volume"] for path, row in before.items()}
+    assert vault.matches(vault.restore(name))
@@ -0,0 +1,211 @@
+import os
+import queue
+import sys
+import time
+import zipfile
+
+import pytest
+
+from filevault.engine import archive_paths, archive_tree, collapse_dirty_paths
+from filevault.manifest import BackupManifest, file_sha256
+from filevault.throttle import Throttle
+from filevault.watch import ChangeJournal, DebouncedTrigger, InotifyWatcher, PollingWatcher
+from tests.helpers import write_tree
+
+
+def wait_for(events, expected, timeout=5):
+    # Collects watcher callbacks until every expected path has been seen.
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while not expected <= seen and time.monotonic() < deadline:
+        try:
+            seen.add(events.get(timeout=0.05))
+        except queue.Empty:
+            pass
+    return seen
+
+
+def test_journal_starts_with_a_rescan(tmp_path):
+    journal = ChangeJournal(tmp_path)
+    journal.open()
+    journal.record("a.txt")
+    assert journal.begin() == ({"a.txt"}, True)
+    journal.commit()
+    journal.record("b.txt")
+    journal.record("b.txt")
+    journal.record("c/d.txt")
+    assert journal.begin() == ({"b.txt", "c/d.txt"}, False)
+    journal.commit()
+    journal.close()
+
+
+def test_rolled_back_changes_come_back(tmp_path):
+    journal = ChangeJournal(tmp_path)
+    journal.open()
+    journal.begin()
+    journal.commit()
+    journal.record("a.txt")
+    assert journal.begin() == ({"a.txt"}, False)
+    journal.rollback()
+    journal.record("b.txt")
+    assert journal.begin() == ({"a.txt", "b.txt"}, False)
+    journal.commit()
+    assert journal.begin() == (set(), False)
+    journal.close()
+
+
+def test_missing_or_torn_journal_means_rescan(tmp_path):
+    journal = ChangeJournal(tmp_path)
+    assert journal.begin() == (set(), True)
+    journal.open()
+    journal.begin()
+    journal.commit()
+    journal.record("a.txt")
+    with open(journal.path, "a") as f:
+        f.write('{"path": "b.t')
+    assert journal.begin() == ({"a.txt"}, True)
+    journal.close()
+
+
+def journaled_vault(vault, **settings):
+    # A destination with one run behind it, so the journal's opening rescan
+    # has been consumed.
+    journal = ChangeJournal(vault.dest)
+    journal.open()
+    vault.write("a.txt", b"a1")
+    vault.write("b.txt", b"b1")
+    vault.engine(**settings).run(journal)
+    return journal
+
+
+def test_incremental_run_archives_only_journaled_paths(vault):
+    journal = journaled_vault(vault, incremental=True)
+    vault.write("a.txt", b"a2")
+    vault.write("b.txt", b"b2")
+    journal.record("a.txt")
+    name = vault.engine(incremental=True).run(journal)["name"]
+    with zipfile.ZipFile(vault.dest / name) as zipf:
+        assert zipf.namelist() == ["a.txt"]
+    journal.close()
+
+
+@pytest.mark.parametrize("settings", [{}, {"incremental": True, "volume_bytes": 10 ** 6},
+                                      {"storage": "Chunk Store"}])
+def test_every_successful_run_consumes_the_journal(vault, settings):
+    journal = journaled_vault(vault, **settings)
+    vault.write("a.txt", b"a2")
+    journal.record("a.txt")
+    journal.record("b.txt")
+    assert vault.engine(**settings).run(journal)["status"] == "success"
+    assert not journal.consuming_path.exists()
+    # So does a run with nothing new (no_changes for all but full backups).
+    journal.record("b.txt")
+    vault.engine(**settings).run(journal)
+    assert journal.begin() == (set(), False)
+    journal.close()
+
+
+def test_failed_run_keeps_the_journal(vault):
+    journal = journaled_vault(vault, incremental=True)
+    vault.write("a.txt", b"a2")
+    journal.record("a.txt")
+    with pytest.raises(Exception):
+        vault.engine(incremental=True, stream_target="cmd:cat > /dev/null; exit 3").run(journal)
+    journal.record("b.txt")
+    assert journal.begin() == ({"a.txt", "b.txt"}, False)
+    journal.close()
+
+
+def test_collapse_dirty_paths():
+    assert collapse_dirty_paths(["a/b/c.txt", "a/b", "a/bc.txt", "d.txt", "a/b/e/f"]) == [
+        "a/b", "a/bc.txt", "d.txt"]
+
+
+def test_journal_run_matches_a_full_scan(tmp_path):
+    src = tmp_path / "src"
+    write_tree(src, {"keep.txt": b"k", "edit.txt": b"e1", "gone/x.txt": b"x", "dir/y.txt": b"y"})
+
+    class Recorder:
+        # Stands in for a ParallelArchiver: records what would be written.
+        def __init__(self):
+            self.added = []
+            self.on_written = None
+            self.throttle = Throttle()
+            self.delta = None
+            self.drop_cache = False
+
+        def add_file(self, path, arcname, st):
+            self.added.append(arcname)
+            self.on_written(arcname, file_sha256(path))
+
+        def finish(self):
+            pass
+
+    manifest = BackupManifest(tmp_path)
+    manifest.files, _, _ = archive_tree(Recorder(), src, manifest, True)
+
+    write_tree(src, {"edit.txt": b"e2", "dir/new.txt": b"n"})
+    for path in (src / "gone").iterdir():
+        path.unlink()
+    (src / "gone").rmdir()
+    archiver = Recorder()
+    files, changed, deleted = archive_paths(archiver, src, manifest, ["edit.txt", "gone", "dir/new.txt"])
+    assert sorted(changed) == ["dir/new.txt", "edit.txt"]
+    assert deleted == ["gone/x.txt"]
+    scanned, _, _ = archive_tree(Recorder(), src, manifest, True)
+    assert {k: v["sha256"] for k, v in files.items()} == {k: v["sha256"] for k, v in scanned.items()}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_inotify_reports_changes_in_new_directories(tmp_path):
+    events = queue.Queue()
+    watcher = InotifyWatcher(tmp_path, events.put)
+    watcher.start()
+    try:
+        (tmp_path / "a.txt").write_bytes(b"a")
+        assert "a.txt" in wait_for(events, {"a.txt"})
+        (tmp_path / "new").mkdir()
+        assert "new" in wait_for(events, {"new"})
+        # The new directory is watched too.
+        time.sleep(0.1)
+        (tmp_path / "new" / "b.txt").write_bytes(b"b")
+        assert "new/b.txt" in wait_for(events, {"new/b.txt"})
+    finally:
+        watcher.stop()
+
+
+def test_polling_watcher(tmp_path):
+    write_tree(tmp_path, {"a.txt": b"a"})
+    events = queue.Queue()
+    watcher = PollingWatcher(tmp_path, events.put, interval=0.05)
+    watcher.start()
+    try:
+        time.sleep(0.1)
+        write_tree(tmp_path, {"a.txt": b"longer", "d/b.txt": b"b"})
+        os.utime(tmp_path / "a.txt", (1, 1))
+        assert wait_for(events, {"a.txt", "d/b.txt"}) >= {"a.txt", "d/b.txt"}
+    finally:
+        watcher.stop()
+
+
+def test_debounced_trigger_fires_once_after_quiet():
+    fired = queue.Queue()
+    trigger = DebouncedTrigger(lambda: fired.put(time.monotonic()), quiet=0.1, max_delay=5)
+    started = time.monotonic()
+    for _ in range(5):
+        trigger.poke()
+        time.sleep(0.02)
+    assert fired.get(timeout=2) - started >= 0.1
+    time.sleep(0.2)
+    assert fired.empty()
+
+
+def test_debounced_trigger_honours_max_delay():
+    fired = queue.Queue()
+    trigger = DebouncedTrigger(lambda: fired.put(time.monotonic()), quiet=0.2, max_delay=0.3)
+    started = time.monotonic()
+    while fired.empty() and time.monotonic() - started < 2:
+        trigger.poke()
+        time.sleep(0.05)
+    assert fired.get(timeout=1) - started < 0.6
+    trigger.cancel()
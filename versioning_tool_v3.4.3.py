@@ -1,21 +1,21 @@
 import customtkinter as ctk
 from tkinter import filedialog
-from datetime import datetime, timedelta
-import shutil
+from datetime import datetime
 from pathlib import Path
-import json
-import zipfile
 import threading
-import schedule
-import time
 import sys
 
-# === Settings ===
-SETTINGS_FILE = Path("backup_settings.json")
+from filevault.compression import CODEC_METHODS
+from filevault.engine import DEFAULT_SETTINGS, SCHEDULE_INTERVALS, load_settings, restore_path, save_settings
+from filevault.progress import EventQueue, ProgressMeter, describe_progress, format_duration
+from filevault.scheduler import DEFAULT_JOB_NAME, JobScheduler, load_jobs
+
 
-# === App Setup ===
-ctk.set_appearance_mode("System")
-ctk.set_default_color_theme("blue")
+SETTINGS_FILE = Path("backup_settings.json")
+# Widgets are only touched on the Tk thread: worker threads put events on
+# self.events, which is drained at most this often (about 20 frames/s).
+EVENT_DRAIN_MS = 50
+RESTORE_TASK = None
 
 
 class BackupApp(ctk.CTk):
@@ -28,19 +28,34 @@ class BackupApp(ctk.CTk):
             print(f"Icon not set: {e}")
 
         self.title("FileVault | Backup & Versioning Software | V3.4.3")
-        self.geometry("925x300")
+        self.geometry("925x380")
 
         self.source_dir = ctk.StringVar()
         self.dest_dir = ctk.StringVar()
         self.schedule_var = ctk.StringVar(value="None")
         self.max_backups_var = ctk.StringVar(value="5")
-        self.next_backup_time = None
-        self.backup_lock = threading.Lock()
+        self.incremental_var = ctk.BooleanVar(value=False)
+        self.storage_var = ctk.StringVar(value="Zip Archives")
+        self.codec_var = ctk.StringVar(value="deflate")
+        self.watch_var = ctk.BooleanVar(value=False)
+        # Engine settings without a widget (workers, codec_level, full_every,
+        # stream_target, ...) are kept as loaded and written back unchanged.
+        try:
+            self.settings = load_settings(SETTINGS_FILE)
+        except Exception as e:
+            print(f"Failed to load settings: {e}")
+            self.settings = dict(DEFAULT_SETTINGS)
+        # Every backup (button, interval, cron, on change, extra jobs from the
+        # settings file) goes through the scheduler, which queues instead of
+        # dropping a trigger while the job is busy.
+        self.events = EventQueue()
+        self.scheduler = JobScheduler(self.events.put)
 
         self.create_widgets()
         self.load_settings()
-        self.start_scheduler_thread()
-        self.start_countdown_thread()
+        self.scheduler.start()
+        self.drain_events()
+        self.update_countdown()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def resource_path(self, relative_path):
@@ -49,33 +64,27 @@ class BackupApp(ctk.CTk):
         except AttributeError:
             return Path(__file__).parent / relative_path
 
-    def start_scheduler_thread(self):
-        def scheduler_loop():
-            while True:
-                schedule.run_pending()
-                time.sleep(1)
-
-        threading.Thread(target=scheduler_loop, daemon=True).start()
-
-    def start_countdown_thread(self):
-        def update_countdown():
-            while True:
-                if self.next_backup_time:
-                    now = datetime.now()
-                    remaining = self.next_backup_time - now
-                    if remaining.total_seconds() > 0:
-                        h, rem = divmod(int(remaining.total_seconds()), 3600)
-                        m, s = divmod(rem, 60)
-                        countdown_text = f"Next backup in: {h:02}:{m:02}:{s:02}"
-                    else:
-                        countdown_text = "Next backup in: scheduling..."
-                else:
-                    countdown_text = "Next backup in: --:--:--"
-
-                self.countdown_label.configure(text=countdown_text)
-                time.sleep(1)
-
-        threading.Thread(target=update_countdown, daemon=True).start()
+    def update_countdown(self):
+        next_backup_time = self.scheduler.next_run(DEFAULT_JOB_NAME)
+        if next_backup_time:
+            remaining = (next_backup_time - datetime.now()).total_seconds()
+            if remaining > 0:
+                countdown_text = f"Next backup in: {format_duration(remaining)}"
+            else:
+                countdown_text = "Next backup in: scheduling..."
+        else:
+            countdown_text = "Next backup in: --:--:--"
+
+        self.countdown_label.configure(text=countdown_text)
+        self.after(1000, self.update_countdown)
+
+    def drain_events(self):
+        for name, event, data in self.events.drain():
+            if name is RESTORE_TASK:
+                self.on_restore_event(event, data)
+            else:
+                self.on_job_event(name, event, data)
+        self.after(EVENT_DRAIN_MS, self.drain_events)
 
     def create_widgets(self):
         self.input_frame = ctk.CTkFrame(self)
@@ -103,7 +112,7 @@ class BackupApp(ctk.CTk):
 
         self.schedule_optionmenu = ctk.CTkOptionMenu(
             self.button_frame,
-            values=["None", "1 minute", "5 minutes", "15 minutes", "30 minutes", "1 hour", "3 hours", "6 hours", "12 hours", "1 day"],
+            values=["None", "On change", "1 minute", "5 minutes", "15 minutes", "30 minutes", "1 hour", "3 hours", "6 hours", "12 hours", "1 day"],
             variable=self.schedule_var,
             command=self.set_schedule
         )
@@ -117,6 +126,39 @@ class BackupApp(ctk.CTk):
             command=lambda _: self.save_settings()
         ).grid(row=0, column=5, padx=(5, 10), pady=5, sticky="w")
 
+        self.restore_button = ctk.CTkButton(self.button_frame, text="Restore...", command=self.threaded_restore)
+        self.restore_button.grid(row=1, column=0, pady=5, padx=(125, 10), sticky="ew", columnspan=2)
+
+        ctk.CTkCheckBox(
+            self.button_frame,
+            text="Incremental (only changed files)",
+            variable=self.incremental_var,
+            command=self.save_settings
+        ).grid(row=1, column=2, columnspan=2, padx=(10, 5), pady=5, sticky="w")
+
+        ctk.CTkLabel(self.button_frame, text="Storage:").grid(row=1, column=4, padx=(10, 5), pady=5, sticky="e")
+        ctk.CTkOptionMenu(
+            self.button_frame,
+            values=["Zip Archives", "Chunk Store"],
+            variable=self.storage_var,
+            command=lambda _: self.save_settings()
+        ).grid(row=1, column=5, padx=(5, 10), pady=5, sticky="w")
+
+        ctk.CTkCheckBox(
+            self.button_frame,
+            text="Watch for changes",
+            variable=self.watch_var,
+            command=self.toggle_watch
+        ).grid(row=2, column=2, columnspan=2, padx=(10, 5), pady=5, sticky="w")
+
+        ctk.CTkLabel(self.button_frame, text="Compression:").grid(row=2, column=4, padx=(10, 5), pady=5, sticky="e")
+        ctk.CTkOptionMenu(
+            self.button_frame,
+            values=list(CODEC_METHODS),
+            variable=self.codec_var,
+            command=lambda _: self.save_settings()
+        ).grid(row=2, column=5, padx=(5, 10), pady=5, sticky="w")
+
         self.status_label = ctk.CTkLabel(self.status_frame, text="", text_color="gray")
         self.status_label.pack()
         self.progress_bar = ctk.CTkProgressBar(self.status_frame, mode="indeterminate")
@@ -130,38 +172,48 @@ class BackupApp(ctk.CTk):
         self.update_run_button_state()
 
     def load_settings(self):
-        if SETTINGS_FILE.exists():
-            try:
-                with open(SETTINGS_FILE, "r") as f:
-                    data = json.load(f)
-                    self.source_dir.set(data.get("source_dir", ""))
-                    self.dest_dir.set(data.get("dest_dir", ""))
-                    max_backups = data.get("max_backups", 5)
-                    self.max_backups_var.set("Disabled" if max_backups is None else str(max_backups))
-                    self.schedule_var.set(data.get("schedule", "None"))
-                    self.set_schedule(self.schedule_var.get())
-            except Exception as e:
-                print(f"Failed to load settings: {e}")
+        data = self.settings
+        self.source_dir.set(data["source_dir"])
+        self.dest_dir.set(data["dest_dir"])
+        max_backups = data["max_backups"]
+        self.max_backups_var.set("Disabled" if max_backups is None else str(max_backups))
+        self.incremental_var.set(data["incremental"])
+        self.storage_var.set(data["storage"])
+        self.codec_var.set(data["codec"])
+        self.watch_var.set(data["watch"])
+        self.schedule_var.set(data["schedule"])
+        self.set_schedule(self.schedule_var.get())
 
         self.update_schedule_state()
         self.update_run_button_state()
+        self.apply_jobs()
+
+    def apply_jobs(self):
+        try:
+            self.scheduler.set_limits(self.settings)
+            self.scheduler.set_jobs(load_jobs(self.settings))
+        except Exception as e:
+            self.status_label.configure(text=f"Invalid job settings: {e}", text_color="red")
 
     def save_settings(self):
         try:
             max_backups_value = self.max_backups_var.get()
             max_backups = int(max_backups_value) if max_backups_value != "Disabled" else None
 
-            data = {
+            self.settings.update({
                 "source_dir": self.source_dir.get(),
                 "dest_dir": self.dest_dir.get(),
                 "max_backups": max_backups,
-                "schedule": self.schedule_var.get()
-            }
-
-            with open(SETTINGS_FILE, "w") as f:
-                json.dump(data, f, indent=4)
+                "schedule": self.schedule_var.get(),
+                "incremental": self.incremental_var.get(),
+                "storage": self.storage_var.get(),
+                "codec": self.codec_var.get(),
+                "watch": self.watch_var.get()
+            })
+            save_settings(self.settings, SETTINGS_FILE)
         except Exception as e:
             print(f"Failed to save settings: {e}")
+        self.apply_jobs()
 
     def select_source(self):
         path = filedialog.askdirectory()
@@ -187,168 +239,123 @@ class BackupApp(ctk.CTk):
             self.schedule_var.set("None")
 #            self.save_settings()
 
+    def toggle_watch(self):
+        if self.watch_var.get():
+            self.incremental_var.set(True)
+        elif self.schedule_var.get() == "On change":
+            self.schedule_var.set("None")
+            self.set_schedule("None")
+        self.save_settings()
+
     def update_run_button_state(self):
         if self.source_dir.get() and self.dest_dir.get():
             self.run_backup_button.configure(state="normal")
         else:
             self.run_backup_button.configure(state="disabled")
 
+        if self.dest_dir.get():
+            self.restore_button.configure(state="normal")
+        else:
+            self.restore_button.configure(state="disabled")
+
     def run_backup(self):
-        if not self.backup_lock.acquire(blocking=False):
-            self.status_label.configure(text="Backup already running.", text_color="orange")
+        self.save_settings()
+        if self.scheduler.state(DEFAULT_JOB_NAME) != "idle":
+            self.status_label.configure(text="Backup already running; queued to run next.", text_color="orange")
+        self.scheduler.trigger(DEFAULT_JOB_NAME)
+
+    def on_job_event(self, name, event, data):
+        # Called on the Tk thread by drain_events. Progress is only shown for
+        # the job edited in this window; other jobs report when they finish.
+        if name != DEFAULT_JOB_NAME:
+            timestampcompletion = datetime.now().strftime("%m-%d-%Y at %H:%M:%S")
+            if event == "finished" and data["status"] == "success":
+                self.status_label.configure(text=f"Job {name} completed on {timestampcompletion}.", text_color="#05a7f7")
+            elif event == "failed":
+                self.status_label.configure(text=f"Job {name} failed: {data}", text_color="red")
             return
 
-        try:
+        if event == "started":
             self.run_backup_button.configure(state="disabled")
-            src = Path(self.source_dir.get())
-            dest_base = Path(self.dest_dir.get())
-
-            if not src.exists() or not dest_base.exists():
-                self.status_label.configure(text="Invalid folder paths.", text_color="red")
-                return
-
             self.status_label.configure(text="Backing up...", text_color="gray")
             self.progress_bar.configure(mode="determinate", progress_color="#FFDD57")
             self.progress_bar.set(0)
-            self.update_idletasks()
             self.button_frame.pack_forget()
-            self.button_frame.update()
-
-            timestampfile = datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
-            zip_name = f"backup_{timestampfile}.zip"
-            zip_path = src.parent / zip_name
-            log_file = dest_base / "backup_log.txt"
-
-            try:
-                all_files = list(src.rglob('*'))
-                file_list = [f for f in all_files if f.is_file()]
-                total_files = len(file_list)
-                if total_files == 0:
-                    raise Exception("No files to back up.")
-
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for i, file in enumerate(file_list, start=1):
-                        arcname = file.relative_to(src)
-                        zipf.write(file, arcname)
-                        if i % 10 == 0 or i == total_files:
-                            self.progress_bar.set(i / total_files)
-                            self.update_idletasks()
-
-                dest_path = dest_base / zip_path.name
-                shutil.move(str(zip_path), dest_path)
-
-                self.enforce_backup_rotation()
-
-                with open(log_file, "a") as log:
-                    log.write(f"[{timestampfile}] SUCCESS: {zip_path.name} -> {dest_path}\n")
-
-                timestampcompletion = datetime.now().strftime("%m-%d-%Y at %H:%M:%S")
+        elif event == "progress":
+            self.progress_bar.set(data["files"] / data["total"])
+            self.status_label.configure(text=f"Backing up... {describe_progress(data)}", text_color="gray")
+        elif event in ("finished", "failed"):
+            timestampcompletion = datetime.now().strftime("%m-%d-%Y at %H:%M:%S")
+            if event == "failed":
+                self.status_label.configure(text=f"Backup failed: {data}", text_color="red")
+            elif data["status"] == "no_changes":
+                self.status_label.configure(text=f"No changes since last backup ({timestampcompletion}).", text_color="#05a7f7")
+            else:
                 self.status_label.configure(text=f"Backup completed successfully on {timestampcompletion}.", text_color="#05a7f7")
-
-            except Exception as e:
-                with open(log_file, "a") as log:
-                    log.write(f"[{timestampfile}] ERROR: {e}\n")
-                self.status_label.configure(text=f"Backup failed: {e}", text_color="red")
-
             self.progress_bar.set(0)
             self.button_frame.pack(padx=20, pady=10, fill="x")
-        finally:
             self.run_backup_button.configure(state="normal")
-            self.backup_lock.release()
-
-    def enforce_backup_rotation(self):
-        dest_base = Path(self.dest_dir.get())
-        log_file = dest_base / "backup_log.txt"
-        backups = sorted(dest_base.glob("backup_*.zip"), key=lambda f: f.stat().st_mtime)
-        max_backups_str = self.max_backups_var.get()
-
-        if max_backups_str == "Disabled":
-            return
-
-        try:
-            max_backups = int(max_backups_str)
-        except ValueError:
-            max_backups = 5
-
-        if max_backups == 0:
-            return
-
-        if len(backups) > max_backups:
-            to_delete = backups[:-max_backups]
-            with open(log_file, "a") as log:
-                for old_backup in to_delete:
-                    try:
-                        old_backup.unlink()
-                        log.write(f"[{datetime.now().strftime('%m-%d-%Y %H:%M:%S')}] DELETED FOR ROLLOVER: {old_backup.name}\n")
-                    except Exception as e:
-                        log.write(f"[{datetime.now().strftime('%m-%d-%Y %H:%M:%S')}] DELETE FAILED: {old_backup.name} - {e}\n")
 
     def set_schedule(self, interval):
-        schedule.clear()
         interval = self.schedule_var.get()
-        interval_map = {
-            "None": (None, None),
-            "1 minute": ("minutes", 1),
-            "5 minutes": ("minutes", 5),
-            "15 minutes": ("minutes", 15),
-            "30 minutes": ("minutes", 30),
-            "1 hour": ("hours", 1),
-            "3 hours": ("hours", 3),
-            "6 hours": ("hours", 6),
-            "12 hours": ("hours", 12),
-            "1 day": ("hours", 24)
-        }
-
-        unit, amount = interval_map.get(interval, (None, None))
+        unit, amount = SCHEDULE_INTERVALS.get(interval, (None, None))
+
+        if interval == "On change":
+            self.incremental_var.set(True)
+            self.watch_var.set(True)
+            self.status_label.configure(text="Auto backup when files change.", text_color="gray")
+            self.save_settings()
+            return
 
         if unit is None or amount is None:
-            self.next_backup_time = None
             self.status_label.configure(text="Auto backup disabled.", text_color="gray")
             self.save_settings()
             return
 
-        if unit == "minutes":
-            schedule.every(amount).minutes.do(self.threaded_backup)
-        elif unit == "hours":
-            schedule.every(amount).hours.do(self.threaded_backup)
-
-        self.set_next_backup_time(amount, unit)
         self.status_label.configure(text=f"Auto backup every {interval}.", text_color="gray")
         self.save_settings()
 
-    def set_next_backup_time(self, amount, unit):
-        now = datetime.now()
-        if unit == "minutes":
-            self.next_backup_time = now + timedelta(minutes=amount)
-        elif unit == "hours":
-            self.next_backup_time = now + timedelta(hours=amount)
-        else:
-            self.next_backup_time = None
-
-    def threaded_backup(self):
-        def backup_and_update_time():
-            self.run_backup()
-            interval = self.schedule_var.get()
-            interval_map = {
-                "1 minute": ("minutes", 1),
-                "5 minutes": ("minutes", 5),
-                "15 minutes": ("minutes", 15),
-                "30 minutes": ("minutes", 30),
-                "1 hour": ("hours", 1),
-                "3 hours": ("hours", 3),
-                "6 hours": ("hours", 6),
-                "12 hours": ("hours", 12),
-                "1 day": ("hours", 24)
-            }
-
-            unit, amount = interval_map.get(interval, (None, None))
-            if unit and amount:
-                self.set_next_backup_time(amount, unit)
-
-        threading.Thread(target=backup_and_update_time, daemon=True).start()
+    def threaded_restore(self):
+        dest_base = Path(self.dest_dir.get())
+        archive = filedialog.askopenfilename(
+            title="Select backup to restore",
+            initialdir=str(dest_base),
+            filetypes=[("Backup archives", "backup_*.zip"), ("Chunk store versions", "backup_*.json")]
+        )
+        if not archive:
+            return
+        target = filedialog.askdirectory(title="Restore into folder")
+        if not target:
+            return
+
+        def restore():
+            self.events.put(RESTORE_TASK, "started")
+            try:
+                progress = ProgressMeter(lambda snapshot: self.events.put(RESTORE_TASK, "progress", snapshot))
+                restored = restore_path(archive, target, progress)
+                self.events.put(RESTORE_TASK, "finished", f"Restored {restored} files to {target}.")
+            except Exception as e:
+                self.events.put(RESTORE_TASK, "failed", e)
+
+        threading.Thread(target=restore, daemon=True).start()
+
+    def on_restore_event(self, event, data):
+        if event == "started":
+            self.status_label.configure(text="Restoring...", text_color="gray")
+            self.progress_bar.configure(mode="determinate", progress_color="#FFDD57")
+        elif event == "progress":
+            self.progress_bar.set(data["files"] / data["total"])
+            self.status_label.configure(text=f"Restoring... {describe_progress(data)}", text_color="gray")
+        elif event == "finished":
+            self.status_label.configure(text=data, text_color="#05a7f7")
+            self.progress_bar.set(0)
+        elif event == "failed":
+            self.status_label.configure(text=f"Restore failed: {data}", text_color="red")
+            self.progress_bar.set(0)
 
     def on_closing(self):
         self.save_settings()
+        self.scheduler.stop()
         self.destroy()
 
 if __name__ == "__main__":